@@ -1,11 +1,18 @@
-"""Failed login tracking.
+"""Failed login tracking and cached access decisions.
 
 Keep track of the number of failed attempts to log in per user over a given time
 period. If there are too many failed login attempts during that period, the user
 will be locked out.
+
+AccessCache remembers whether users may access other users' projects, so that
+repeated checks don't have to go back to the database.
 """
 
 import time
+import threading
+import weakref
+
+from sqlalchemy.orm.interfaces import SessionExtension
 
 class FailedLoginInfo(object):
     def __init__(self, username, can_log_in, failed_attempts):
@@ -61,5 +68,71 @@ class MemoryFailedLoginTracker(object):
             del self.store[fli.username]
         except KeyError:
             pass
-        
-        
\ No newline at end of file
+
+class AccessCache(object):
+    """Remembers access decisions for ttl seconds. Changing sharing or
+    group membership calls invalidate(), which drops everything and
+    bumps the generation, so that caches built on these decisions can
+    tell that their entries are stale too. Changes made by other
+    processes are only seen once the entries expire."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def get(self, key):
+        """Returns the cached decision, or None if there isn't one."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, key, value, generation):
+        """Remembers value, which was looked up when the cache was at
+        generation. If the cache has been invalidated since, value may
+        come from the old rows and is dropped."""
+        self._lock.acquire()
+        try:
+            if generation == self.generation:
+                self._entries[key] = (time.time() + self.ttl, value)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, session=None):
+        """Drops all decisions. Call this after writing the change. If
+        it was written in a database session, the cache is invalidated
+        again when that session commits or rolls back, because until
+        then other sessions still see the old rows."""
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self.generation += 1
+            if session is not None:
+                self._sessions[session] = True
+        finally:
+            self._lock.release()
+
+    def session_ended(self, session):
+        self._lock.acquire()
+        try:
+            changed = self._sessions.pop(session, False)
+        finally:
+            self._lock.release()
+        if changed:
+            self.invalidate()
+
+class AccessCacheExtension(SessionExtension):
+    """Tells the access cache when a database session commits or rolls
+    back."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def after_commit(self, session):
+        self.cache.session_ended(session)
+
+    def after_rollback(self, session):
+        self.cache.session_ended(session)
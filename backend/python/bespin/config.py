@@ -38,7 +38,7 @@ from path import path
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from bespin import stats, auth
+from bespin import stats, auth, locks, openfiles, mobwriteclient
 
 class InvalidConfiguration(Exception):
     pass
@@ -105,6 +105,19 @@ c.stats_type = "none"
 c.redis_host = None
 c.redis_port = None
 
+# locking of the sqlite open files registry: thread, flock
+# thread only keeps out other threads in the same process
+# flock also works between server processes (and falls back
+# to thread where fcntl is not available)
+c.lock_type = "flock"
+
+# where the open files are tracked: sqlite, memory
+# memory only works with a single server process
+# sqlite keeps them in open_files_db, which defaults to
+# .bespin-openfiles.db in the fsroot
+c.open_files_type = "sqlite"
+c.open_files_db = None
+
 # login failure tracking: none, memory, redis
 # memory holds the login failure attempts in a dictionary and should
 # not be used in production
@@ -118,9 +131,37 @@ c.login_attempts = 10
 # how long a user is locked out (in seconds)
 c.lockout_period = 600
 
+# how long (in seconds) a decision about whether a user may access
+# another user's project is remembered
+c.access_cache_ttl = 60
+
 # Are we using in-process mobwrite, or telnet to port 3017
 c.in_process_mobwrite = False
 
+# where the mobwrite daemon listens, and how many idle connections
+# to it each server process keeps open
+c.mobwrite_host = "localhost"
+c.mobwrite_port = 3017
+c.mobwrite_pool_size = 8
+
+# number of mobwrite daemons sharing the documents between them,
+# listening on consecutive ports starting at mobwrite_port
+c.mobwrite_shards = 1
+
+# longest time, in seconds, that a w= request to /mobwrite/ is held
+# waiting for edits from other users. 0 answers them at once, which
+# makes w= the same as q=. A held request keeps its web server thread
+# busy for the whole wait (and, in-process, a daemon thread as well),
+# so every idle editor holds a thread: only turn this on when the
+# thread pool is much larger than the number of open editors. When it
+# is on, /mobwrite/ says so in a header and the editor starts sending w=.
+c.mobwrite_long_poll = 0
+
+# should in-process mobwrite keep a journal of the edits to each file
+# (in fsroot/.mobwrite-journal) rather than rewriting the whole file
+# on every save
+c.mobwrite_journal = True
+
 # if this is true, the user's UUID will be used as their
 # user directory name. If it's false, their username will
 # be used. Generally, you'll only want this to be false
@@ -228,8 +269,11 @@ def activate_profile():
             name, directory = mapping.split("=")
             static_map[name] = directory
 
+    c.access_cache = auth.AccessCache(int(c.access_cache_ttl))
+
     c.dbengine = create_engine(c.dburl)
-    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine))
+    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine,
+        extension=auth.AccessCacheExtension(c.access_cache)))
     c.fsroot = path(c.fsroot)
 
     c.static_dir = path(c.static_dir)
@@ -267,6 +311,41 @@ def activate_profile():
     else:
         c.stats = stats.DoNothingStats()
 
+    if c.lock_type == "flock" and locks.fcntl is not None:
+        c.locks = locks.FlockLocks()
+    elif c.lock_type in ("thread", "flock"):
+        c.locks = locks.ThreadLocks()
+    else:
+        raise InvalidConfiguration("Unknown lock_type: %s" % c.lock_type)
+
+    if c.open_files_type == "sqlite":
+        open_files_db = c.open_files_db
+        if not open_files_db:
+            open_files_db = c.fsroot / ".bespin-openfiles.db"
+        c.open_files = openfiles.SQLiteOpenFiles(open_files_db, c.locks)
+    elif c.open_files_type == "memory":
+        c.open_files = openfiles.MemoryOpenFiles()
+    else:
+        raise InvalidConfiguration("Unknown open_files_type: %s"
+                                   % c.open_files_type)
+
+    if c.in_process_mobwrite:
+        c.mobwrite_pool = None
+        from bespin.mobwrite import mobwrite_daemon
+        c.mobwrite_persister = mobwrite_daemon.Persister()
+        if c.mobwrite_journal:
+            c.mobwrite_persister = mobwrite_daemon.JournalPersister(
+                c.mobwrite_persister, c.fsroot / ".mobwrite-journal")
+    else:
+        pools = [mobwriteclient.ConnectionPool(
+                    (c.mobwrite_host, int(c.mobwrite_port) + shard),
+                    int(c.mobwrite_pool_size))
+                 for shard in range(int(c.mobwrite_shards))]
+        if len(pools) == 1:
+            c.mobwrite_pool = pools[0]
+        else:
+            c.mobwrite_pool = mobwriteclient.ShardedPool(pools)
+
     if isinstance(c.stats_users, basestring):
         c.stats_users = set(c.stats_users.split(','))
     if isinstance(c.stats_display, basestring):
@@ -27,7 +27,6 @@ import httplib2
 from urlparse import urlparse
 import logging
 from datetime import date
-import socket
 import urllib
 from hashlib import sha256
 
@@ -259,8 +258,43 @@ def getfile(request, response):
     project = get_project(user, owner, project)
 
     mode = request.GET.get('mode', 'rw')
-    contents = project.get_file(path, mode)
-    response.body = contents
+    file_obj = project.open_file(path, mode)
+    return _send_file(request, response, file_obj)
+
+# size of the pieces that files are sent in when the server
+# does not provide wsgi.file_wrapper
+SEND_BLOCK_SIZE = 65536
+
+def _iter_file(fileobj):
+    try:
+        while True:
+            data = fileobj.read(SEND_BLOCK_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        fileobj.close()
+
+def _send_file(request, response, file_obj):
+    """Responds with the contents of file_obj, letting the server
+    send the file itself through wsgi.file_wrapper when it can. The
+    ETag and Last-Modified come from the file's stat, and a matching
+    If-None-Match or If-Modified-Since gets a 304 with no body."""
+    info = file_obj.info
+    response.etag = "%x-%x" % (info['size'], int(info['mtime'] * 1000000))
+    response.last_modified = int(info['mtime'])
+    # the client may keep the file, but has to check back each time
+    response.headers['Cache-Control'] = "private, no-cache, must-revalidate"
+    del response.headers['Pragma']
+    response.conditional_response = True
+
+    fileobj = open(file_obj.location, "rb")
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        response.app_iter = file_wrapper(fileobj, SEND_BLOCK_SIZE)
+    else:
+        response.app_iter = _iter_file(fileobj)
+    response.content_length = info['size']
     return response()
 
 @expose(r'^/file/close/(?P<path>.*)$', 'POST')
@@ -307,10 +341,11 @@ def listfiles(request, response):
             project = get_project(user, owner, project)
 
         files = project.list_files(path)
+        open_files = project.open_files()
 
         for item in files:
             reply = { 'name':item.short_name }
-            _populate_stats(item, reply)
+            _populate_stats(item, reply, open_files)
             result.append(reply)
 
     return _respond_json(response, result)
@@ -387,12 +422,18 @@ def file_search(request, response):
     result = project.search_files(query, limit, include)
     return _respond_json(response, result)
 
-def _populate_stats(item, result):
+def _populate_stats(item, result, open_files=None):
+    """Adds the stats for item to result. open_files is the
+    project's Project.open_files(), when the caller has it."""
     if isinstance(item, File):
         result['size'] = item.saved_size
         result['created'] = item.created.strftime("%Y%m%dT%H%M%S")
         result['modified'] = item.modified.strftime("%Y%m%dT%H%M%S")
-        result['openedBy'] = [username for username in item.users]
+        if open_files is None:
+            users = item.users
+        else:
+            users = open_files.get(item.name, {})
+        result['openedBy'] = [username for username in users]
     
 @expose(r'^/file/stats/(?P<path>.+)$', 'GET')
 def filestats(request, response):
@@ -529,6 +570,42 @@ def _perform_import(user, project_name, filename, fileobj):
     func(filename, fileobj)
     return
 
+# size of the pieces that an archive is read in when it is
+# imported from a url
+IMPORT_CHUNK_SIZE = 65536
+
+def _check_import_size(user, size):
+    """Rejects an archive of the given size (which may be None if
+    the size is not known) if it is too large to be imported."""
+    if not size:
+        return
+    size = int(size)
+    if size > c.max_import_file_size:
+        raise filesystem.FSException(
+            "Archive too large (max is %s bytes)" % c.max_import_file_size)
+    if not user.check_save(size):
+        raise OverQuota()
+
+def _download(user, datafile):
+    """Copies the archive from datafile into a temporary file a chunk
+    at a time, giving up as soon as it grows beyond what the user
+    can import. The temporary file is returned ready to be read."""
+    tempdatafile = tempfile.NamedTemporaryFile()
+    received = 0
+    try:
+        while True:
+            chunk = datafile.read(IMPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            _check_import_size(user, received)
+            tempdatafile.write(chunk)
+    except:
+        tempdatafile.close()
+        raise
+    tempdatafile.seek(0)
+    return tempdatafile
+
 def validate_url(url):
     if not url.startswith("http://") and not url.startswith("https://"):
         raise BadRequest("Invalid url: " + url)
@@ -546,24 +623,24 @@ def import_from_url(request, response):
         
     # check the content length to see if the user has enough quota
     # available before we download the whole file
-    content_length = resp[0].get("content-length")
-    if content_length:
-        content_length = int(content_length)
-        if not request.user.check_save(content_length):
-            raise OverQuota()
-    
+    _check_import_size(request.user, resp[0].get("content-length"))
+
     try:
         datafile = urllib2.urlopen(url)
     except urllib2.URLError, e:
         raise BadRequest(str(e))
-    tempdatafile = tempfile.NamedTemporaryFile()
-    tempdatafile.write(datafile.read())
-    datafile.close()
-    tempdatafile.seek(0)
+    try:
+        _check_import_size(request.user,
+                           datafile.info().getheader("content-length"))
+        tempdatafile = _download(request.user, datafile)
+    finally:
+        datafile.close()
     url_parts = urlparse(url)
     filename = os.path.basename(url_parts[2])
-    _perform_import(request.user, project_name, filename, tempdatafile)
-    tempdatafile.close()
+    try:
+        _perform_import(request.user, project_name, filename, tempdatafile)
+    finally:
+        tempdatafile.close()
     return response()
 
 @expose(r'^/project/export/(?P<project_name>.*(\.zip|\.tgz))')
@@ -576,20 +653,15 @@ def export_project(request, response):
     project = get_project(user, user, project_name)
     
     if extension == ".zip":
-        func = project.export_zipfile
+        func = project.stream_zipfile
         response.content_type = "application/zip"
     else:
         response.content_type = "application/x-tar-gz"
-        func = project.export_tarball
+        func = project.stream_tarball
     
-    output = func()
-    def filegen():
-        data = output.read(8192)
-        while data:
-            yield data
-            data = output.read(8192)
-        raise StopIteration
-    response.app_iter = filegen()
+    # the archive is built as the client reads it, so the
+    # first bytes go out without waiting for the whole project
+    response.app_iter = func()
     return response()
     
 @expose(r'^/preview/at/(?P<path>.+)$')
@@ -600,9 +672,8 @@ def preview_file(request, response):
     project = get_project(user, owner, project)
     
     file_obj = project.get_file_object(path)
-    response.body = str(file_obj.data)
     response.content_type = file_obj.mimetype
-    return response()
+    return _send_file(request, response, file_obj)
     
 @expose(r'^/project/rename/(?P<project_name>.+)/$', 'POST')
 def rename_project(request, response):
@@ -770,15 +841,13 @@ def viewme_set(request, response):
     return _respond_json(response, data)
 
 from bespin.mobwrite.mobwrite_daemon import DaemonMobWrite
-from bespin.mobwrite.mobwrite_daemon import Persister
 from bespin.mobwrite.mobwrite_daemon import maybe_cleanup
 
 class InProcessMobwriteWorker(DaemonMobWrite):
     "Talk to an in-process mobwrite"
 
     def __init__(self):
-        persister = Persister()
-        DaemonMobWrite.__init__(self, persister)
+        DaemonMobWrite.__init__(self, c.mobwrite_persister)
 
     def processRequest(self, question):
         "Since we are a MobWriteWorker we just call directly into mobwrite code"
@@ -787,39 +856,40 @@ class InProcessMobwriteWorker(DaemonMobWrite):
         return answer
 
 class MobwriteWorkerProxy():
-    "Talk to mobwrite using port 3017"
+    "Talk to the mobwrite daemon through the pool of connections to it"
 
     def processRequest(self, question):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(("localhost", 3017))
-        s.send(question)
-        answer = ''
-        while True:
-            line = s.recv(1024)
-            if not line:
-                break
-            answer += line
-        s.close()
-        return answer
+        return c.mobwrite_pool.request(question)
 
 @expose(r'^/mobwrite/$', 'POST')
 def mobwrite(request, response):
     """Handle a request for mobwrite synchronization.
 
     We talk to mobwrite either in-process for development or using a socket
-    which would be more common in live."""
+    which would be more common in live.
+
+    A w= request is a q= request that the daemon may hold for up to
+    c.mobwrite_long_poll seconds, until there is something to send back,
+    rather than answering it at once with no edits. The request keeps
+    this thread for as long as it is held, so long polling is off
+    unless c.mobwrite_long_poll is set. When it is, every answer carries
+    an X-Mobwrite-Long-Poll header, which tells the client to send w=
+    rather than q= when it has no edits of its own."""
     question = urllib.unquote(request.body)
     # Hmmm do we need to handle 'p' requests? q.py does.
     mode = None
     if question.find("p=") == 0:
         mode = "script"
-    elif question.find("q=") == 0:
+    elif question.find("q=") == 0 or question.find("w=") == 0:
         mode = "text"
     else:
-        raise BadRequest("Missing q= or p=")
+        raise BadRequest("Missing q=, w= or p=")
+    wait = question.find("w=") == 0 and c.mobwrite_long_poll
     question = question[2:]
 
     question = "H:" + str(request.user.username) + ":" + request.remote_addr + "\n" + question
+    if wait:
+        question = "W:%s\n%s" % (wait, question)
 
     if c.in_process_mobwrite:
         worker = InProcessMobwriteWorker()
@@ -828,6 +898,9 @@ def mobwrite(request, response):
 
     answer = worker.processRequest(question)
 
+    if c.mobwrite_long_poll:
+        response.headers['X-Mobwrite-Long-Poll'] = str(c.mobwrite_long_poll)
+
     if mode == "text":
         response.body = answer + "\n\n"
         response.content_type = "text/plain"
@@ -989,6 +1062,8 @@ def stats(request, response):
     more_keys = [k.replace("_DATE", "_" + today) for k in c.stats_display]
     keys.extend(more_keys)
     result = c.stats.multiget(keys)
+    # lock contention is counted per server process
+    result.update(c.locks.stats())
     response.content_type = "application/json"
     response.body = simplejson.dumps(result)
     return response()
@@ -1049,7 +1124,9 @@ def scriptwrapper_middleware(app):
             start_response(result.status, result.headers.items())
             return [newbody]
         start_response(result.status, result.headers.items())
-        return [result.body]
+        # pass the body through untouched so that streamed
+        # responses are not collected in memory here
+        return result.app_iter
     return new_app
 
 def make_app():
@@ -29,7 +29,6 @@ import simplejson
 from hashlib import sha256
 
 from path import path as path_obj
-from pathutils import LockError as PULockError, Lock, LockFile
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, PickleType, String, Integer,
@@ -56,6 +55,12 @@ def debug():
 def _get_session():
     return config.c.session_factory()
 
+def _access_changed():
+    """Called after sharing or group membership has been changed in
+    the current session, to clear the access cache now and again once
+    the change is committed."""
+    config.c.access_cache.invalidate(_get_session())
+
 Base = declarative_base()
 
 class Connection(Base):
@@ -221,12 +226,10 @@ class User(Base):
                         result.append(project)
         return result
 
-    @property
-    def statusfile(self):
-        return self.get_location() / ".bespin-status.json"
-
     def recompute_files(self):
-        """Recomputes how much space the user has used."""
+        """Recomputes how much space the user has used. The totals
+        come from each project's file manifest, which is brought up
+        to date by rescanning only the directories that changed."""
         total = 0
         # add up all of the directory contents
         # by only looking at directories, we skip
@@ -236,61 +239,15 @@ class User(Base):
             total += additional
         self.amount_used = total
 
-    #def mark_opened(self, file_obj, mode):
-    #    """Keeps track of this file as being currently open by the
-    #    user with the mode provided."""
-    #    statusfile = self.statusfile
-    #    try:
-    #        lock = Lock(statusfile)
-    #        lock.lock()
-    #        if statusfile.exists():
-    #            statusinfo = statusfile.bytes()
-    #            statusinfo = simplejson.loads(statusinfo)
-    #        else:
-    #            statusinfo = dict()
-    #
-    #        open_files = statusinfo.setdefault("open", {})
-    #        project_files = open_files.setdefault(file_obj.project.name, {})
-    #        project_files[file_obj.name] = {'mode' : mode}
-    #        statusfile.write_bytes(simplejson.dumps(statusinfo))
-    #        lock.unlock()
-    #    except PULockError, e:
-    #        raise LockError("Problem tracking open status for file %s: %s" %
-    #                    (file_obj.name, str(e)))
+    def mark_opened(self, file_obj, mode):
+        """Keeps track of this file as being currently open by the
+        user with the mode provided."""
+        file_obj.mark_opened(self, mode)
 
     def close(self, file_obj):
         """Keeps track of this file as being currently closed by the
         user."""
-        statusfile = self.statusfile
-        if not statusfile.exists():
-            return
-
-        try:
-            lock = Lock(statusfile)
-            lock.lock()
-            if statusfile.exists():
-                statusinfo = statusfile.bytes()
-                statusinfo = simplejson.loads(statusinfo)
-            else:
-                statusinfo = dict()
-
-            open_files = statusinfo.setdefault("open", {})
-            project_files = open_files.get(file_obj.project.name)
-            if project_files is not None:
-                try:
-                    del project_files[file_obj.name]
-                except KeyError:
-                    pass
-
-                if not project_files:
-                    del open_files[file_obj.project.name]
-
-                statusfile.write_bytes(simplejson.dumps(statusinfo))
-
-            lock.unlock()
-        except PULockError, e:
-            raise LockError("Problem tracking open status for file %s: %s" %
-                        (file_obj.name, str(e)))
+        file_obj.close(self)
 
     @property
     def files(self):
@@ -298,17 +255,7 @@ class User(Base):
 
             {'project' : {'path/to/file' : {'mode' : 'rw'}}}
         """
-        if not self.statusfile.exists():
-            return {}
-        try:
-            statusfile = LockFile(self.statusfile)
-            statusinfo = statusfile.read()
-            statusfile.close()
-        except PULockError, e:
-            raise LockError("Problem reading open file status: %s", str(e))
-
-        statusinfo = simplejson.loads(statusinfo)
-        return statusinfo.get("open", {})
+        return config.c.open_files.user_files(self.username)
 
     def get_settings(self):
         """Load a user's settings from BespinSettings/settings.
@@ -473,6 +420,18 @@ class User(Base):
         }
 
     def is_project_shared(self, project, user):
+        if isinstance(project, Project):
+            project = project.name
+        key = (self.uuid, project, user.uuid)
+        access_cache = config.c.access_cache
+        shared = access_cache.get(key)
+        if shared is None:
+            generation = access_cache.generation
+            shared = self._check_project_shared(project, user)
+            access_cache.set(key, shared, generation)
+        return shared
+
+    def _check_project_shared(self, project, user):
         if self._is_project_everyone_shared(project):
             return True
         if self._is_project_user_shared(project, user):
@@ -514,12 +473,14 @@ class User(Base):
 
     def add_sharing(self, project, member, edit=False, loadany=False):
         if member == 'everyone':
-            return self._add_everyone_sharing(project, edit, loadany)
+            sharing = self._add_everyone_sharing(project, edit, loadany)
         else:
             if isinstance(member, Group):
-                return self._add_group_sharing(project, member, edit, loadany)
+                sharing = self._add_group_sharing(project, member, edit, loadany)
             else:
-                return self._add_user_sharing(project, member, edit, loadany)
+                sharing = self._add_user_sharing(project, member, edit, loadany)
+        _access_changed()
+        return sharing
 
     def _add_user_sharing(self, project, invited_user, edit=False, loadany=False):
         sharing = UserSharing(self, project.name, invited_user, edit, loadany)
@@ -542,15 +503,16 @@ class User(Base):
             rows += self._remove_user_sharing(project)
             rows += self._remove_group_sharing(project)
             rows += self._remove_everyone_sharing(project)
-            return rows
         else:
             if member == 'everyone':
-                return self._remove_everyone_sharing(project)
+                rows = self._remove_everyone_sharing(project)
             else:
                 if isinstance(member, Group):
-                    return self._remove_group_sharing(project, member)
+                    rows = self._remove_group_sharing(project, member)
                 else:
-                    return self._remove_user_sharing(project, member)
+                    rows = self._remove_user_sharing(project, member)
+        _access_changed()
+        return rows
 
     def _remove_user_sharing(self, project, invited_user=None):
         user_query = _get_session().query(UserSharing).filter_by(owner_id=self.id)
@@ -613,9 +575,11 @@ class Group(Base):
 
     def remove(self):
         """Remove a group (and all its members) from the owning users profile"""
-        return _get_session().query(Group). \
+        rows = _get_session().query(Group). \
             filter_by(id=self.id). \
             delete()
+        _access_changed()
+        return rows
 
     def get_members(self):
         """Retrieve a list of the members of a given users group"""
@@ -629,20 +593,25 @@ class Group(Base):
             raise ConflictError("You can't be a member of your own group")
         membership = GroupMembership(self, other_user)
         _get_session().add(membership)
+        _access_changed()
         return membership
 
     def remove_member(self, other_user):
         """Remove a member from a given users group."""
-        return _get_session().query(GroupMembership) \
+        rows = _get_session().query(GroupMembership) \
             .filter_by(group_id=self.id) \
             .filter_by(user_id=other_user.id) \
             .delete()
+        _access_changed()
+        return rows
 
     def remove_all_members(self):
         """Remove all the members of a given group"""
-        return _get_session().query(GroupMembership) \
+        rows = _get_session().query(GroupMembership) \
             .filter_by(group_id=self.id) \
             .delete()
+        _access_changed()
+        return rows
 
 class GroupMembership(Base):
     __tablename__ = "group_memberships"
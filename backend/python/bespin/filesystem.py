@@ -32,10 +32,14 @@ from datetime import datetime
 import logging
 import re
 import itertools
+import posixpath
+import stat
 import sqlite3
+import sys
+import threading
+import Queue
 
 from path import path as path_obj
-from pathutils import LockError as PULockError, Lock, LockFile
 import simplejson
 
 from bespin import config, jsontemplate
@@ -46,6 +50,13 @@ log = logging.getLogger("bespin.model")
 # quotas are expressed in 1 megabyte increments
 QUOTA_UNITS = 1048576
 
+# size of the pieces that file contents are read in when
+# streaming a project export
+EXPORT_CHUNK_SIZE = 65536
+
+# number of threads writing files to disk during an archive import
+IMPORT_WRITERS = 4
+
 class FSException(Exception):
     pass
 
@@ -122,6 +133,101 @@ def _find_common_base(member_names):
             break
     return base
 
+class _ArchiveBuffer(object):
+    """Write-only file-like object that collects the output of
+    tarfile/zipfile so that it can be handed to the client in
+    chunks while the archive is still being built."""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+            self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Returns everything written since the last drain."""
+        data = "".join(self.chunks)
+        self.chunks = []
+        return data
+
+class _SaveBatch(object):
+    """Running totals for a Project.save_files call."""
+    def __init__(self):
+        self.saved = []
+        self.size_delta = 0
+        self.new_files = 0
+        # files handed to the writer pool that have not been
+        # recorded yet, with the space they will take
+        self.pending = {}
+        self.pending_size = 0
+
+class _WriterPool(object):
+    """A small pool of threads that write file contents to disk.
+    Files are handed over with put and come back from finished once
+    they are on disk. The first error raised by a writer is raised
+    again from put or wait, and nothing more is written after it."""
+    def __init__(self, size):
+        self.queue = Queue.Queue(size * 2)
+        self.done = []
+        self.error = None
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                file, contents, tag = item
+                if self.error is None:
+                    try:
+                        file.save(contents)
+                        self.done.append((file, tag))
+                    except Exception:
+                        self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def put(self, file, contents, tag):
+        self._check()
+        self.queue.put((file, contents, tag))
+
+    def wait(self):
+        """Waits until everything put so far has been written."""
+        self.queue.join()
+        self._check()
+
+    def finished(self):
+        """Returns the (file, tag) pairs written since the last call."""
+        done = self.done
+        count = len(done)
+        result = done[:count]
+        del done[:count]
+        return result
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
 class LenientUndefinedDict(dict):
     def get(self, key, default=''):
         return super(LenientUndefinedDict, self).get(key, default)
@@ -170,8 +276,15 @@ class Directory(object):
     def short_name(self):
         return self.name.parent.basename() + "/"
 
+def _stat_info(file_stat):
+    """Returns the File.info dictionary for the stat result given."""
+    return dict(size=file_stat.st_size,
+                mtime=file_stat.st_mtime,
+                created_time=datetime.fromtimestamp(file_stat.st_ctime),
+                modified_time=datetime.fromtimestamp(file_stat.st_mtime))
+
 class File(object):
-    def __init__(self, project, name):
+    def __init__(self, project, name, file_stat=None):
         if "../" in name:
             raise BadValue("Relative directories are not allowed")
 
@@ -182,7 +295,10 @@ class File(object):
         self.project = project
         self.name = name
         self.location = project.location / name
-        self._info = None
+        if file_stat is not None:
+            self._info = _stat_info(file_stat)
+        else:
+            self._info = None
 
     @property
     def short_name(self):
@@ -193,15 +309,9 @@ class File(object):
 
     @property
     def info(self):
-        if self._info is not None:
-            return self._info
-        info = {}
-        self._info = info
-        stat = self.location.stat()
-        info['size'] = stat.st_size
-        info['created_time'] = datetime.fromtimestamp(stat.st_ctime)
-        info['modified_time'] = datetime.fromtimestamp(stat.st_mtime)
-        return info
+        if self._info is None:
+            self._info = _stat_info(self.location.stat())
+        return self._info
 
     @property
     def data(self):
@@ -231,92 +341,115 @@ class File(object):
     def save(self, contents):
         self.location.write_bytes(contents)
 
-    @property
-    def statusfile(self):
+    def mark_opened(self, user_obj, mode):
+        """Keeps track of this file as being currently open by the
+        user with the mode provided."""
         project = self.project
-        return project.location / ".." / (".%s.json" % (project.name))
-
-    #def mark_opened(self, user_obj, mode):
-    #    """Keeps track of this file as being currently open by the
-    #    user with the mode provided."""
-    #    statusfile = self.statusfile
-    #    try:
-    #        lock = Lock(statusfile)
-    #        lock.lock()
-    #        if statusfile.exists():
-    #            statusinfo = statusfile.bytes()
-    #            statusinfo = simplejson.loads(statusinfo)
-    #        else:
-    #            statusinfo = dict()
-    #
-    #        open_files = statusinfo.setdefault("open", {})
-    #        file_users = open_files.setdefault(self.name, {})
-    #        file_users[user_obj.username] = mode
-    #
-    #        statusfile.write_bytes(simplejson.dumps(statusinfo))
-    #        lock.unlock()
-    #    except PULockError, e:
-    #        raise LockError("Problem tracking open status for file %s: %s" %
-    #                    (self.name, str(e)))
+        config.c.open_files.opened(project.full_name, project.name,
+                                   self.name, user_obj.username, mode)
 
     @property
     def users(self):
         """Returns a dictionary with the keys being the list of users
         with this file open and the values being the modes."""
-        statusfile = self.statusfile
-        if statusfile.exists():
-            try:
-                statusfile = LockFile(self.statusfile)
-                statusinfo = statusfile.read()
-                statusfile.close()
-            except PULockError, e:
-                raise LockError("Problem reading open file status: %s", str(e))
-
-            statusinfo = simplejson.loads(statusinfo)
-            open_files = statusinfo.get("open", {})
-            return open_files.get(self.name, {})
-        else:
-            return {}
+        return config.c.open_files.users(self.project.full_name, self.name)
 
     def close(self, user):
         """Close this file for the given user."""
-        statusfile = self.statusfile
-        if not statusfile.exists():
-            return
+        config.c.open_files.closed(self.project.full_name, self.name,
+                                   user.username)
+
+    def __repr__(self):
+        return "File: %s" % (self.name)
+
+_VCS_MARKERS = (".hg", ".svn", ".bzr", ".git")
+
+def _is_vcs_path(name):
+    for marker in _VCS_MARKERS:
+        if marker in name:
+            return True
+    return False
+
+def _scan_changes(location, known_dirs, known_files):
+    """Compares the tree at location with the manifest recorded by
+    the previous scan. known_dirs maps directory names ("" is the
+    top) to their mtime and known_files maps file names to
+    (size, mtime, inode).
+
+    Only directories with a different mtime are listed. Files that
+    sit in an unchanged directory are taken to be unchanged too, so
+    a scan of a quiet project costs one stat() per directory.
+
+    Returns (dirs, removed_dirs, files, removed_files), with dirs
+    and files holding the new or changed manifest entries."""
+    started = time.time()
+
+    subdirs = {}
+    for dirname in known_dirs:
+        if dirname:
+            subdirs.setdefault(posixpath.dirname(dirname), []).append(dirname)
+    files_by_dir = {}
+    for filename in known_files:
+        files_by_dir.setdefault(posixpath.dirname(filename), []).append(filename)
+
+    dirs = {}
+    files = {}
+    removed_files = []
+    seen = set()
+    pending = [""]
+    while pending:
+        dirname = pending.pop()
+        full_dir = os.path.join(location, dirname)
         try:
-            lock = Lock(statusfile)
-            lock.lock()
-            if statusfile.exists():
-                statusinfo = statusfile.bytes()
-                statusinfo = simplejson.loads(statusinfo)
-            else:
-                statusinfo = dict()
+            mtime = os.stat(full_dir).st_mtime
+        except OSError:
+            # went away while we were scanning
+            continue
+        seen.add(dirname)
+
+        if known_dirs.get(dirname) == mtime:
+            pending.extend(subdirs.get(dirname, []))
+            continue
+
+        # a change made in the same clock tick as this scan would not
+        # move the mtime, so directories that are that fresh are
+        # recorded in a way that makes the next scan list them again.
+        if mtime < started - 1:
+            dirs[dirname] = mtime
+        else:
+            dirs[dirname] = -1
 
-            open_files = statusinfo.setdefault("open", {})
-            file_users = open_files.setdefault(self.name, {})
+        present = set()
+        for name in os.listdir(full_dir):
+            if dirname:
+                relname = dirname + "/" + name
+            else:
+                relname = name
+            if _is_vcs_path(relname):
+                continue
             try:
-                del file_users[user.username]
-            except KeyError:
-                pass
+                st = os.stat(os.path.join(full_dir, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                pending.append(relname)
+                continue
+            present.add(relname)
+            entry = (st.st_size, st.st_mtime, st.st_ino)
+            if known_files.get(relname) != entry:
+                files[relname] = entry
 
-            statusfile.write_bytes(simplejson.dumps(statusinfo))
-            lock.unlock()
-        except PULockError, e:
-            raise LockError("Problem tracking open status for file %s: %s" %
-                        (self.name, str(e)))
+        for filename in files_by_dir.get(dirname, []):
+            if filename not in present:
+                removed_files.append(filename)
 
-    def __repr__(self):
-        return "File: %s" % (self.name)
+    removed_dirs = [dirname for dirname in known_dirs
+                    if dirname not in seen]
+    for dirname, filenames in files_by_dir.items():
+        if dirname not in seen:
+            removed_files.extend(filenames)
 
-def _get_file_list(directory):
-    total = 0
-    files = []
-    for f in directory.walkfiles():
-        if ".hg" in f or ".svn" in f or ".bzr" in f or ".git" in f:
-            continue
-        total += f.size
-        files.append(directory.relpathto(f))
-    return total, files
+    return dirs, removed_dirs, files, removed_files
 
 def _get_space_used(directory):
     total = 0
@@ -326,14 +459,6 @@ def _get_space_used(directory):
         total += f.size
     return total
 
-def _regexp(expr, item):
-    if expr is None:
-        return False
-    # only search on basenames
-    p = path_obj(item)
-    item = p.basename()
-    return re.search(expr, item, re.UNICODE|re.I) is not None
-    
 def rescan_project(qi):
     """Runs an asynchronous rescan of a project"""
     from bespin import database
@@ -342,7 +467,7 @@ def rescan_project(qi):
     s = database._get_session()
     user = database.User.find_user(message['user'])
     project = get_project(user, user, message['project'])
-    project.scan_files()
+    user.amount_used += project.update_manifest()
     retvalue = database.Message(user_id=user.id, message=simplejson.dumps(
             dict(asyncDone=True,
             jobid=qi.id, output="Rescan complete")))
@@ -373,6 +498,13 @@ class Project(object):
     def full_name(self):
         return self.owner.uuid + "/" + self.name
 
+    def open_files(self):
+        """Returns a dictionary with the keys being the names of the
+        open files in this project and the values being dictionaries
+        of the users with that file open and their modes. This is the
+        way to find the users of many files at a time."""
+        return config.c.open_files.project_files(self.full_name)
+
     def __repr__(self):
         return "Project(name=%s)" % (self.name)
 
@@ -382,6 +514,62 @@ class Project(object):
         the file must not be opened for editing. Otherwise, the
         last_edit parameter should include the last edit ID received by
         the user."""
+        return self.save_files([(destpath, contents)])[0]
+
+    def save_files(self, files, writers=1):
+        """Saves each (destpath, contents) pair from the iterable files
+        the way save_file does, but as one batch: the search cache and
+        manifest are updated in a single transaction and the owner's
+        space used and the file stats are updated once at the end.
+        Returns the list of File objects saved.
+
+        If writers is more than 1, the contents are written to disk by
+        a pool of that many threads while the next pair is pulled from
+        files, which lets an archive be decompressed and written at
+        the same time.
+
+        If saving one of the files fails, the files saved before it
+        are kept and accounted for."""
+        batch = _SaveBatch()
+        metadata = self.metadata
+        if writers > 1:
+            pool = _WriterPool(writers)
+        else:
+            pool = None
+        metadata.begin_batch()
+        try:
+            for destpath, contents in files:
+                file, is_new, size_delta = self._prepare_save(destpath,
+                                                    contents, batch)
+                if pool is None:
+                    file.save(contents)
+                    self._record_save(file, is_new, size_delta, batch)
+                    continue
+
+                if file.name in batch.pending:
+                    # the archive has this file more than once, the
+                    # earlier copy must land before this one is written
+                    pool.wait()
+                    self._record_writes(pool, batch)
+                    file, is_new, size_delta = self._prepare_save(destpath,
+                                                        contents, batch)
+                batch.pending[file.name] = size_delta
+                batch.pending_size += size_delta
+                pool.put(file, contents, (is_new, size_delta))
+                self._record_writes(pool, batch)
+            if pool is not None:
+                pool.wait()
+        finally:
+            if pool is not None:
+                pool.close()
+                self._record_writes(pool, batch)
+            metadata.end_batch()
+            self.owner.amount_used += batch.size_delta
+            if batch.new_files:
+                config.c.stats.incr("files", batch.new_files)
+        return batch.saved
+
+    def _prepare_save(self, destpath, contents, batch):
         if "../" in destpath:
             raise BadValue("Relative directories are not allowed")
 
@@ -389,8 +577,11 @@ class Project(object):
         while destpath and destpath.startswith("/"):
             destpath = destpath[1:]
 
+        # the space taken by earlier files in the batch has not been
+        # added to the owner yet
         saved_size = len(contents) if contents is not None else 0
-        if not self.owner.check_save(saved_size):
+        if not self.owner.check_save(batch.size_delta + batch.pending_size
+                                     + saved_size):
             raise OverQuota()
 
         file_loc = self.location / destpath
@@ -405,15 +596,33 @@ class Project(object):
             file_dir.makedirs()
 
         file = File(self, destpath)
-        if file.exists():
+        is_new = not file.exists()
+        if is_new:
+            size_delta = saved_size
+        else:
             size_delta = saved_size - file.saved_size
+        return file, is_new, size_delta
+
+    def _record_save(self, file, is_new, size_delta, batch):
+        # keep the manifest current so that the next rescan does not
+        # count this file again
+        file_stat = file.location.stat()
+        if is_new:
+            self.metadata.cache_add(file.name, file_stat)
+            batch.new_files += 1
         else:
-            size_delta = saved_size
-            self.metadata.cache_add(destpath)
-            config.c.stats.incr("files")
-        file.save(contents)
-        self.owner.amount_used += size_delta
-        return file
+            self.metadata.manifest_set(file.name, file_stat)
+        batch.size_delta += size_delta
+        batch.saved.append(file)
+
+    def _record_writes(self, pool, batch):
+        """Records the files that the writer pool has finished with.
+        The metadata connection and the owner can only be used from
+        this thread, so the pool just hands the files back."""
+        for file, (is_new, size_delta) in pool.finished():
+            del batch.pending[file.name]
+            batch.pending_size -= size_delta
+            self._record_save(file, is_new, size_delta, batch)
 
     def save_temp_file(self, destpath, contents=None):
         """Saves the contents to the file path provided, creating
@@ -543,24 +752,26 @@ class Project(object):
         variables['username'] = self.owner.username
 
         common_path_len = len(source_dir) + 1
-        for dirpath, dirnames, filenames in os.walk(source_dir):
-            destdir = dirpath[common_path_len:]
-            if '.svn' in destdir:
-                continue
-            for f in filenames:
-                if "{" in f:
-                    dest_f = jsontemplate.expand(f, variables)
-                else:
-                    dest_f = f
-
-                if destdir:
-                    destpath = "%s/%s" % (destdir, dest_f)
-                else:
-                    destpath = dest_f
-                contents = open(os.path.join(dirpath, f)).read()
-                variables['filename'] = dest_f
-                contents = jsontemplate.expand(contents, variables)
-                self.save_file(destpath, contents)
+        def template_files():
+            for dirpath, dirnames, filenames in os.walk(source_dir):
+                destdir = dirpath[common_path_len:]
+                if '.svn' in destdir:
+                    continue
+                for f in filenames:
+                    if "{" in f:
+                        dest_f = jsontemplate.expand(f, variables)
+                    else:
+                        dest_f = f
+
+                    if destdir:
+                        destpath = "%s/%s" % (destdir, dest_f)
+                    else:
+                        destpath = dest_f
+                    contents = open(os.path.join(dirpath, f)).read()
+                    variables['filename'] = dest_f
+                    contents = jsontemplate.expand(contents, variables)
+                    yield destpath, contents
+        self.save_files(template_files())
 
     def list_files(self, path=""):
         """Retrieve a list of files at the path. Directories will have
@@ -574,12 +785,20 @@ class Project(object):
 
         names = location.listdir()
 
+        # one stat per entry tells directories from files and fills
+        # in the File info that a listing is usually followed by
         result = []
         for name in names:
-            if name.isdir():
+            try:
+                file_stat = os.stat(name)
+            except OSError:
+                # removed since the listdir
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
                 result.append(Directory(self, self.location.relpathto(name)))
             else:
-                result.append(File(self, self.location.relpathto(name)))
+                result.append(File(self, self.location.relpathto(name),
+                                   file_stat))
 
         return sorted(result, key=lambda item: item.name)
 
@@ -624,6 +843,7 @@ class Project(object):
 
             if not path:
                 self.metadata.delete()
+                config.c.open_files.forget_project(self.full_name)
             else:
                 self.metadata.cache_delete(path, True)
 
@@ -653,52 +873,81 @@ class Project(object):
         project owned by user. If the project already exists,
         IT WILL BE WIPED OUT AND REPLACED."""
         pfile = tarfile.open(filename, fileobj=file_obj)
-        max_import_file_size = config.c.max_import_file_size
-        info = list(pfile)
+        info = [member for member in pfile
+                # directories are created automatically
+                # note that this does not currently support empty directories.
+                if member.isreg()]
 
         base = _find_common_base(member.name for member in info)
         base_len = len(base)
 
-        for member in info:
-            # save the files, directories are created automatically
-            # note that this does not currently support empty directories.
-            if member.isreg():
-                if member.size > max_import_file_size:
-                    raise FSException("File %s too large (max is %s bytes)"
-                        % (member.name, max_import_file_size))
-                self.save_file(member.name[base_len:],
+        total = self._check_import(filename,
+            [(member.name, member.size) for member in info])
+
+        def members():
+            for member in info:
+                yield (member.name[base_len:],
                     pfile.extractfile(member).read())
+        self._import_files(filename, members(), total)
 
     def import_zipfile(self, filename, file_obj):
         """Imports the zip file in the file_obj into the project
         project owned by user. If the project already exists,
         IT WILL BE WIPED OUT AND REPLACED."""
-        max_import_file_size = config.c.max_import_file_size
-
         pfile = zipfile.ZipFile(file_obj)
         info = pfile.infolist()
 
         base = _find_common_base(member.filename for member in info)
         base_len = len(base)
 
-        for member in pfile.infolist():
-            if member.filename.endswith("/"):
-                continue
-            if member.file_size > max_import_file_size:
+        info = [member for member in info
+                if not member.filename.endswith("/")]
+        total = self._check_import(filename,
+            [(member.filename, member.file_size) for member in info])
+
+        def members():
+            for member in info:
+                yield (member.filename[base_len:],
+                    pfile.read(member.filename))
+        self._import_files(filename, members(), total)
+
+    def _check_import(self, filename, sizes):
+        """Rejects an import before anything is written if one of the
+        (name, size) pairs in sizes is too large or if the whole
+        archive will not fit in the owner's quota. Returns the total
+        size of the files."""
+        max_import_file_size = config.c.max_import_file_size
+        total = 0
+        for name, size in sizes:
+            if size > max_import_file_size:
                 raise FSException("File %s too large (max is %s bytes)"
-                    % (member.filename, max_import_file_size))
-            self.save_file(member.filename[base_len:],
-                pfile.read(member.filename))
-
-    def export_tarball(self):
-        """Exports the project as a tarball, returning a
-        NamedTemporaryFile object. You can either use that
-        open file handle or use the .name property to get
-        at the file."""
-        temporaryfile = tempfile.NamedTemporaryFile()
+                    % (name, max_import_file_size))
+            total += size
+        if not self.owner.check_save(total):
+            raise OverQuota()
+        return total
+
+    def _import_files(self, filename, files, total):
+        """Saves the (destpath, contents) pairs from an archive,
+        decompressing on this thread while the writer pool saves the
+        files, and logs how fast it went."""
+        start = time.time()
+        saved = self.save_files(files, writers=IMPORT_WRITERS)
+        elapsed = time.time() - start
+        log.info("Imported %s (%s files, %s bytes) into %s in %.2fs "
+                 "(%.0f bytes/s)", filename, len(saved), total, self.name,
+                 elapsed, total / max(elapsed, 0.001))
+        config.c.stats.incr("import_bytes", total)
+        return saved
+
+    def stream_tarball(self):
+        """Exports the project as a gzipped tarball, yielding
+        the compressed data in chunks as the project tree is
+        walked. Nothing is written to disk along the way."""
+        output = _ArchiveBuffer()
+        tfile = tarfile.open(mode="w|gz", fileobj=output)
 
         mtime = time.time()
-        tfile = tarfile.open(temporaryfile.name, "w:gz")
 
         location = self.location
         project_name = self.name
@@ -728,22 +977,49 @@ class Project(object):
                 # we'll default to read for all, write only by user
                 tarinfo.mode = 420
                 tarinfo.size = file.size
-                fileobj = open(file)
-                tfile.addfile(tarinfo, fileobj)
-                fileobj.close()
 
-        tfile.close()
-        temporaryfile.seek(0)
-        return temporaryfile
-
-    def export_zipfile(self):
-        """Exports the project as a zip file, returning a
-        NamedTemporaryFile object. You can either use that
-        open file handle or use the .name property to get
-        at the file."""
-        temporaryfile = tempfile.NamedTemporaryFile()
+                # addfile without a file object only writes the header,
+                # which lets us feed the contents through in pieces
+                # rather than holding whole files in the buffer.
+                tfile.addfile(tarinfo)
+                fileobj = open(file, "rb")
+                try:
+                    remaining = tarinfo.size
+                    while remaining > 0:
+                        data = fileobj.read(min(remaining,
+                                                EXPORT_CHUNK_SIZE))
+                        if not data:
+                            raise FSException("File %s changed size "
+                                "during export" % tarinfo.name)
+                        tfile.fileobj.write(data)
+                        remaining -= len(data)
+                        chunk = output.drain()
+                        if chunk:
+                            yield chunk
+                finally:
+                    fileobj.close()
+                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                if remainder > 0:
+                    tfile.fileobj.write(tarfile.NUL *
+                                        (tarfile.BLOCKSIZE - remainder))
+                    blocks += 1
+                tfile.offset += blocks * tarfile.BLOCKSIZE
+
+            chunk = output.drain()
+            if chunk:
+                yield chunk
 
-        zfile = zipfile.ZipFile(temporaryfile, "w", zipfile.ZIP_DEFLATED)
+        tfile.close()
+        chunk = output.drain()
+        if chunk:
+            yield chunk
+
+    def stream_zipfile(self):
+        """Exports the project as a zip file, yielding the
+        compressed data file by file as the project tree is
+        walked. Nothing is written to disk along the way."""
+        output = _ArchiveBuffer()
+        zfile = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
         ztime = time.gmtime()[:6]
 
         project_name = self.name
@@ -758,11 +1034,35 @@ class Project(object):
             zipinfo.date_time = ztime
             zipinfo.compress_type = zipfile.ZIP_DEFLATED
             zfile.writestr(zipinfo, file.bytes())
+            yield output.drain()
 
         zfile.close()
+        yield output.drain()
+
+    def _export_to_tempfile(self, chunks):
+        temporaryfile = tempfile.NamedTemporaryFile()
+        for chunk in chunks:
+            temporaryfile.write(chunk)
+        temporaryfile.flush()
         temporaryfile.seek(0)
         return temporaryfile
 
+    def export_tarball(self):
+        """Exports the project as a tarball, returning a
+        NamedTemporaryFile object. You can either use that
+        open file handle or use the .name property to get
+        at the file. Use stream_tarball to avoid the temporary
+        file."""
+        return self._export_to_tempfile(self.stream_tarball())
+
+    def export_zipfile(self):
+        """Exports the project as a zip file, returning a
+        NamedTemporaryFile object. You can either use that
+        open file handle or use the .name property to get
+        at the file. Use stream_zipfile to avoid the temporary
+        file."""
+        return self._export_to_tempfile(self.stream_zipfile())
+
     def rename(self, new_name):
         """Renames this project to new_name, assuming there is
         not already another project with that name."""
@@ -775,29 +1075,66 @@ class Project(object):
                 " a project with the new name already exists."
                 % (self.name, new_name))
         old_location.rename(new_location)
+        old_full_name = self.full_name
         self.name = new_name
         self.location = new_location
+        config.c.open_files.rename_project(old_full_name, self.full_name,
+                                           new_name)
 
     def scan_files(self):
         """Looks through the files, computes how much space they
-        take and updates the cached file list."""
-        space_used, files = _get_file_list(self.location)
-        self.metadata.cache_replace(files)
-        return space_used
+        take and updates the cached file list. Only directories that
+        changed since the last scan are looked at (see update_manifest).
+        Returns the space used by the project."""
+        self.update_manifest()
+        return self.metadata.manifest_size()
+
+    def update_manifest(self):
+        """Brings the file manifest and the search cache up to date
+        with what is on disk and returns the change in space used
+        since the previous scan.
+
+        Before the first scan, the manifest only has the files saved
+        through Bespin, which are already counted in amount_used. The
+        first scan lists every directory and returns the size of
+        everything else (a clone, an import or files that were there
+        before the manifest) less the size of recorded files that are
+        gone."""
+        metadata = self.metadata
+        known_dirs, known_files = metadata.manifest_get()
+        first_scan = "" not in known_dirs
+        if first_scan:
+            known_dirs = {}
+
+        dirs, removed_dirs, files, removed_files = _scan_changes(
+                            self.location, known_dirs, known_files)
+
+        size_delta = 0
+        for filename, entry in files.items():
+            old_entry = known_files.get(filename)
+            size_delta += entry[0]
+            if old_entry is not None:
+                size_delta -= old_entry[0]
+        for filename in removed_files:
+            size_delta -= known_files[filename][0]
+
+        metadata.manifest_apply(dirs, removed_dirs, files, removed_files,
+                                prune=first_scan)
+        return size_delta
 
     def search_files(self, query, limit=20, include=""):
         """Scans the files for filenames that match the queries."""
 
         # make the query lower case so that the match boosting
         # in _SearchMatch can use it
-        query = query.lower()
-        if isinstance(query, unicode):
-            query = query.encode('utf-8')
-        escaped_query = [re.escape(char) for char in query]
-        search_re = ".*".join(escaped_query)
-        files = self.metadata.search_files(search_re)
+        query = _decode_name(query).lower()
+        if include != "":
+            # the include filter may drop any of the files found
+            files = self.metadata.search_files(query)
+        else:
+            files = self.metadata.search_files(query, limit)
         match_list = [_SearchMatch(query, f) for f in files]
-        all_results = [str(match) for match in sorted(match_list)]
+        all_results = [match.match for match in sorted(match_list)]
         
         # check now if the files are within the include folder
         # if the include folder is empty just take them all
@@ -823,12 +1160,17 @@ class ProjectView(Project):
         FileNotFound if the file does not exist. The file is
         marked as open after this call."""
 
+        file_obj = self.open_file(path, mode)
+        contents = str(file_obj.data)
+        return contents
+
+    def open_file(self, path, mode="rw"):
+        """Like get_file, but returns the File object rather than
+        reading its contents."""
         file_obj = self._check_and_get_file(path)
         #self.user.mark_opened(file_obj, mode)
         #file_obj.mark_opened(self.user, mode)
-
-        contents = str(file_obj.data)
-        return contents
+        return file_obj
 
     def get_temp_file(self, path, mode="rw"):
         """Like get_file() except that it uses a parallel file as its source,
@@ -859,7 +1201,12 @@ class ProjectView(Project):
 
         file_dir = file_loc.dirname()
         if not file_dir.exists():
-            file_dir.makedirs()
+            try:
+                file_dir.makedirs()
+            except OSError:
+                # another collaborator may have got there first
+                if not file_dir.isdir():
+                    raise
 
         file_loc.write_bytes("")
         return ""
@@ -892,6 +1239,26 @@ class ProjectView(Project):
 def get_temp_file_name(project, path):
     return "." + project + "-mobwrite/" + path
 
+def _encode_name(name):
+    if isinstance(name, unicode):
+        return name.encode("utf-8")
+    return name
+
+def _decode_name(name):
+    if isinstance(name, str):
+        return name.decode("utf-8", "replace")
+    return name
+
+def _search_grams(filename):
+    """The grams indexed for filename: the lowercased trigrams of its
+    basename, which find the files whose names contain the query, and
+    its single characters, which find the files that have the query's
+    characters in order but not next to each other."""
+    name = _decode_name(filename).rsplit("/", 1)[-1].lower()
+    grams = set(name)
+    grams.update(name[i:i + 3] for i in xrange(len(name) - 2))
+    return grams
+
 class ProjectMetadata(dict):
     """Provides access to Bespin-specific project information.
     This metadata is stored in an sqlite database in the user's
@@ -903,7 +1270,7 @@ class ProjectMetadata(dict):
         self.filename = self.project_location / ".." / \
                         (".%s_metadata" % self.project_name)
         self._connection = None
-        self._regexp_initialized = False
+        self._batch_depth = 0
 
     @property
     def connection(self):
@@ -917,8 +1284,8 @@ class ProjectMetadata(dict):
         conn = sqlite3.connect(self.filename)
         self._connection = conn
 
+        c = conn.cursor()
         if is_new:
-            c = conn.cursor()
             c.execute('''create table keyvalue (
     key text primary key,
     value text
@@ -926,10 +1293,57 @@ class ProjectMetadata(dict):
             c.execute('''create table search_cache (
     filename
 )''')
-            conn.commit()
-            c.close()
+        # the manifest was added after the other tables, so it
+        # also needs to be created in older metadata files
+        c.execute('''create table if not exists manifest (
+    filename text primary key,
+    size integer,
+    mtime real,
+    inode integer
+)''')
+        c.execute('''create table if not exists manifest_dirs (
+    dirname text primary key,
+    mtime real
+)''')
+        c.execute('''create index if not exists search_cache_filename
+    on search_cache (filename)''')
+        c.execute("""select count(*) from sqlite_master
+            where type='table' and name='search_ngrams'""")
+        if not c.fetchone()[0]:
+            # search_grams only held single characters
+            c.execute("drop table if exists search_grams")
+            c.execute('''create table search_ngrams (
+    gram text,
+    file_id integer
+)''')
+            c.execute('''create index search_ngrams_gram
+    on search_ngrams (gram)''')
+            c.execute('''create index search_ngrams_file
+    on search_ngrams (file_id)''')
+            # index whatever an older metadata file already has cached
+            rows = c.execute("select rowid, filename from search_cache").fetchall()
+            for file_id, filename in rows:
+                self._add_grams(c, file_id, filename)
+        conn.commit()
+        c.close()
         return conn
 
+    def begin_batch(self):
+        """Holds back commits until the matching end_batch, so that
+        a group of changes is written in a single transaction."""
+        self._batch_depth += 1
+
+    def end_batch(self):
+        """Ends a batch started with begin_batch, committing the
+        changes made during it once the outermost batch ends."""
+        self._batch_depth -= 1
+        if self._connection:
+            self._commit()
+
+    def _commit(self):
+        if not self._batch_depth:
+            self.connection.commit()
+
     def delete(self):
         """Remove this metadata file."""
         if self.filename.exists():
@@ -950,12 +1364,16 @@ class ProjectMetadata(dict):
     #
     ######
 
-    def cache_add(self, filename):
-        """Add the file to the search cache."""
+    def cache_add(self, filename, file_stat=None):
+        """Add the file to the search cache. If the file's stat
+        result is provided, the file is recorded in the manifest
+        as well."""
         conn = self.connection
         c = conn.cursor()
-        c.execute("""insert into search_cache values (?)""", (filename,))
-        conn.commit()
+        self._cache_insert(c, filename)
+        if file_stat is not None:
+            self._manifest_set(c, filename, file_stat)
+        self._commit()
         c.close()
 
     def cache_delete(self, filename, recursive=False):
@@ -965,15 +1383,24 @@ class ProjectMetadata(dict):
         c = conn.cursor()
 
         if recursive:
-            op = " LIKE "
+            # the name itself and everything from "name/" up to, but
+            # not including, "name0" ("0" follows "/"), which compares
+            # case-sensitively and leaves "name2.txt" and "Name/" alone
             if filename.endswith("/"):
                 filename = filename[:-1]
-            filename += "%"
+            where = "%(name)s=? or (%(name)s>=? and %(name)s<?)"
+            params = (filename, filename + "/", filename + "0")
         else:
-            op = "="
+            where = "%(name)s=?"
+            params = (filename,)
 
-        c.execute("""delete from search_cache where filename%s?""" % op, (filename,))
-        conn.commit()
+        self._cache_remove(c, where % dict(name="filename"), params)
+        c.execute("delete from manifest where "
+                  + where % dict(name="filename"), params)
+        if recursive:
+            c.execute("delete from manifest_dirs where "
+                      + where % dict(name="dirname"), params)
+        self._commit()
         c.close()
 
     def cache_replace(self, files):
@@ -981,24 +1408,146 @@ class ProjectMetadata(dict):
         conn = self.connection
         c = conn.cursor()
         c.execute("delete from search_cache")
+        c.execute("delete from search_ngrams")
         for filename in files:
-            c.execute("""insert into search_cache values (?)""", (filename,))
-        conn.commit()
+            self._cache_insert(c, filename)
+        self._commit()
         c.close()
 
-    def search_files(self, search_expr):
-        """Search the file list with the given regular expression."""
+    def _cache_insert(self, c, filename):
+        c.execute("""insert into search_cache values (?)""", (filename,))
+        self._add_grams(c, c.lastrowid, filename)
+
+    def _add_grams(self, c, file_id, filename):
+        c.executemany("""insert into search_ngrams values (?, ?)""",
+            [(gram, file_id) for gram in _search_grams(filename)])
+
+    def _cache_remove(self, c, where, params):
+        c.execute("""delete from search_ngrams where file_id in
+            (select rowid from search_cache where %s)""" % where, params)
+        c.execute("""delete from search_cache where %s""" % where, params)
+
+    ######
+    #
+    # Methods for handling the file manifest
+    #
+    ######
+
+    def _manifest_set(self, c, filename, file_stat):
+        c.execute("""insert or replace into manifest values (?, ?, ?, ?)""",
+            (filename, file_stat.st_size, file_stat.st_mtime,
+             file_stat.st_ino))
+
+    def manifest_set(self, filename, file_stat):
+        """Record the stat result for the file in the manifest."""
         conn = self.connection
-        # the sqlite REGEXP support needs a supplied regexp function
-        if not self._regexp_initialized:
-            conn.create_function("regexp", 2, _regexp)
         c = conn.cursor()
-        rs = c.execute(
-            "SELECT filename FROM search_cache WHERE filename REGEXP ?",
-            (search_expr,))
-        result = [item[0] for item in rs]
+        self._manifest_set(c, filename, file_stat)
+        self._commit()
         c.close()
-        return result
+
+    def manifest_get(self):
+        """Returns the manifest as a tuple of two dictionaries. The
+        first maps directory names to mtimes, the second maps file
+        names to (size, mtime, inode). Names are utf-8 encoded str,
+        the way they come back from os.listdir."""
+        conn = self.connection
+        c = conn.cursor()
+        dirs = dict((_encode_name(row[0]), row[1]) for row in
+                    c.execute("SELECT dirname, mtime FROM manifest_dirs"))
+        files = dict((_encode_name(row[0]), tuple(row[1:])) for row in
+                    c.execute("SELECT filename, size, mtime, inode FROM manifest"))
+        c.close()
+        return dirs, files
+
+    def manifest_size(self):
+        """Returns the total size of the files in the manifest."""
+        conn = self.connection
+        c = conn.cursor()
+        c.execute("SELECT sum(size) FROM manifest")
+        total = c.fetchone()[0]
+        c.close()
+        return total or 0
+
+    def manifest_apply(self, dirs, removed_dirs, files, removed_files,
+                       prune=False):
+        """Applies the changes found by a scan to the manifest and
+        the search cache in a single transaction. If prune is True,
+        files in the search cache that are not in the manifest, left
+        there from before the manifest existed, are removed too."""
+        conn = self.connection
+        c = conn.cursor()
+        for dirname in removed_dirs:
+            c.execute("delete from manifest_dirs where dirname=?",
+                      (_decode_name(dirname),))
+        for filename in removed_files:
+            filename = _decode_name(filename)
+            c.execute("delete from manifest where filename=?", (filename,))
+            self._cache_remove(c, "filename=?", (filename,))
+        for dirname, mtime in dirs.items():
+            c.execute("insert or replace into manifest_dirs values (?, ?)",
+                      (_decode_name(dirname), mtime))
+        for filename, (size, mtime, inode) in files.items():
+            filename = _decode_name(filename)
+            c.execute("insert or replace into manifest values (?, ?, ?, ?)",
+                      (filename, size, mtime, inode))
+            c.execute("select 1 from search_cache where filename=?",
+                      (filename,))
+            if c.fetchone() is None:
+                self._cache_insert(c, filename)
+        if prune:
+            self._cache_remove(c, "filename not in "
+                               "(select filename from manifest)", ())
+        self._commit()
+        c.close()
+
+    def search_files(self, query, limit=None):
+        """Returns the files whose basenames contain the characters
+        of query in order, ignoring case.
+
+        Queries of three or more characters first look up the files
+        whose basenames contain the query itself, through its
+        trigrams. If there are at least limit of those, they are
+        returned on their own: the file finder ranks them first
+        anyway. Otherwise, and for shorter queries, the files that
+        contain every character of the query are looked up as well
+        and checked for the characters being in order."""
+        query = _decode_name(query).lower()
+        conn = self.connection
+        c = conn.cursor()
+        files = []
+        if len(query) >= 3:
+            trigrams = set(query[i:i + 3] for i in xrange(len(query) - 2))
+            files = [filename for filename in
+                     self._search_candidates(c, trigrams)
+                     if query in filename.rsplit("/", 1)[-1].lower()]
+            if limit is not None and len(files) >= limit:
+                c.close()
+                return files
+
+        candidates = self._search_candidates(c, set(query))
+        c.close()
+        if len(query) < 2:
+            # a single character can't be out of order
+            return candidates
+        found = set(files)
+        search_re = re.compile(".*".join(re.escape(char) for char in query),
+                               re.UNICODE|re.I)
+        return files + [filename for filename in candidates
+                        if filename not in found
+                        and search_re.search(filename.rsplit("/", 1)[-1])]
+
+    def _search_candidates(self, c, grams):
+        """Returns the files indexed under all of grams, or every file
+        if there are no grams."""
+        if not grams:
+            rs = c.execute("SELECT filename FROM search_cache")
+        else:
+            candidates = " INTERSECT ".join(
+                ["SELECT file_id FROM search_ngrams WHERE gram=?"] * len(grams))
+            rs = c.execute("SELECT filename FROM search_cache "
+                "WHERE rowid IN (%s)" % candidates, list(grams))
+        return [item[0] for item in rs]
 
     def get_file_list(self):
         """Return a list of all files."""
@@ -1041,14 +1590,14 @@ class ProjectMetadata(dict):
         c.execute("delete from keyvalue where key=?", (key,))
         c.execute("""insert into keyvalue (key, value) values (?, ?) """,
                     (key, value))
-        conn.commit()
+        self._commit()
         c.close()
 
     def __delitem__(self, key):
         conn = self.connection
         c = conn.cursor()
         c.execute("delete from keyvalue where key=?", (key,))
-        conn.commit()
+        self._commit()
         c.close()
 
     def close(self):
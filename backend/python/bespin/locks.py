@@ -0,0 +1,227 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Named reader/writer locks.
+
+A lock manager hands out locks by name (the open files registry
+uses the path of its database as the name). shared() returns a lock that any number of readers
+can hold at once, exclusive() one that shuts everyone else out.
+Either blocks until the lock is available and the returned object's
+release() method gives it back.
+
+ThreadLocks only keeps out other threads of this process.
+FlockLocks also takes an fcntl.flock() on a ".lock" file next to the
+name, so that separate server processes keep out of each other too.
+"""
+
+import os
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class LockError(IOError):
+    pass
+
+class _RWLock(object):
+    """One named lock. Waiting writers hold off new readers, so that
+    a steady stream of readers cannot starve a writer."""
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        # number of HeldLocks and waiters using this, guarded by
+        # the manager's lock
+        self.users = 0
+
+    def acquire(self, exclusive):
+        """Returns True if the lock could not be had right away."""
+        condition = self.condition
+        condition.acquire()
+        try:
+            waited = False
+            if exclusive:
+                self.waiting_writers += 1
+                while self.writer or self.readers:
+                    waited = True
+                    condition.wait()
+                self.waiting_writers -= 1
+                self.writer = True
+            else:
+                while self.writer or self.waiting_writers:
+                    waited = True
+                    condition.wait()
+                self.readers += 1
+            return waited
+        finally:
+            condition.release()
+
+    def release(self, exclusive):
+        condition = self.condition
+        condition.acquire()
+        try:
+            if exclusive:
+                self.writer = False
+            else:
+                self.readers -= 1
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+class HeldLock(object):
+    """A lock that has been acquired from a lock manager."""
+    def __init__(self, manager, name, exclusive, handle=None):
+        self.manager = manager
+        self.name = name
+        self.exclusive = exclusive
+        self.handle = handle
+        self.locked = True
+
+    def release(self):
+        if not self.locked:
+            raise LockError("%s is not locked" % self.name)
+        self.locked = False
+        self.manager._release(self)
+
+class ThreadLocks(object):
+    """Reader/writer locks shared by the threads of one process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self.acquired = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def shared(self, name):
+        """Acquires the named lock for reading."""
+        return self._acquire(name, False)
+
+    def exclusive(self, name):
+        """Acquires the named lock for writing."""
+        return self._acquire(name, True)
+
+    def stats(self):
+        """Returns how many locks have been acquired, how many of
+        those had to wait for another holder and the total time
+        spent waiting, in milliseconds."""
+        self._lock.acquire()
+        try:
+            return dict(locks_acquired=self.acquired,
+                        locks_contended=self.contended,
+                        locks_wait_ms=int(self.wait_time * 1000))
+        finally:
+            self._lock.release()
+
+    def _acquire(self, name, exclusive):
+        self._lock.acquire()
+        try:
+            rwlock = self._locks.get(name)
+            if rwlock is None:
+                rwlock = self._locks[name] = _RWLock()
+            rwlock.users += 1
+        finally:
+            self._lock.release()
+
+        start = time.time()
+        waited = rwlock.acquire(exclusive)
+        try:
+            held = HeldLock(self, name, exclusive)
+            waited = self._acquire_more(held) or waited
+        except:
+            self._release_rwlock(name, rwlock, exclusive)
+            raise
+        self._record(waited, start)
+        return held
+
+    def _acquire_more(self, held):
+        """Hook for subclasses that need more than the thread lock.
+        Returns True if it had to wait."""
+        return False
+
+    def _record(self, waited, start):
+        self._lock.acquire()
+        try:
+            self.acquired += 1
+            if waited:
+                self.contended += 1
+                self.wait_time += time.time() - start
+        finally:
+            self._lock.release()
+
+    def _release(self, held):
+        self._release_rwlock(held.name, self._locks[held.name],
+                             held.exclusive)
+
+    def _release_rwlock(self, name, rwlock, exclusive):
+        rwlock.release(exclusive)
+        self._lock.acquire()
+        try:
+            rwlock.users -= 1
+            if not rwlock.users:
+                del self._locks[name]
+        finally:
+            self._lock.release()
+
+class FlockLocks(ThreadLocks):
+    """Reader/writer locks that are also honored by other processes,
+    using fcntl.flock() on name + ".lock". The lock files are left in
+    place, removing them would let two processes lock different
+    files of the same name."""
+    def __init__(self):
+        if fcntl is None:
+            raise LockError("fcntl is not available on this platform")
+        ThreadLocks.__init__(self)
+
+    def _acquire_more(self, held):
+        try:
+            fd = os.open(held.name + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+        except OSError, e:
+            raise LockError("Unable to open lock file for %s: %s"
+                            % (held.name, e))
+        if held.exclusive:
+            operation = fcntl.LOCK_EX
+        else:
+            operation = fcntl.LOCK_SH
+        waited = False
+        try:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except IOError:
+                waited = True
+                fcntl.flock(fd, operation)
+        except IOError, e:
+            os.close(fd)
+            raise LockError("Unable to lock %s: %s" % (held.name, e))
+        held.handle = fd
+        return waited
+
+    def _release(self, held):
+        try:
+            fcntl.flock(held.handle, fcntl.LOCK_UN)
+        finally:
+            os.close(held.handle)
+            ThreadLocks._release(self, held)
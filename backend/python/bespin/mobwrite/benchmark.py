@@ -0,0 +1,352 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Benchmarks for the collaboration server.
+
+diff_benchmark() times the diff engine on edits to a generated source
+file, comparing diff_bisect with the diff_map engine it replaced. The
+same diff_main is used for both, only the engine underneath differs,
+and both get the timeout that mobwrite_core sets. "edits" is the
+Levenshtein distance of the resulting diff: when an engine runs out of
+time it falls back to deleting and inserting the whole remaining text,
+which shows up as far more edits than needed.
+
+diff_bisect on its own does not make large documents fit the timeout.
+On a 2000 line file it still runs out of time on rewrite_function,
+reindent and large_rewrite, and gives the same degraded diffs as
+diff_map, with or without line mode. The "core" rows go through
+mobwrite_core.diff, which is what the daemon calls: it diffs the
+changed lines first and refines them character by character while time
+allows. That gets a minimal diff of the reindent well within the
+timeout. Rewrites of this size still use up the whole timeout on every
+path and send the rewritten block whole. Without a time limit, the
+minimal diffs of the default rewrite_function and large_rewrite take
+about 0.8s and two minutes, and are about a quarter smaller.
+
+memory_benchmark() measures the bytes that each text and view takes
+beyond the text itself, with the __slots__ classes of mobwrite_core and
+mobwrite_daemon against copies of the classes they replaced, which kept
+their properties in a __dict__ and their times as datetimes.
+"""
+
+import datetime
+import random
+import sys
+import thread
+import time
+
+from bespin.mobwrite import diff_match_patch as dmp_module
+from bespin.mobwrite import mobwrite_core
+from bespin.mobwrite import mobwrite_daemon
+
+_WORDS = ["self", "data", "result", "name", "value", "index", "count",
+          "items", "request", "response", "user", "project", "path",
+          "text", "options", "config", "error", "line", "offset", "key"]
+
+class _MapDiff(dmp_module.diff_match_patch):
+    """diff_match_patch using the old diff_map engine."""
+    def diff_bisect(self, text1, text2, deadline):
+        diffs = self.diff_map(text1, text2)
+        if not diffs:
+            diffs = [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+        return diffs
+
+def _statement(rnd):
+    words = [rnd.choice(_WORDS) for i in range(rnd.randint(2, 5))]
+    kind = rnd.randint(0, 3)
+    if kind == 0:
+        return "%s = %s(%s)" % (words[0], words[1], ", ".join(words[2:]))
+    elif kind == 1:
+        return "%s.%s(%s)" % (words[0], words[1], ", ".join(words[2:]))
+    elif kind == 2:
+        return "if %s is not None:" % ".".join(words[:2])
+    return "return %s" % " + ".join(words[1:])
+
+def source_file(lines, rnd):
+    """Returns a list of lines that look like Python source."""
+    result = []
+    while len(result) < lines:
+        result.append("def %s_%s(%s):\n" % (rnd.choice(_WORDS),
+                      rnd.choice(_WORDS), rnd.choice(_WORDS)))
+        for i in range(rnd.randint(4, 20)):
+            result.append("    %s\n" % _statement(rnd))
+        result.append("\n")
+    return result[:lines]
+
+def _scattered(lines, rnd):
+    lines = list(lines)
+    for i in range(20):
+        n = rnd.randrange(len(lines))
+        lines[n] = lines[n].replace(rnd.choice(_WORDS), rnd.choice(_WORDS))
+    return lines
+
+def _rewrite_function(lines, rnd):
+    size = max(len(lines) * 3 // 100, 1)
+    start = rnd.randrange(len(lines) - size)
+    return lines[:start] + source_file(size, rnd) + lines[start + size:]
+
+def _reindent(lines, rnd):
+    size = len(lines) // 10
+    start = rnd.randrange(len(lines) - size)
+    return (lines[:start] + ["    " + line for line in lines[start:start + size]]
+            + lines[start + size:])
+
+def _move_block(lines, rnd):
+    size = len(lines) // 20
+    start = rnd.randrange(len(lines) // 2)
+    block = lines[start:start + size]
+    rest = lines[:start] + lines[start + size:]
+    to = rnd.randrange(len(rest) // 2, len(rest))
+    return rest[:to] + block + rest[to:]
+
+def _large_rewrite(lines, rnd):
+    size = len(lines) * 2 // 5
+    start = rnd.randrange(len(lines) - size)
+    return lines[:start] + source_file(size, rnd) + lines[start + size:]
+
+EDITS = [("scattered", _scattered),
+         ("rewrite_function", _rewrite_function),
+         ("reindent", _reindent),
+         ("move_block", _move_block),
+         ("large_rewrite", _large_rewrite)]
+
+def _run(dmp, text1, text2, checklines):
+    start = time.time()
+    diffs = dmp.diff_main(text1, text2, checklines)
+    elapsed = time.time() - start
+    assert dmp.diff_text1(diffs) == text1 and dmp.diff_text2(diffs) == text2
+    return elapsed, dmp.diff_levenshtein(diffs)
+
+def _run_core(dmp, text1, text2):
+    # mobwrite_core.diff uses mobwrite_core.DMP, so swap the engine in
+    old_dmp = mobwrite_core.DMP
+    mobwrite_core.DMP = dmp
+    try:
+        start = time.time()
+        diffs = mobwrite_core.diff(text1, text2)
+        elapsed = time.time() - start
+    finally:
+        mobwrite_core.DMP = old_dmp
+    assert dmp.diff_text1(diffs) == text1 and dmp.diff_text2(diffs) == text2
+    return elapsed, dmp.diff_levenshtein(diffs)
+
+def diff_benchmark(lines=2000, timeout=None, seed=0):
+    """Diffs each kind of edit to a file of the given number of lines
+    (40 or more) with both engines: character by character, line mode
+    first and through mobwrite_core.diff. Returns a list of
+    dictionaries, one per edit and mode. The timeout defaults to the
+    one mobwrite uses."""
+    if timeout is None:
+        timeout = mobwrite_core.DMP.Diff_Timeout
+    rnd = random.Random(seed)
+    engines = [("map", _MapDiff()), ("bisect", dmp_module.diff_match_patch())]
+    for name, dmp in engines:
+        dmp.Diff_Timeout = timeout
+    original = source_file(lines, rnd)
+    text1 = u"".join(original)
+    results = []
+    for edit, function in EDITS:
+        text2 = u"".join(function(original, rnd))
+        for mode in ("chars", "lines", "core"):
+            result = dict(edit=edit, chars=len(text2), mode=mode)
+            for name, dmp in engines:
+                if mode == "core":
+                    elapsed, edits = _run_core(dmp, text1, text2)
+                else:
+                    elapsed, edits = _run(dmp, text1, text2, mode == "lines")
+                result[name + "_ms"] = elapsed * 1000
+                result[name + "_edits"] = edits
+            results.append(result)
+    return results
+
+def print_diff_benchmark(lines=2000, timeout=None, seed=0):
+    results = diff_benchmark(lines, timeout, seed)
+    print "%-18s %-6s %8s %10s %10s %10s %10s" % ("edit", "mode", "chars",
+        "map ms", "map edits", "bisect ms", "bisect edits")
+    for r in results:
+        print "%-18s %-6s %8d %10.1f %10d %10.1f %10d" % (r["edit"],
+            r["mode"], r["chars"], r["map_ms"], r["map_edits"],
+            r["bisect_ms"], r["bisect_edits"])
+
+
+
+class _DictWatchers:
+    def __init__(self):
+        self.callbacks = []
+
+class _DictTextObj:
+    """mobwrite_core.TextObj before __slots__."""
+    def __init__(self, name):
+        self.name = name
+        self.text = None
+        self.changed = False
+
+class _DictViewObj:
+    """mobwrite_core.ViewObj before __slots__."""
+    def __init__(self, username, filename):
+        self.username = username
+        self.filename = filename
+        self.shadow_client_version = 0
+        self.shadow_server_version = 0
+        self.backup_shadow_server_version = 0
+        self.shadow = u""
+        self.backup_shadow = u""
+
+class _DictDaemonTextObj(_DictTextObj):
+    """mobwrite_daemon.TextObj before __slots__."""
+    def __init__(self, name, persister):
+        _DictTextObj.__init__(self, name)
+        self.persister = persister
+        self.revision = 0
+        self.watchers = _DictWatchers()
+        self.memory = 0
+        self.peak_memory = 0
+        self.views = []
+        self.lasttime = datetime.datetime.now()
+        self.lock = thread.allocate_lock()
+        self.text = u""
+
+class _DictDaemonViewObj(_DictViewObj):
+    """mobwrite_daemon.ViewObj before __slots__."""
+    def __init__(self, username, textobj):
+        _DictViewObj.__init__(self, username, textobj.name)
+        self.handle = None
+        self.edit_stack = []
+        self.shadow_revision = None
+        self.requests = 0
+        self.watchers = _DictWatchers()
+        self.lasttime = datetime.datetime.now()
+        self.lock = thread.allocate_lock()
+        self.textobj = textobj
+        textobj.views.append(self)
+
+class _NullPersister(object):
+    def load(self, name):
+        return u""
+
+    def save(self, name, contents):
+        pass
+
+    def close(self, name):
+        pass
+
+def _owned_size(obj, shared=()):
+    """Returns the bytes taken by obj and the objects that it holds:
+    its __dict__ or slots, lists, locks and times. Strings and numbers
+    are left out, they are the same either way, and so are the objects
+    in shared."""
+    seen = set(id(o) for o in shared)
+    def size(o):
+        if (o is None or id(o) in seen or
+                isinstance(o, (basestring, int, long))):
+            return 0
+        seen.add(id(o))
+        total = sys.getsizeof(o)
+        if isinstance(o, (list, tuple)):
+            for item in o:
+                total += size(item)
+        elif isinstance(o, dict):
+            for item in o.itervalues():
+                total += size(item)
+        if hasattr(o, "__dict__"):
+            total += size(o.__dict__)
+        for cls in getattr(type(o), "__mro__", ()):
+            for name in cls.__dict__.get("__slots__", ()):
+                total += size(getattr(o, name, None))
+        return total
+    return size(obj)
+
+def _average(objects, shared):
+    return sum(_owned_size(obj, shared(obj)) for obj in objects) / \
+        float(len(objects))
+
+def _timestamp_us(function, count=100000):
+    start = time.time()
+    for i in xrange(count):
+        function()
+    return (time.time() - start) * 1000000 / count
+
+def memory_benchmark(files=1000, views_per_file=2):
+    """Creates the given number of texts, each with views_per_file views,
+    and returns a list of dictionaries with the average bytes per object
+    before and after the change to __slots__. The daemon's objects are
+    registered in mobwrite_daemon.views and texts as the daemon would
+    and are removed again at the end."""
+    names = ["bench/project/file%d.txt" % i for i in range(files)]
+    users = ["user%d" % i for i in range(views_per_file)]
+    persister = _NullPersister()
+    no_shared = lambda obj: ()
+    results = []
+
+    old = [_DictTextObj(name) for name in names]
+    new = [mobwrite_core.TextObj(name=name) for name in names]
+    results.append(dict(object="core TextObj",
+        before=_average(old, no_shared), after=_average(new, no_shared)))
+    old = [_DictViewObj(user, name) for name in names for user in users]
+    new = [mobwrite_core.ViewObj(username=user, filename=name)
+           for name in names for user in users]
+    results.append(dict(object="core ViewObj",
+        before=_average(old, no_shared), after=_average(new, no_shared)))
+
+    old_texts = [_DictDaemonTextObj(name, persister) for name in names]
+    old_views = [_DictDaemonViewObj(user, textobj)
+                 for textobj in old_texts for user in users]
+    new_views = []
+    for name in names:
+        for user in users:
+            viewobj = mobwrite_daemon.fetch_viewobj(user, name, None,
+                                                    persister)
+            if viewobj is None:
+                raise ValueError("More than MAX_VIEWS views")
+            new_views.append(viewobj)
+    new_texts = [mobwrite_daemon.texts[name] for name in names]
+    try:
+        text_shared = lambda textobj: textobj.views + [persister]
+        view_shared = lambda viewobj: [viewobj.textobj]
+        results.append(dict(object="daemon TextObj",
+            before=_average(old_texts, text_shared),
+            after=_average(new_texts, text_shared)))
+        results.append(dict(object="daemon ViewObj",
+            before=_average(old_views, view_shared),
+            after=_average(new_views, view_shared)))
+    finally:
+        for viewobj in new_views:
+            viewobj.nullify()
+        for textobj in new_texts:
+            textobj.expire()
+
+    results.append(dict(object="timestamp (us)",
+        before=_timestamp_us(datetime.datetime.now),
+        after=_timestamp_us(mobwrite_core.monotonic)))
+    return results
+
+def print_memory_benchmark(files=1000, views_per_file=2):
+    results = memory_benchmark(files, views_per_file)
+    print "%-16s %10s %10s" % ("bytes per", "before", "after")
+    for r in results:
+        print "%-16s %10.1f %10.1f" % (r["object"], r["before"], r["after"])
+
+if __name__ == "__main__":
+    print_diff_benchmark()
+    print
+    print_memory_benchmark()
@@ -27,6 +27,7 @@ Applies the patch onto another text, allowing for errors.
 __author__ = 'fraser@google.com (Neil Fraser)'
 
 import math
+import sys
 import time
 import urllib
 import re
@@ -46,8 +47,9 @@ class diff_match_patch:
     self.Diff_Timeout = 1.0
     # Cost of an empty edit operation in terms of edit characters.
     self.Diff_EditCost = 4
-    # The size beyond which the double-ended diff activates.
+    # The size beyond which the double-ended diff activates in diff_map.
     # Double-ending is twice as fast, but less accurate.
+    # diff_main uses diff_bisect, which is always double-ended.
     self.Diff_DualThreshold = 32
     # Tweak the relative importance (0.0 = accuracy, 1.0 = proximity)
     self.Match_Balance = 0.5
@@ -74,7 +76,7 @@ class diff_match_patch:
   DIFF_INSERT = 1
   DIFF_EQUAL = 0
 
-  def diff_main(self, text1, text2, checklines=True):
+  def diff_main(self, text1, text2, checklines=True, deadline=None):
     """Find the differences between two texts.  Simplifies the problem by
       stripping any common prefix or suffix off the texts before diffing.
 
@@ -84,10 +86,19 @@ class diff_match_patch:
       checklines: Optional speedup flag.  If present and false, then don't run
         a line-level diff first to identify the changed areas.
         Defaults to true, which does a faster, slightly less optimal diff.
+      deadline: Optional time when the diff should be complete by.  Used
+        internally for recursive calls.  Users should set Diff_Timeout instead.
 
     Returns:
       Array of changes.
     """
+    # Set a deadline by which time the diff must be complete.
+    if deadline == None:
+      # Unlike in most languages, Python counts time in seconds.
+      if self.Diff_Timeout <= 0:
+        deadline = sys.maxint
+      else:
+        deadline = time.time() + self.Diff_Timeout
 
     # Check for equality (speedup)
     if text1 == text2:
@@ -109,7 +120,7 @@ class diff_match_patch:
       text2 = text2[:-commonlength]
 
     # Compute the diff on the middle block
-    diffs = self.diff_compute(text1, text2, checklines)
+    diffs = self.diff_compute(text1, text2, checklines, deadline)
 
     # Restore the prefix and suffix
     if commonprefix:
@@ -119,7 +130,7 @@ class diff_match_patch:
     self.diff_cleanupMerge(diffs)
     return diffs
 
-  def diff_compute(self, text1, text2, checklines):
+  def diff_compute(self, text1, text2, checklines, deadline):
     """Find the differences between two texts.  Assumes that the texts do not
       have any common prefix or suffix.
 
@@ -129,6 +140,7 @@ class diff_match_patch:
       checklines: Speedup flag.  If false, then don't run a line-level diff
         first to identify the changed areas.
         If true, then run a faster, slightly less optimal diff.
+      deadline: Time when the diff should be complete by.
 
     Returns:
       Array of changes.
@@ -155,6 +167,10 @@ class diff_match_patch:
         diffs[0] = (self.DIFF_DELETE, diffs[0][1])
         diffs[2] = (self.DIFF_DELETE, diffs[2][1])
       return diffs
+    if len(shorttext) == 1:
+      # Single character string.
+      # After the previous speedup, the character can't be an equality.
+      return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
     longtext = shorttext = None  # Garbage collect
 
     # Check to see if the problem can be split in two.
@@ -163,8 +179,8 @@ class diff_match_patch:
       # A half-match was found, sort out the return data.
       (text1_a, text1_b, text2_a, text2_b, mid_common) = hm
       # Send both pairs off for separate processing.
-      diffs_a = self.diff_main(text1_a, text2_a, checklines)
-      diffs_b = self.diff_main(text1_b, text2_b, checklines)
+      diffs_a = self.diff_main(text1_a, text2_a, checklines, deadline)
+      diffs_b = self.diff_main(text1_b, text2_b, checklines, deadline)
       # Merge the results.
       return diffs_a + [(self.DIFF_EQUAL, mid_common)] + diffs_b
 
@@ -175,9 +191,7 @@ class diff_match_patch:
       # Scan the text on a line-by-line basis first.
       (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
 
-    diffs = self.diff_map(text1, text2)
-    if not diffs:  # No acceptable result.
-      diffs = [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+    diffs = self.diff_bisect(text1, text2, deadline)
     if checklines:
       # Convert the diff back to original text.
       self.diff_charsToLines(diffs, linearray)
@@ -203,7 +217,7 @@ class diff_match_patch:
           # Upon reaching an equality, check for prior redundancies.
           if count_delete >= 1 and count_insert >= 1:
             # Delete the offending records and add the merged ones.
-            a = self.diff_main(text_delete, text_insert, False)
+            a = self.diff_main(text_delete, text_insert, False, deadline)
             diffs[pointer - count_delete - count_insert : pointer] = a
             pointer = pointer - count_delete - count_insert + len(a)
           count_insert = 0
@@ -286,8 +300,139 @@ class diff_match_patch:
         text.append(lineArray[ord(char)])
       diffs[x] = (diffs[x][0], "".join(text))
 
+  def diff_bisect(self, text1, text2, deadline):
+    """Find the 'middle snake' of a diff, split the problem in two
+      and return the recursively constructed diff.
+      See Myers 1986 paper: An O(ND) Difference Algorithm and Its Variations.
+      Only the furthest reaching path on each diagonal is kept, so memory
+      use is linear in the length of the texts.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time at which to bail if not yet complete.
+
+    Returns:
+      Array of diff tuples.
+    """
+
+    # Cache the text lengths to prevent multiple calls.
+    text1_length = len(text1)
+    text2_length = len(text2)
+    max_d = (text1_length + text2_length + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = v1[:]
+    delta = text1_length - text2_length
+    # If the total number of characters is odd, then the front path will
+    # collide with the reverse path.
+    front = (delta % 2 != 0)
+    # Offsets for start and end of k loop.
+    # Prevents mapping of space beyond the grid.
+    k1start = 0
+    k1end = 0
+    k2start = 0
+    k2end = 0
+    for d in xrange(max_d):
+      # Bail out if deadline is reached.
+      if time.time() > deadline:
+        break
+
+      # Walk the front path one step.
+      for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+        k1_offset = v_offset + k1
+        if k1 == -d or (k1 != d and
+            v1[k1_offset - 1] < v1[k1_offset + 1]):
+          x1 = v1[k1_offset + 1]
+        else:
+          x1 = v1[k1_offset - 1] + 1
+        y1 = x1 - k1
+        while (x1 < text1_length and y1 < text2_length and
+               text1[x1] == text2[y1]):
+          x1 += 1
+          y1 += 1
+        v1[k1_offset] = x1
+        if x1 > text1_length:
+          # Ran off the right of the graph.
+          k1end += 2
+        elif y1 > text2_length:
+          # Ran off the bottom of the graph.
+          k1start += 2
+        elif front:
+          k2_offset = v_offset + delta - k1
+          if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
+            # Mirror x2 onto top-left coordinate system.
+            x2 = text1_length - v2[k2_offset]
+            if x1 >= x2:
+              # Overlap detected.
+              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+
+      # Walk the reverse path one step.
+      for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+        k2_offset = v_offset + k2
+        if k2 == -d or (k2 != d and
+            v2[k2_offset - 1] < v2[k2_offset + 1]):
+          x2 = v2[k2_offset + 1]
+        else:
+          x2 = v2[k2_offset - 1] + 1
+        y2 = x2 - k2
+        while (x2 < text1_length and y2 < text2_length and
+               text1[-x2 - 1] == text2[-y2 - 1]):
+          x2 += 1
+          y2 += 1
+        v2[k2_offset] = x2
+        if x2 > text1_length:
+          # Ran off the left of the graph.
+          k2end += 2
+        elif y2 > text2_length:
+          # Ran off the top of the graph.
+          k2start += 2
+        elif not front:
+          k1_offset = v_offset + delta - k2
+          if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
+            x1 = v1[k1_offset]
+            y1 = v_offset + x1 - k1_offset
+            # Mirror x2 onto top-left coordinate system.
+            x2 = text1_length - x2
+            if x1 >= x2:
+              # Overlap detected.
+              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+
+    # Diff took too long and hit the deadline or
+    # number of diffs equals number of characters, no commonality at all.
+    return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+  def diff_bisectSplit(self, text1, text2, x, y, deadline):
+    """Given the location of the 'middle snake', split the diff in two parts
+    and recurse.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      x: Index of split point in text1.
+      y: Index of split point in text2.
+      deadline: Time at which to bail if not yet complete.
+
+    Returns:
+      Array of diff tuples.
+    """
+    text1a = text1[:x]
+    text2a = text2[:y]
+    text1b = text1[x:]
+    text2b = text2[y:]
+
+    # Compute both diffs serially.
+    diffs = self.diff_main(text1a, text2a, False, deadline)
+    diffsb = self.diff_main(text1b, text2b, False, deadline)
+
+    return diffs + diffsb
+
   def diff_map(self, text1, text2):
     """Explore the intersection points between the two texts.
+      Superseded by diff_bisect, which needs far less memory; kept for
+      comparison.
 
     Args:
       text1: Old string to be diffed.
@@ -0,0 +1,314 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+
+"""Load generator for the collaboration server.
+
+Simulated users edit shared documents and synchronize them the way the
+browser client in frontend/js/bespin/mobwrite/core.js does: each sync
+sends the deltas from the user's shadow of a document to their text,
+and merges the deltas that come back into both. Requests go to any
+function that answers one, such as
+InProcessMobwriteWorker.processRequest or ConnectionPool.request, with
+the handle line that the /mobwrite/ controller adds in front. Requests
+longer than fragment characters are sent as b: buffer fragments, as the
+cross-domain client sends them.
+
+run() returns a report of the syncs per second, their latency, the
+bytes of the requests and answers, and the time the server spent on
+diffs, patches and persistence. That split comes from
+mobwrite_daemon.phase_times, so it is only there when the server runs
+in this process.
+"""
+
+import os
+import random
+import threading
+import time
+import urllib
+
+from bespin.mobwrite import benchmark
+from bespin.mobwrite import diff_match_patch as dmp_module
+from bespin.mobwrite import mobwrite_daemon
+
+_LETTERS = u"abcdefghijklmnopqrstuvwxyz     \n"
+
+def _quote(text):
+    return urllib.quote(text.encode("utf-8"), "!~*'();/?:@&=+$,# ")
+
+class _Document(object):
+    """A user's copy of a shared document, as the browser keeps it."""
+    def __init__(self, name):
+        self.name = name
+        self.text = u""
+        self.shadow = u""
+        self.client_version = 0
+        self.server_version = 0
+        self.edit_stack = []
+        self.delta_ok = False
+
+class SimulatedUser(object):
+    """One browser, editing some of the documents."""
+    def __init__(self, username, names, fragment=0):
+        self.username = username
+        self.documents = dict((name, _Document(name)) for name in names)
+        self.fragment = fragment
+        self.dmp = dmp_module.diff_match_patch()
+        self.dmp.Diff_Timeout = 0.5
+        self.buffers = 0
+
+    def edit(self, rnd, edit_rate, typing, paste_rate, paste_size):
+        """Makes the edits that the user has made since the last sync:
+        with a chance of edit_rate some typing or deleting, and with a
+        chance of paste_rate a paste."""
+        documents = [doc for doc in self.documents.values() if doc.delta_ok]
+        if not documents:
+            return
+        doc = rnd.choice(documents)
+        if rnd.random() < edit_rate:
+            at = rnd.randint(0, len(doc.text))
+            if doc.text and rnd.random() < 0.2:
+                doc.text = doc.text[:at] + doc.text[at + typing:]
+            else:
+                typed = u"".join(rnd.choice(_LETTERS) for i in range(typing))
+                doc.text = doc.text[:at] + typed + doc.text[at:]
+        if rnd.random() < paste_rate:
+            at = rnd.randint(0, len(doc.text))
+            lines = benchmark.source_file(paste_size // 20 + 1, rnd)
+            pasted = u"".join(lines)[:paste_size]
+            doc.text = doc.text[:at] + pasted + doc.text[at:]
+
+    def requests(self):
+        """Returns the requests for the next sync, more than one if it
+        is sent in fragments."""
+        data = ["H:%s:127.0.0.1\n" % self.username,
+                "u:%s\n" % self.username]
+        for name in sorted(self.documents):
+            data.append(self._sync_text(self.documents[name]))
+        data.append("\n")
+        data = "".join(data)
+        if not self.fragment or len(data) <= self.fragment:
+            return [data]
+        self.buffers += 1
+        count = (len(data) + self.fragment - 1) // self.fragment
+        size = (len(data) + count - 1) // count
+        name = "%s-%d" % (self.username, self.buffers)
+        return ["b:%s %d %d %s\n\n" % (name, count, i + 1,
+                    urllib.quote(data[i * size:(i + 1) * size]))
+                for i in range(count)]
+
+    def _sync_text(self, doc):
+        dmp = self.dmp
+        if doc.delta_ok:
+            diffs = dmp.diff_main(doc.shadow, doc.text, True)
+            if len(diffs) > 2:
+                dmp.diff_cleanupSemantic(diffs)
+                dmp.diff_cleanupEfficiency(diffs)
+            changed = bool(diffs) and (len(diffs) != 1 or
+                                       diffs[0][0] != dmp.DIFF_EQUAL)
+            if changed:
+                doc.shadow = doc.text
+            if changed or not doc.edit_stack:
+                action = "d:%d:%s" % (doc.client_version,
+                                      dmp.diff_toDelta(diffs))
+                doc.edit_stack.append((doc.client_version, action))
+                doc.client_version += 1
+        else:
+            # Not in step with the server, send the whole text.
+            doc.shadow = doc.text
+            doc.client_version += 1
+            action = "r:%d:%s" % (doc.client_version, _quote(doc.text))
+            doc.edit_stack.append((doc.client_version, action))
+        lines = ["F:%d:%s\n" % (doc.server_version, doc.name)]
+        lines.extend(action + "\n" for version, action in doc.edit_stack)
+        return str("".join(lines))
+
+    def receive(self, answer):
+        """Applies the server's answer to the documents."""
+        dmp = self.dmp
+        doc = None
+        client_version = None
+        for line in answer.splitlines():
+            if not line:
+                break
+            if line[1:2] != ":":
+                continue
+            name = line[0]
+            value = line[2:]
+            if name in "FfDdRr":
+                version, sep, value = value.partition(":")
+                try:
+                    version = int(version)
+                except ValueError:
+                    continue
+            if name in "Ff":
+                doc = self.documents.get(value)
+                if doc is None:
+                    continue
+                doc.delta_ok = True
+                client_version = version
+                doc.edit_stack = [edit for edit in doc.edit_stack
+                                  if edit[0] > client_version]
+            elif doc is None:
+                continue
+            elif name in "Rr":
+                doc.shadow = urllib.unquote(value).decode("utf-8")
+                doc.client_version = client_version
+                doc.server_version = version
+                doc.edit_stack = []
+                if name == "R":
+                    doc.text = doc.shadow
+            elif name in "Dd":
+                if (client_version != doc.client_version or
+                        version > doc.server_version):
+                    doc.delta_ok = False
+                    continue
+                if version < doc.server_version:
+                    # Already seen.
+                    continue
+                try:
+                    diffs = dmp.diff_fromDelta(doc.shadow, value)
+                except ValueError:
+                    doc.delta_ok = False
+                    continue
+                doc.server_version += 1
+                if len(diffs) == 1 and diffs[0][0] == dmp.DIFF_EQUAL:
+                    continue
+                if name == "D":
+                    doc.shadow = doc.text = dmp.diff_text2(diffs)
+                else:
+                    patches = dmp.patch_make(doc.shadow, diffs)
+                    doc.shadow = dmp.patch_apply(patches, doc.shadow)[0]
+                    doc.text = dmp.patch_apply(patches, doc.text)[0]
+
+def _percentile(latencies, percent):
+    if not latencies:
+        return 0.0
+    index = min(len(latencies) - 1, len(latencies) * percent // 100)
+    return latencies[index] * 1000
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+def run(request, users=20, files=5, files_per_user=2, syncs=50, threads=4,
+        edit_rate=0.5, typing=5, paste_rate=0.02, paste_size=2000,
+        fragment=0, prefix="loadtest/", seed=0):
+    """Runs the simulated users, each syncing syncs times, on the given
+    number of threads, with request() answering each request. The
+    documents are called prefix + "fileN.txt" and must be writable by
+    the server. Afterwards every user syncs three more times without
+    editing, and the report says how many documents then read the same
+    for all of their users."""
+    rnd = random.Random(seed)
+    names = ["%sfile%d.txt" % (prefix, i) for i in range(files)]
+    simulated = [SimulatedUser("loaduser%d" % i,
+                               rnd.sample(names, min(files_per_user, files)),
+                               fragment)
+                 for i in range(users)]
+    latencies = []
+    wire = [0, 0]
+    lock = threading.Lock()
+    errors = []
+
+    def sync(user):
+        sent = received = 0
+        start = time.time()
+        for question in user.requests():
+            answer = request(question)
+            sent += len(question)
+            received += len(answer)
+        user.receive(answer)
+        elapsed = time.time() - start
+        lock.acquire()
+        latencies.append(elapsed)
+        wire[0] += sent
+        wire[1] += received
+        lock.release()
+
+    def work(mine, seed):
+        rnd = random.Random(seed)
+        try:
+            for i in range(syncs):
+                for user in mine:
+                    user.edit(rnd, edit_rate, typing, paste_rate, paste_size)
+                    sync(user)
+        except Exception, e:
+            errors.append(e)
+            raise
+
+    phases = mobwrite_daemon.phase_times.report()
+    cpu = _cpu_seconds()
+    start = time.time()
+    workers = [threading.Thread(target=work,
+                                args=(simulated[i::threads], seed + i + 1))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    cpu = _cpu_seconds() - cpu
+    if errors:
+        raise errors[0]
+    after = mobwrite_daemon.phase_times.report()
+
+    count = len(latencies)
+    latencies.sort()
+    report = dict(users=users, syncs=count,
+                  syncs_per_second=count / max(elapsed, 0.001),
+                  p50_ms=_percentile(latencies, 50),
+                  p99_ms=_percentile(latencies, 99),
+                  max_ms=_percentile(latencies, 100),
+                  bytes_sent=wire[0], bytes_received=wire[1],
+                  process_cpu_ms=cpu * 1000)
+    for key in after:
+        report[key] = after[key] - phases[key]
+
+    for i in range(3):
+        for user in simulated:
+            sync(user)
+    copies = {}
+    for user in simulated:
+        for doc in user.documents.values():
+            copies.setdefault(doc.name, set()).add(doc.text)
+    report["documents"] = len(copies)
+    report["documents_converged"] = len([name for name in copies
+                                         if len(copies[name]) == 1])
+    return report
+
+def print_report(report):
+    print "%d syncs by %d users, %.1f syncs/sec" % (report["syncs"],
+        report["users"], report["syncs_per_second"])
+    print "latency: p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        report["p50_ms"], report["p99_ms"], report["max_ms"])
+    print "wire: %d bytes sent, %d bytes received" % (
+        report["bytes_sent"], report["bytes_received"])
+    if report["diff_ms"] is None:
+        print "server: see the daemon's log for its phase times"
+    else:
+        print "server: diff %.0f ms, patch %.0f ms, persist %.0f ms" % (
+            report["diff_ms"], report["patch_ms"], report["persist_ms"])
+    print "process CPU: %.0f ms" % report["process_cpu_ms"]
+    print "%d of %d documents converged" % (report["documents_converged"],
+                                            report["documents"])
@@ -23,36 +23,199 @@ limitations under the License.
 __author__ = "fraser@google.com (Neil Fraser)"
 
 import re
+import sys
 import diff_match_patch as dmp_module
 import logging
-import datetime
+import os
+import thread
+import time
 
 # Global Diff/Match/Patch object.
 DMP = dmp_module.diff_match_patch()
 DMP.Diff_Timeout = 0.1
 
+# Texts which differ over more than this many characters are diffed line by
+# line first, then character by character within the changed lines.
+LINE_MODE_CHARS = 2000
+
+# In line mode, changed hunks larger than this are only refined if as many
+# lines were inserted as deleted, one line against the other.  Otherwise they
+# are sent as whole lines.
+LINE_MODE_HUNK_CHARS = 1000
+
 # Demo usage should limit the maximum size of any text.
 # Set to 0 to disable limit.
 MAX_CHARS = 0
 
+# Timeouts are in seconds, and are measured with monotonic().
+
 # Delete any view which hasn't been accessed in half an hour.
 # Mozilla: Keeping views for longer than necessary wastes memory, and makes the
 # Collaborators view more likely to be out of date
-TIMEOUT_VIEW = datetime.timedelta(minutes=2)
+TIMEOUT_VIEW = 2 * 60.0
 
 # Delete any text which hasn't been accessed in a day.
 # TIMEOUT_TEXT should be longer than the length of TIMEOUT_VIEW
-TIMEOUT_TEXT = datetime.timedelta(days=1)
+TIMEOUT_TEXT = 24 * 60 * 60.0
 
 # Delete any buffer which hasn't been written to in a quarter of an hour.
-TIMEOUT_BUFFER = datetime.timedelta(minutes=15)
+TIMEOUT_BUFFER = 15 * 60.0
 
 LOG = logging.getLogger("mobwrite")
 # Choose from: CRITICAL, ERROR, WARNING, INFO, DEBUG
 LOG.setLevel(logging.DEBUG)
 
 
-class TextObj:
+def monotonic():
+  # Seconds since an arbitrary point in the past.  Unlike time.time() this
+  # doesn't jump when the clock is set, and it is cheaper than
+  # datetime.datetime.now().  os.times() gives the elapsed real time on POSIX
+  # systems, in clock ticks; elsewhere it is always 0.
+  return os.times()[4]
+
+if not monotonic():
+  monotonic = time.time
+
+
+class DiffPaths:
+  # Counts of the strategies used by diff().
+  # .chars - Diffs computed character by character.
+  # .lines - Diffs computed line by line first.
+  # .hunks_refined - Changed hunks refined character by character.
+  # .hunks_paired - Large changed hunks refined one line at a time.
+  # .hunks_whole - Changed hunks too large, or too late, to refine.
+
+  def __init__(self):
+    self.lock = thread.allocate_lock()
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    self.counts = {"chars": 0, "lines": 0, "hunks_refined": 0,
+                   "hunks_paired": 0, "hunks_whole": 0}
+    self.lock.release()
+
+  def add(self, path, count=1):
+    self.lock.acquire()
+    self.counts[path] += count
+    self.lock.release()
+
+  def report(self):
+    self.lock.acquire()
+    result = dict(self.counts)
+    self.lock.release()
+    return result
+
+DIFF_PATHS = DiffPaths()
+
+
+def diff(text1, text2):
+  """Find the differences between two texts, as DMP.diff_main does.
+  If the texts differ over a stretch longer than LINE_MODE_CHARS, diff the
+  changed lines first and then refine the hunks of changed lines character
+  by character while time allows: whole if they are small, line against line
+  if they are large but have as many lines on each side.  A character diff
+  of a large hunk tends to run out of time and give up anyway.
+
+  Args:
+    text1: Old string to be diffed.
+    text2: New string to be diffed.
+
+  Returns:
+    Array of diff tuples.
+  """
+  if text1 == text2:
+    if not text1:
+      return []
+    return [(DMP.DIFF_EQUAL, text1)]
+  # Trim the common prefix and suffix back to whole lines.
+  length = DMP.diff_commonPrefix(text1, text2)
+  length = text1.rfind("\n", 0, length) + 1
+  prefix = text1[:length]
+  middle1 = text1[length:]
+  middle2 = text2[length:]
+  length = DMP.diff_commonSuffix(middle1, middle2)
+  suffix = middle1[len(middle1) - length:]
+  if "\n" in suffix:
+    suffix = suffix[suffix.find("\n") + 1:]
+  else:
+    suffix = ""
+  if suffix:
+    middle1 = middle1[:-len(suffix)]
+    middle2 = middle2[:-len(suffix)]
+
+  if max(len(middle1), len(middle2)) <= LINE_MODE_CHARS:
+    DIFF_PATHS.add("chars")
+    return DMP.diff_main(text1, text2)
+
+  DIFF_PATHS.add("lines")
+  if DMP.Diff_Timeout <= 0:
+    deadline = sys.maxint
+  else:
+    deadline = time.time() + DMP.Diff_Timeout
+  (chars1, chars2, lines) = DMP.diff_linesToChars(middle1, middle2)
+  if set(chars1).isdisjoint(chars2):
+    # No line in common, which is the slowest case for diff_main.
+    diffs = [(DMP.DIFF_DELETE, chars1), (DMP.DIFF_INSERT, chars2)]
+  else:
+    diffs = DMP.diff_main(chars1, chars2, False, deadline)
+  DMP.diff_charsToLines(diffs, lines)
+  # Eliminate freak matches (e.g. blank lines)
+  DMP.diff_cleanupSemantic(diffs)
+
+  # Refine each hunk of deleted and inserted lines.
+  result = []
+  deleted = []
+  inserted = []
+  for (op, data) in diffs + [(DMP.DIFF_EQUAL, "")]:
+    if op == DMP.DIFF_DELETE:
+      deleted.append(data)
+    elif op == DMP.DIFF_INSERT:
+      inserted.append(data)
+    else:
+      if deleted and inserted:
+        result.extend(_refine("".join(deleted), "".join(inserted), deadline))
+      elif deleted:
+        result.append((DMP.DIFF_DELETE, "".join(deleted)))
+      elif inserted:
+        result.append((DMP.DIFF_INSERT, "".join(inserted)))
+      if data:
+        result.append((op, data))
+      deleted = []
+      inserted = []
+
+  if prefix:
+    result[:0] = [(DMP.DIFF_EQUAL, prefix)]
+  if suffix:
+    result.append((DMP.DIFF_EQUAL, suffix))
+  DMP.diff_cleanupMerge(result)
+  return result
+
+
+def _refine(text_delete, text_insert, deadline):
+  # Diff a hunk of changed lines character by character, if it is worth it.
+  if time.time() < deadline:
+    if len(text_delete) + len(text_insert) <= LINE_MODE_HUNK_CHARS:
+      DIFF_PATHS.add("hunks_refined")
+      return DMP.diff_main(text_delete, text_insert, False, deadline)
+    lines_delete = text_delete.splitlines(True)
+    lines_insert = text_insert.splitlines(True)
+    if len(lines_delete) == len(lines_insert):
+      DIFF_PATHS.add("hunks_paired")
+      diffs = []
+      for x in xrange(len(lines_delete)):
+        if time.time() < deadline:
+          diffs.extend(DMP.diff_main(lines_delete[x], lines_insert[x], False,
+                                     deadline))
+        else:
+          diffs.append((DMP.DIFF_DELETE, lines_delete[x]))
+          diffs.append((DMP.DIFF_INSERT, lines_insert[x]))
+      return diffs
+  DIFF_PATHS.add("hunks_whole")
+  return [(DMP.DIFF_DELETE, text_delete), (DMP.DIFF_INSERT, text_insert)]
+
+
+class TextObj(object):
   # An object which stores a text.
 
   # Object properties:
@@ -60,6 +223,10 @@ class TextObj:
   # .text - The text itself.
   # .changed - Has the text changed since the last time it was saved.
 
+  # There can be many thousands of these, so they do without a __dict__.
+  # Subclasses must list their own properties in __slots__ too.
+  __slots__ = ("name", "text", "changed")
+
   def __init__(self, *args, **kwargs):
     # Setup this object
     self.name = kwargs.get("name")
@@ -80,7 +247,7 @@ class TextObj:
       self.changed = True
 
 
-class ViewObj:
+class ViewObj(object):
   # An object which contains one user's view of one text.
 
   # Object properties:
@@ -93,6 +260,10 @@ class ViewObj:
   # .backup_shadow_server_version - the server's version for the backup
   #     shadow (m).
 
+  __slots__ = ("username", "filename", "shadow_client_version",
+               "shadow_server_version", "backup_shadow_server_version",
+               "shadow", "backup_shadow")
+
   def __init__(self, *args, **kwargs):
     # Setup this object
     self.username = kwargs["username"]
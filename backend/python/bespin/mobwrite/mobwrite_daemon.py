@@ -25,14 +25,18 @@ from clients.
 
 __author__ = "fraser@google.com (Neil Fraser)"
 
-import datetime
+import asyncore
 import glob
+import hashlib
+import heapq
 import os
+import Queue
 import socket
 import SocketServer
 import sys
 import time
 import thread
+import threading
 import urllib
 
 sys.path.insert(0, "lib")
@@ -43,6 +47,22 @@ del sys.path[0]
 # Set to 0 to disable limit.
 MAX_VIEWS = 10000
 
+# Limit the characters held by a buffer waiting for the rest of its fragments,
+# and by all the buffers together.  Each slot counts as a character, filled or
+# not.  Set to 0 to disable a limit.
+MAX_BUFFER_CHARS = 10000000
+MAX_BUFFERS_CHARS = 100000000
+
+# Limit the memory held by the loaded texts, their views' shadows and
+# unacknowledged edits, in bytes.  Beyond it, the least recently used texts
+# are saved and unloaded along with their views, whose clients then start over
+# as if the views had idled out.  Set to 0 to disable the limit.
+MAX_MEMORY = 512 * 1024 * 1024
+
+# Texts used more recently than this many seconds are never unloaded to stay
+# within MAX_MEMORY.
+MEMORY_MIN_IDLE = 60.0
+
 # How should data be stored.
 MEMORY = 0
 FILE = 1
@@ -50,26 +70,207 @@ BDB = 2
 PERSISTER = 3
 STORAGE_MODE = PERSISTER
 
+# In PERSISTER mode, keep a journal of the edits to each text in this
+# directory and only write the whole text out now and then.  None to write
+# the whole text every time.
+JOURNAL_DIR = None
+
+# Rewrite the text and start a new journal once the journal is bigger than the
+# text and at least this many bytes...
+JOURNAL_MIN_BYTES = 4096
+
+# ...or once the journal is older than this many seconds.
+JOURNAL_INTERVAL = 300
+
 # Port to listen on.
 LOCAL_PORT = 3017
 
 # If the Telnet connection stalls for more than 2 seconds, give up.
 TIMEOUT_TELNET = 2.0
 
+# A connection that starts with a line holding just a number is framed: every
+# request is that many bytes after the number's line, every answer is written
+# the same way, and the connection stays open for the next request.  Close
+# framed connections that have been idle for longer than this many seconds.
+TIMEOUT_IDLE = 60.0
+
+# A request may start with a line "W:<seconds>".  If it sends no edits and
+# would get none back, it is held for that many seconds, but no longer than
+# LONG_POLL_TIMEOUT, or until one of its texts changes or its client sends
+# another request.  Keep this below the timeout of the clients' connections.
+LONG_POLL_TIMEOUT = 20.0
+
+# A request may also start with a line "A:".  Its buffer fragments are then
+# only stored, and the answer is the request held by a buffer that they
+# completed, or nothing, for the sender to route and send on by itself.
+
 # Restrict all Telnet connections to come from this location.
 # Set to "" to allow connections from anywhere.
 CONNECTION_ORIGIN = "127.0.0.1"
 
+# How connections are served.
+# THREADED starts a thread for each connection.
+# EVENT_LOOP reads and writes every connection from one select() loop and
+# hands complete requests to a pool of EXECUTOR_THREADS worker threads.
+THREADED = 0
+EVENT_LOOP = 1
+SERVER_MODE = THREADED
+
+# Number of threads doing the diff and patch work in EVENT_LOOP mode.
+EXECUTOR_THREADS = 4
+
+# Once this many requests are waiting for or being handled by the worker
+# threads, the event loop stops reading new requests until some finish.
+EXECUTOR_BACKLOG = 64
+
+# Number of recent requests that the latency percentiles are taken from.
+STATS_SAMPLES = 1000
+
+# The texts and views dictionaries are split into this many stripes, each
+# with its own lock.
+STRIPES = 64
+
+
+class StripedDict:
+  # A dictionary split into stripes by the hash of the key.  Creating or
+  # deleting an entry locks only its stripe, so threads working on unrelated
+  # keys don't wait for each other.  The caller must hold lock(key) while
+  # adding or removing key.
+
+  def __init__(self, stripes=STRIPES):
+    self.stripes = []
+    for x in xrange(stripes):
+      self.stripes.append(({}, thread.allocate_lock()))
+
+  def lock(self, key):
+    # The lock that guards key.
+    return self.stripes[hash(key) % len(self.stripes)][1]
+
+  def get(self, key, default=None):
+    return self.stripes[hash(key) % len(self.stripes)][0].get(key, default)
+
+  def has_key(self, key):
+    return self.stripes[hash(key) % len(self.stripes)][0].has_key(key)
+
+  __contains__ = has_key
+
+  def __getitem__(self, key):
+    return self.stripes[hash(key) % len(self.stripes)][0][key]
+
+  def __setitem__(self, key, value):
+    self.stripes[hash(key) % len(self.stripes)][0][key] = value
+
+  def __delitem__(self, key):
+    del self.stripes[hash(key) % len(self.stripes)][0][key]
+
+  def __len__(self):
+    total = 0
+    for (entries, lock) in self.stripes:
+      total += len(entries)
+    return total
+
+  def values(self):
+    # A copy of the values, taken one stripe at a time.
+    result = []
+    for (entries, lock) in self.stripes:
+      lock.acquire()
+      try:
+        result.extend(entries.values())
+      finally:
+        lock.release()
+    return result
+
+
+class ExpiryQueue:
+  # Objects that may expire, in a heap ordered by when they are due.  An
+  # object is only looked at once it is due; its expire() method then checks
+  # whether it has really been idle for long enough and schedules it again
+  # if not.  So accessing an object costs nothing here, and a cleanup pass
+  # only touches the objects that are due.
+
+  def __init__(self):
+    self.heap = []
+    self.counter = 0
+    self.lock = thread.allocate_lock()
+
+  def schedule(self, obj, due):
+    self.lock.acquire()
+    # The counter keeps objects themselves from ever being compared.
+    self.counter += 1
+    heapq.heappush(self.heap, (due, self.counter, obj))
+    self.lock.release()
+
+  def due(self, now):
+    # Remove and return the objects that are due by now.
+    result = []
+    self.lock.acquire()
+    while self.heap and self.heap[0][0] <= now:
+      result.append(heapq.heappop(self.heap)[2])
+    self.lock.release()
+    return result
+
+  def __len__(self):
+    return len(self.heap)
+
+expiry = ExpiryQueue()
+
+# Texts that have changed since they were last saved.
+dirty_texts = set()
+
+# Lock to prevent simultaneous changes to dirty_texts.
+lock_dirty = thread.allocate_lock()
+
+
+def mark_dirty(textobj):
+  lock_dirty.acquire()
+  dirty_texts.add(textobj)
+  lock_dirty.release()
+
+
+def take_dirty():
+  # Return the dirty texts and start a new set.
+  global dirty_texts
+  lock_dirty.acquire()
+  result = dirty_texts
+  dirty_texts = set()
+  lock_dirty.release()
+  return result
+
+
+class Watchers(object):
+  # Callbacks waiting for an object to change.  Each is called once, by the
+  # thread that changed the object, so it must not block.
+
+  __slots__ = ("callbacks",)
+
+  def __init__(self):
+    self.callbacks = []
+
+  def add(self, callback):
+    self.callbacks.append(callback)
+
+  def remove(self, callback):
+    try:
+      self.callbacks.remove(callback)
+    except ValueError:
+      # Already called.
+      pass
+
+  def notify(self):
+    callbacks = self.callbacks
+    if callbacks:
+      self.callbacks = []
+      for callback in callbacks:
+        callback()
+
+
 # Dictionary of all text objects.
-texts = {}
+texts = StripedDict()
 
 # Berkeley Databases
 texts_db = None
 lasttime_db = None
 
-# Lock to prevent simultaneous changes to the texts dictionary.
-lock_texts = thread.allocate_lock()
-
 
 class TextObj(mobwrite_core.TextObj):
   # A persistent object which stores a text.
@@ -77,67 +278,174 @@ class TextObj(mobwrite_core.TextObj):
   # Object properties:
   # .lock - Access control for writing to the text on this object.
   # .views - Views currently connected to this text.
-  # .lasttime - The last time that this text was modified.
+  # .lasttime - The last time that this text was modified, from
+  #     mobwrite_core.monotonic().
+  # .revision - Incremented every time the text changes.
+  # .watchers - Held requests waiting for the text or its views to change.
+  # .memory - Bytes held by the text and its views, as last measured.
+  # .peak_memory - The most that .memory has been.
+  # .persister - Where the text is loaded from and saved to.
 
   # Inherited properties:
   # .name - The unique name for this text, e.g 'proposal'.
   # .text - The text itself.
   # .changed - Has the text changed since the last time it was saved.
 
+  __slots__ = ("lock", "views", "lasttime", "revision", "watchers", "memory",
+               "peak_memory", "persister")
+
   def __init__(self, *args, **kwargs):
     # Setup this object
     mobwrite_core.TextObj.__init__(self, *args, **kwargs)
     self.persister = kwargs.get("persister")
+    self.revision = 0
+    self.watchers = Watchers()
+    self.memory = 0
+    self.peak_memory = 0
     self.views = []
-    self.lasttime = datetime.datetime.now()
+    self.lasttime = mobwrite_core.monotonic()
     self.lock = thread.allocate_lock()
     self.load()
 
-    # lock_texts must be acquired by the caller to prevent simultaneous
+    # The text's stripe must be locked by the caller to prevent simultaneous
     # creations of the same text.
-    assert lock_texts.locked(), "Can't create TextObj unless locked."
-    global texts
+    assert texts.lock(self.name).locked(), "Can't create TextObj unless locked."
     texts[self.name] = self
 
   def setText(self, newText):
+    oldText = self.text
     mobwrite_core.TextObj.setText(self, newText)
-    self.lasttime = datetime.datetime.now()
+    if self.text is not oldText:
+      self.revision += 1
+      self.watchers.notify()
+    self.lasttime = mobwrite_core.monotonic()
+    if self.changed:
+      mark_dirty(self)
+
+  def expire(self):
+    # Called by the expiry queue.  A text is scheduled when its last view
+    # goes away, and is scheduled again when the next one does.
+    if texts.get(self.name) is not self or self.views:
+      return
+    if not self.cleanup():
+      expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_TEXT)
 
   def cleanup(self):
     # General cleanup task.
+    # Returns True if the text was removed from memory.
     if len(self.views) > 0:
-      return
+      return False
     terminate = False
     # Lock must be acquired to prevent simultaneous deletions.
     self.lock.acquire()
-    if STORAGE_MODE == MEMORY:
-      if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_TEXT:
-        mobwrite_core.LOG.info("Expired text: '%s'" % self.name)
+    try:
+      if STORAGE_MODE == MEMORY:
+        if (self.lasttime <
+            mobwrite_core.monotonic() - mobwrite_core.TIMEOUT_TEXT):
+          mobwrite_core.LOG.info("Expired text: '%s'" % self.name)
+          terminate = True
+      else:
+        # Delete myself from memory if there are no attached views.
+        mobwrite_core.LOG.info("Unloading text: '%s'" % self.name)
         terminate = True
-    else:
-      # Delete myself from memory if there are no attached views.
-      mobwrite_core.LOG.info("Unloading text: '%s'" % self.name)
-      terminate = True
-
-    if terminate:
-      # Save to disk/database.
-      self.save()
-      # Terminate in-memory copy.
-      global texts
-      lock_texts.acquire()
-      try:
-        del texts[self.name]
-      except KeyError:
-        mobwrite_core.LOG.error("Text object not in text list: '%s'" % self.name)
-      lock_texts.release()
-    else:
-      if self.changed:
-        self.save()
-    self.lock.release()
+
+      # Save to disk/database.  A text that can't be saved stays in memory,
+      # so its changes are not lost and the save is tried again later.
+      if terminate or self.changed:
+        try:
+          self.save()
+          if terminate and STORAGE_MODE == PERSISTER:
+            self.persister.close(self.name)
+        except:
+          mobwrite_core.LOG.exception("Can't save text: '%s'" % self.name)
+          return False
+
+      if terminate:
+        # Terminate in-memory copy, unless a view has been attached meanwhile.
+        lock = texts.lock(self.name)
+        lock.acquire()
+        try:
+          if not self.views:
+            del texts[self.name]
+            memory_stats.charge(-self.memory)
+            self.memory = 0
+        except KeyError:
+          mobwrite_core.LOG.error("Text object not in text list: '%s'" %
+                                  self.name)
+        lock.release()
+    finally:
+      self.lock.release()
+    return terminate
+
+  def evict(self):
+    # Save and unload the text along with its views, to stay within
+    # MAX_MEMORY.  Returns True if the text was unloaded, False if one of its
+    # views is in use.
+    viewobjs = list(self.views)
+    locked = []
+    try:
+      for viewobj in viewobjs:
+        if not viewobj.lock.acquire(False):
+          return False
+        locked.append(viewobj)
+      for viewobj in viewobjs:
+        key = (viewobj.username, viewobj.filename)
+        lock = views.lock(key)
+        lock.acquire()
+        try:
+          if views.get(key) is viewobj:
+            viewobj.remove()
+        finally:
+          lock.release()
+    finally:
+      for viewobj in locked:
+        viewobj.lock.release()
+    return self.cleanup()
+
+  def lastused(self):
+    # The last time that the text was modified or any of its views serviced.
+    lasttime = self.lasttime
+    for viewobj in list(self.views):
+      lasttime = max(lasttime, viewobj.lasttime)
+    return lasttime
+
+  def measure(self, viewobj=None):
+    # Count the bytes held by the text and by its views' shadows and edit
+    # stacks, counting each string once however many of them hold it.  The
+    # shadows of viewobj, whose lock the caller holds, are swapped for equal
+    # strings that are already held, so that their copies can be freed.
+    # The text's lock must be held by the caller.
+    held = {}
+    sizes = {}
+    def add(string):
+      if string is not None:
+        sizes[id(string)] = sys.getsizeof(string)
+        held.setdefault(string, string)
+    add(self.text)
+    for other in list(self.views):
+      if other is not viewobj:
+        add(other.shadow)
+        add(other.backup_shadow)
+    if viewobj is not None:
+      if viewobj.shadow is not None:
+        viewobj.shadow = held.setdefault(viewobj.shadow, viewobj.shadow)
+      if viewobj.backup_shadow is not None:
+        viewobj.backup_shadow = held.setdefault(viewobj.backup_shadow,
+                                                viewobj.backup_shadow)
+      add(viewobj.shadow)
+      add(viewobj.backup_shadow)
+    memory = sum(sizes.values())
+    for other in list(self.views):
+      for (version, edit) in other.edit_stack:
+        memory += sys.getsizeof(edit)
+    memory_stats.charge(memory - self.memory)
+    self.memory = memory
+    self.peak_memory = max(self.peak_memory, memory)
 
 
   def load(self):
     # Load the text object from non-volatile storage.
+    start = time.time()
     if STORAGE_MODE == PERSISTER:
       contents = self.persister.load(self.name)
       self.setText(contents)
@@ -169,11 +477,13 @@ class TextObj(mobwrite_core.TextObj):
       else:
         self.setText(None)
       self.changed = False
+    phase_times.add("persist", time.time() - start)
 
   def save(self):
     # Save the text object to non-volatile storage.
     # Lock must be acquired by the caller to prevent simultaneous saves.
     assert self.lock.locked(), "Can't save unless locked."
+    start = time.time()
 
     if STORAGE_MODE == PERSISTER:
       self.persister.save(self.name, self.text)
@@ -215,6 +525,7 @@ class TextObj(mobwrite_core.TextObj):
         texts_db[self.name] = self.text.encode("utf-8")
         lasttime_db[self.name] = str(int(time.time()))
       self.changed = False
+    phase_times.add("persist", time.time() - start)
 
 
 def fetch_textobj(name, view, persister):
@@ -222,32 +533,39 @@ def fetch_textobj(name, view, persister):
   # Add the given view into the text object's list of connected views.
   # Don't let two simultaneous creations happen, or a deletion during a
   # retrieval.
-  lock_texts.acquire()
-  if texts.has_key(name):
-    textobj = texts[name]
-    mobwrite_core.LOG.debug("Accepted text: '%s'" % name)
-  else:
-    textobj = TextObj(name=name, persister=persister)
-    mobwrite_core.LOG.debug("Creating text: '%s'" % name)
-  textobj.views.append(view)
-  lock_texts.release()
+  lock = texts.lock(name)
+  lock.acquire()
+  try:
+    textobj = texts.get(name)
+    if textobj is not None:
+      mobwrite_core.LOG.debug("Accepted text: '%s'" % name)
+    else:
+      textobj = TextObj(name=name, persister=persister)
+      mobwrite_core.LOG.debug("Creating text: '%s'" % name)
+    textobj.views.append(view)
+    # The collaborators have changed.
+    textobj.watchers.notify()
+  finally:
+    lock.release()
   return textobj
 
 
 # Dictionary of all view objects.
-views = {}
-
-# Lock to prevent simultaneous changes to the views dictionary.
-lock_views = thread.allocate_lock()
+views = StripedDict()
 
 class ViewObj(mobwrite_core.ViewObj):
   # A persistent object which contains one user's view of one text.
 
   # Object properties:
   # .edit_stack - List of unacknowledged edits sent to the client.
-  # .lasttime - The last time that a web connection serviced this object.
+  # .lasttime - The last time that a web connection serviced this object,
+  #     from mobwrite_core.monotonic().
   # .lock - Access control for writing to the text on this object.
   # .textobj - The shared text object being worked on.
+  # .shadow_revision - The text's revision when it was last copied to the
+  #     shadow, or None if the shadow has changed since.
+  # .requests - The number of requests that have used this view.
+  # .watchers - Held requests from this view's client.
 
   # Inherited properties:
   # .username - The name for the user, e.g 'fraser'
@@ -259,38 +577,69 @@ class ViewObj(mobwrite_core.ViewObj):
   # .backup_shadow_server_version - the server's version for the backup
   #     shadow (m).
 
+  __slots__ = ("handle", "edit_stack", "lasttime", "lock", "textobj",
+               "shadow_revision", "requests", "watchers")
+
   def __init__(self, *args, **kwargs):
     # Setup this object
     mobwrite_core.ViewObj.__init__(self, *args, **kwargs)
     self.handle = kwargs.get("handle")
     self.edit_stack = []
-    self.lasttime = datetime.datetime.now()
+    self.shadow_revision = None
+    self.requests = 0
+    self.watchers = Watchers()
+    self.lasttime = mobwrite_core.monotonic()
     self.lock = thread.allocate_lock()
     self.textobj = fetch_textobj(self.filename, self, kwargs.get("persister"))
 
-    # lock_views must be acquired by the caller to prevent simultaneous
+    # The view's stripe must be locked by the caller to prevent simultaneous
     # creations of the same view.
-    assert lock_views.locked(), "Can't create ViewObj unless locked."
-    global views
-    views[(self.username, self.filename)] = self
+    key = (self.username, self.filename)
+    assert views.lock(key).locked(), "Can't create ViewObj unless locked."
+    views[key] = self
+    expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_VIEW)
+
+  def expire(self):
+    # Called by the expiry queue once the view may have idled out.
+    if not self.cleanup():
+      expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_VIEW)
 
   def cleanup(self):
     # General cleanup task.
     # Delete myself if I've been idle too long.
+    # Returns True if the view is gone.
     # Don't delete during a retrieval.
-    lock_views.acquire()
-    if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_VIEW:
-      mobwrite_core.LOG.info("Idle out: '%s@%s'" % (self.username, self.filename))
-      global views
-      try:
-        del views[(self.username, self.filename)]
-      except KeyError:
-        mobwrite_core.LOG.error("View object not in view list: '%s %s'" % (self.username, self.filename))
-      self.textobj.views.remove(self)
-    lock_views.release()
+    key = (self.username, self.filename)
+    lock = views.lock(key)
+    lock.acquire()
+    try:
+      if views.get(key) is not self:
+        # Already deleted.
+        return True
+      if self.lasttime >= mobwrite_core.monotonic() - mobwrite_core.TIMEOUT_VIEW:
+        return False
+      mobwrite_core.LOG.info("Idle out: '%s@%s'" % key)
+      self.remove()
+      return True
+    finally:
+      lock.release()
+
+  def remove(self):
+    # Detach the view from its text.  The caller holds the view's stripe lock.
+    del views[(self.username, self.filename)]
+    textobj = self.textobj
+    textobj.views.remove(self)
+    textobj.watchers.notify()
+    if not textobj.views:
+      # The text can go once it has no views.
+      if STORAGE_MODE == MEMORY:
+        due = textobj.lasttime + mobwrite_core.TIMEOUT_TEXT
+      else:
+        due = 0
+      expiry.schedule(textobj, due)
 
   def nullify(self):
-    self.lasttime = datetime.datetime.min
+    self.lasttime = 0
     self.cleanup()
 
 
@@ -298,20 +647,23 @@ def fetch_viewobj(username, filename, handle, persister):
   # Retrieve the named view object.  Create it if it doesn't exist.
   # Don't let two simultaneous creations happen, or a deletion during a
   # retrieval.
-  lock_views.acquire()
   key = (username, filename)
-  if views.has_key(key):
-    viewobj = views[key]
-    viewobj.lasttime = datetime.datetime.now()
-    mobwrite_core.LOG.debug("Accepting view: '%s@%s'" % key)
-  else:
-    if MAX_VIEWS != 0 and len(views) > MAX_VIEWS:
-      viewobj = None
-      mobwrite_core.LOG.critical("Overflow: Can't create new view.")
+  lock = views.lock(key)
+  lock.acquire()
+  try:
+    viewobj = views.get(key)
+    if viewobj is not None:
+      viewobj.lasttime = mobwrite_core.monotonic()
+      mobwrite_core.LOG.debug("Accepting view: '%s@%s'" % key)
     else:
-      viewobj = ViewObj(username=username, filename=filename, handle=handle, persister=persister)
-      mobwrite_core.LOG.debug("Creating view: '%s@%s'" % key)
-  lock_views.release()
+      if MAX_VIEWS != 0 and len(views) > MAX_VIEWS:
+        viewobj = None
+        mobwrite_core.LOG.critical("Overflow: Can't create new view.")
+      else:
+        viewobj = ViewObj(username=username, filename=filename, handle=handle, persister=persister)
+        mobwrite_core.LOG.debug("Creating view: '%s@%s'" % key)
+  finally:
+    lock.release()
   return viewobj
 
 
@@ -321,68 +673,142 @@ buffers = {}
 # Lock to prevent simultaneous changes to the buffers dictionary.
 lock_buffers = thread.allocate_lock()
 
+# Characters held by all the buffers.
+buffer_chars = 0
+
+# Lock to prevent simultaneous changes to buffer_chars.
+lock_buffer_chars = thread.allocate_lock()
+
+
+def charge_buffers(chars):
+  # Add to the characters held by all the buffers.  Returns False, and adds
+  # nothing, if that would take them over MAX_BUFFERS_CHARS.
+  global buffer_chars
+  lock_buffer_chars.acquire()
+  try:
+    if (chars > 0 and MAX_BUFFERS_CHARS != 0 and
+        buffer_chars + chars > MAX_BUFFERS_CHARS):
+      return False
+    buffer_chars += chars
+    return True
+  finally:
+    lock_buffer_chars.release()
+
+
 class BufferObj:
   # A persistent object which assembles large commands from fragments.
 
   # Object properties:
   # .name - The name (and size) of the buffer, e.g. 'alpha:12'
   # .lasttime - The last time that a web connection wrote to this object.
-  # .data - The contents of the buffer.
+  # .slots - The fragments received so far, None for the missing ones.
+  # .filled - The number of slots which have been filled.
+  # .chars - The characters held, counting each slot as one.
+  # .done - Has the buffer been completed or removed.
   # .lock - Access control for writing to the text on this object.
 
   def __init__(self, name, size):
     # Setup this object
     self.name = name
-    self.lasttime = datetime.datetime.now()
+    self.lasttime = mobwrite_core.monotonic()
     self.lock = thread.allocate_lock()
 
-    # Initialize the buffer with a set number of slots.
-    # Null characters form dividers between each slot.
-    array = []
-    for x in xrange(size - 1):
-      array.append("\0")
-    self.data = "".join(array)
+    # Initialize the buffer with a set number of empty slots.
+    # The caller must have charged the slots to the buffers' total.
+    self.slots = [None] * size
+    self.filled = 0
+    self.chars = size
+    self.done = False
 
     # lock_buffers must be acquired by the caller to prevent simultaneous
     # creations of the same view.
     assert lock_buffers.locked(), "Can't create BufferObj unless locked."
     global buffers
     buffers[name] = self
+    expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_BUFFER)
     mobwrite_core.LOG.debug("Buffer initialized to %d slots: %s" % (size, name))
 
   def set(self, n, text):
     # Set the nth slot of this buffer with text.
+    # Returns False if that would take this buffer, or all of them, over
+    # their limit.
     assert self.lock.locked(), "Can't edit BufferObj unless locked."
     # n is 1-based.
     n -= 1
-    array = self.data.split("\0")
-    assert 0 <= n < len(array), "Invalid buffer insertion"
-    array[n] = text
-    self.data = "\0".join(array)
+    assert 0 <= n < len(self.slots), "Invalid buffer insertion"
+    if self.done:
+      return True
+    old = self.slots[n]
+    if old is None:
+      grow = len(text)
+    else:
+      grow = len(text) - len(old)
+    if MAX_BUFFER_CHARS != 0 and self.chars + grow > MAX_BUFFER_CHARS:
+      mobwrite_core.LOG.error("Buffer over %d characters: '%s'" %
+          (MAX_BUFFER_CHARS, self.name))
+      return False
+    if not charge_buffers(grow):
+      mobwrite_core.LOG.error("Buffers over %d characters, dropping: '%s'" %
+          (MAX_BUFFERS_CHARS, self.name))
+      return False
+    self.slots[n] = text
+    self.chars += grow
+    if old is None:
+      self.filled += 1
     mobwrite_core.LOG.debug("Inserted into slot %d of a %d slot buffer: %s" %
-        (n + 1, len(array), self.name))
+        (n + 1, len(self.slots), self.name))
+    return True
 
   def get(self):
     # Fetch the completed text from the buffer.
-    if ("\0" + self.data + "\0").find("\0\0") == -1:
-      text = self.data.replace("\0", "")
-      # Delete this buffer.
-      self.lasttime = datetime.datetime.min
-      self.cleanup()
-      return text
-    # Not complete yet.
-    return None
+    # Once it has been fetched, the buffer should be discarded.
+    assert self.lock.locked(), "Can't read BufferObj unless locked."
+    if self.done or self.filled < len(self.slots):
+      # Not complete yet.
+      return None
+    self.done = True
+    return "".join(self.slots)
+
+  def expire(self):
+    # Called by the expiry queue once the buffer may have expired.
+    if not self.cleanup():
+      expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_BUFFER)
 
   def cleanup(self):
     # General cleanup task.
     # Delete myself if I've been idle too long.
+    # Returns True if the buffer is gone.
     # Don't delete during a retrieval.
     lock_buffers.acquire()
-    if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_BUFFER:
+    try:
+      if buffers.get(self.name) is not self:
+        # Already deleted.
+        return True
+      if self.lasttime >= mobwrite_core.monotonic() - mobwrite_core.TIMEOUT_BUFFER:
+        return False
       mobwrite_core.LOG.info("Expired buffer: '%s'" % self.name)
-      global buffers
-      del buffers[self.name]
-    lock_buffers.release()
+      self.remove()
+      return True
+    finally:
+      lock_buffers.release()
+
+  def discard(self):
+    # Delete this buffer now, because it is complete or over its limit.
+    lock_buffers.acquire()
+    try:
+      if buffers.get(self.name) is self:
+        self.remove()
+    finally:
+      lock_buffers.release()
+
+  def remove(self):
+    # Delete this buffer and give back its characters.
+    # lock_buffers must be acquired by the caller.
+    self.lock.acquire()
+    self.done = True
+    self.lock.release()
+    del buffers[self.name]
+    charge_buffers(-self.chars)
 
 
 class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
@@ -405,7 +831,8 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
       buffer is not yet complete returns the empty string.
     """
     # Note that 'index' is 1-based.
-    if not 0 < index <= size:
+    if not 0 < index <= size or (MAX_BUFFER_CHARS != 0 and
+                                 size > MAX_BUFFER_CHARS):
       mobwrite_core.LOG.error("Invalid buffer: '%s %d %d'" % (name, size, index))
       text = ""
     elif size == 1 and index == 1:
@@ -418,19 +845,30 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
       # Don't let two simultaneous creations happen, or a deletion during a
       # retrieval.
       lock_buffers.acquire()
-      if buffers.has_key(name):
-        bufferobj = buffers[name]
-        bufferobj.lasttime = datetime.datetime.now()
+      bufferobj = buffers.get(name)
+      if bufferobj is not None:
+        bufferobj.lasttime = mobwrite_core.monotonic()
         mobwrite_core.LOG.debug("Found buffer: '%s'" % name)
-      else:
+      elif charge_buffers(size):
         bufferobj = BufferObj(name, size)
         mobwrite_core.LOG.debug("Creating buffer: '%s'" % name)
-      bufferobj.lock.acquire()
+      else:
+        mobwrite_core.LOG.error("Buffers over %d characters, can't create: '%s'"
+            % (MAX_BUFFERS_CHARS, name))
+      if bufferobj is not None:
+        bufferobj.lock.acquire()
       lock_buffers.release()
-      bufferobj.set(index, datum)
-      # Check if Buffer is complete.
-      text = bufferobj.get()
-      bufferobj.lock.release()
+      text = None
+      if bufferobj is not None:
+        accepted = bufferobj.set(index, datum)
+        if accepted:
+          # Check if Buffer is complete.
+          text = bufferobj.get()
+        bufferobj.lock.release()
+        if not accepted or text != None:
+          # Delete the buffer outside of its lock, since lock_buffers must not
+          # be waited for while holding it.
+          bufferobj.discard()
       if text == None:
         text = ""
     return urllib.unquote(text)
@@ -451,11 +889,14 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         # Timeout.
         mobwrite_core.LOG.warning("Timeout on connection")
         break
+      if not data and line.rstrip("\r\n").isdigit():
+        self.handleFrames(line)
+        break
       data.append(line)
       if not line.rstrip("\r\n"):
         # Terminate and execute on blank line.
         question = "".join(data)
-        answer = self.handleRequest(question)
+        answer = serve_request(self, question)
         self.wfile.write(answer)
         break
 
@@ -463,11 +904,97 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
     mobwrite_core.LOG.debug("Disconnecting.")
 
 
-  def handleRequest(self, text):
-    actions = self.parseRequest(text)
-    return self.doActions(actions)
+  def handleFrames(self, line):
+    # Answer framed requests until the client goes away or goes quiet.
+    # line is the first request's length line.
+    while line:
+      size = int(line)
+      try:
+        question = self.rfile.read(size)
+      except:
+        mobwrite_core.LOG.warning("Timeout on connection")
+        return
+      if len(question) < size:
+        return
+      answer = serve_request(self, question)
+      self.wfile.write(frame(answer))
+      self.connection.settimeout(TIMEOUT_IDLE)
+      try:
+        line = self.rfile.readline()
+      except:
+        return
+      self.connection.settimeout(TIMEOUT_TELNET)
+      if not line.rstrip("\r\n").isdigit():
+        mobwrite_core.LOG.warning("Bad frame on connection")
+        return
+
+
+  def handleRequest(self, text, held=None):
+    if text.startswith("A:\n"):
+      return self.assembleRequest(text[3:])
+    (actions, held, waited) = self.holdRequest(text, held)
+    return self.doActions(actions, held)
+
+  def assembleRequest(self, text):
+    """Store the buffer fragments of a request without executing anything.
+
+    Args:
+      text: Request made up of buffer commands.
+
+    Returns:
+      The request held by a buffer that this completed, ready to be parsed,
+      or the empty string if no buffer was completed.
+    """
+    for line in text.splitlines():
+      if not line:
+        break
+      if line[:2] not in ("b:", "B:"):
+        continue
+      try:
+        (name, size, index, datum) = line[2:].split(" ", 3)
+        size = int(size)
+        index = int(index)
+      except ValueError:
+        mobwrite_core.LOG.warning("Invalid buffer format: %s" % line)
+        continue
+      datum = self.feedBuffer(name, size, index, datum)
+      if datum:
+        mobwrite_core.LOG.info("Assembled buffer: %s_%d" % (name, size))
+        # Duplicate the last character, as parseRequest does.
+        return datum + datum[-1]
+    return ""
 
-  def doActions(self, actions):
+  def holdRequest(self, text, held=None):
+    """Parse a request and, if it asks to be and there is nothing to send
+      either way, hold it until there is.
+
+    Args:
+      text: The request.
+      held: If the request has already been held, the view requests from
+        hold_views().
+
+    Returns:
+      A tuple of the actions, the view requests from hold_views() if the
+      request has been held, and how many seconds it was held for here.
+    """
+    (wait, text) = split_wait(text)
+    actions = self.parseRequest(text)
+    waited = 0.0
+    if wait and held is None:
+      viewobjs = idle_views(actions)
+      if viewobjs is not None:
+        start = time.time()
+        held = hold_views(viewobjs)
+        event = threading.Event()
+        watch_views(viewobjs, event.set)
+        # A change may have come before the watch.
+        if idle_views(actions) is not None:
+          event.wait(wait)
+        unwatch_views(viewobjs, event.set)
+        waited = time.time() - start
+    return (actions, held, waited)
+
+  def doActions(self, actions, held=None):
     output = []
     last_username = None
     last_filename = None
@@ -488,6 +1015,13 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         delta_ok = True
         viewobj.lock.acquire()
         textobj = viewobj.textobj
+        key = (viewobj.username, viewobj.filename)
+        if held is not None and held.get(key) != (viewobj, viewobj.requests):
+          # The client has given up on this held request and sent another.
+          viewobj.lock.release()
+          return ""
+        viewobj.requests += 1
+        viewobj.watchers.notify()
 
       if action["mode"] == "null":
         # Nullify the text.
@@ -507,6 +1041,7 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         mobwrite_core.LOG.warning("Rollback from shadow %d to backup shadow %d" %
             (viewobj.shadow_server_version, viewobj.backup_shadow_server_version))
         viewobj.shadow = viewobj.backup_shadow
+        viewobj.shadow_revision = None
         viewobj.shadow_server_version = viewobj.backup_shadow_server_version
         viewobj.edit_stack = []
 
@@ -527,6 +1062,7 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         delta_ok = True
         # First, update the client's shadow.
         viewobj.shadow = data
+        viewobj.shadow_revision = None
         viewobj.shadow_client_version = action["client_version"]
         viewobj.shadow_server_version = action["server_version"]
         viewobj.backup_shadow = viewobj.shadow
@@ -571,9 +1107,16 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
                 (len(viewobj.shadow), viewobj.username, viewobj.filename))
           viewobj.shadow_client_version += 1
           if diffs != None:
+            for (op, data) in diffs:
+              if op != mobwrite_core.DMP.DIFF_EQUAL:
+                # The client edited its shadow.
+                viewobj.shadow_revision = None
+                break
             # Textobj lock required for read/patch/write cycle.
             textobj.lock.acquire()
+            start = time.time()
             self.applyPatches(viewobj, diffs, action)
+            phase_times.add("patch", time.time() - start)
             textobj.lock.release()
 
       # Generate output if this is the last action or the username/filename
@@ -587,15 +1130,18 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
                                          delta_ok))
         last_username = viewobj.username
         last_filename = viewobj.filename
+        textobj.lock.acquire()
+        textobj.measure(viewobj)
+        textobj.lock.release()
         # Dereference the view object so that a new one can be created.
         # Mozilla: Is this just belt and braces - how would it be locked?
         viewobj.lock.release()
         viewobj = None
 
-    if action["echo_collaborators"]:
-      name = action["filename"]
-      if name in texts:
-        text = texts[name]
+    # An incomplete buffer leaves no actions at all.
+    if actions and action["echo_collaborators"]:
+      text = texts.get(action["filename"])
+      if text is not None:
         collab_list = [view.handle + ":" + view.username for view in text.views]
         line = "C:" + (",".join(collab_list))
         output.append(line)
@@ -615,15 +1161,30 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
           (viewobj.shadow_client_version, viewobj.filename))
 
     textobj = viewobj.textobj
+    # Read the revision before the text, so that a change in between makes
+    # the next poll compute a diff rather than skip one it needed.
+    revision = textobj.revision
     mastertext = textobj.text
 
     if delta_ok:
       if mastertext == None:
         mastertext = ""
-      # Create the diff between the view's text and the master text.
-      diffs = mobwrite_core.DMP.diff_main(viewobj.shadow, mastertext)
-      mobwrite_core.DMP.diff_cleanupEfficiency(diffs)
-      text = mobwrite_core.DMP.diff_toDelta(diffs)
+      if viewobj.shadow_revision == revision:
+        # Neither side has changed since the shadow was taken from the text,
+        # so the diff can only be the empty one.
+        if mastertext:
+          text = "=%d" % len(mastertext)
+        else:
+          text = ""
+        diff_stats.skipped()
+      else:
+        # Create the diff between the view's text and the master text.
+        start = time.time()
+        diffs = mobwrite_core.diff(viewobj.shadow, mastertext)
+        mobwrite_core.DMP.diff_cleanupEfficiency(diffs)
+        text = mobwrite_core.DMP.diff_toDelta(diffs)
+        phase_times.add("diff", time.time() - start)
+        diff_stats.computed()
       if force:
         # Client sending 'D' means number, no error.
         # Client sending 'R' means number, client error.
@@ -660,12 +1221,575 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
             (len(text), viewobj.username, viewobj.filename))
 
     viewobj.shadow = mastertext
+    viewobj.shadow_revision = revision
 
     for edit in viewobj.edit_stack:
       output.append(edit[1])
 
     return "".join(output)
 
+class RequestStats:
+  # Throughput and latency of the requests served by this daemon.
+  # Latency is measured from a complete request having been read to the
+  # answer being ready, so in EVENT_LOOP mode it includes the time spent
+  # waiting for a worker thread.
+
+  def __init__(self, samples=STATS_SAMPLES):
+    self.lock = thread.allocate_lock()
+    self.samples = samples
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    self.started = time.time()
+    self.requests = 0
+    self.latencies = []
+    self.next_sample = 0
+    self.lock.release()
+
+  def record(self, latency):
+    self.lock.acquire()
+    self.requests += 1
+    if len(self.latencies) < self.samples:
+      self.latencies.append(latency)
+    else:
+      self.latencies[self.next_sample] = latency
+      self.next_sample = (self.next_sample + 1) % self.samples
+    self.lock.release()
+
+  def report(self):
+    # Returns a dictionary with the number of requests, the requests per
+    # second since the stats were reset and the 50th percentile, 99th
+    # percentile and maximum latency in milliseconds of recent requests.
+    self.lock.acquire()
+    elapsed = time.time() - self.started
+    requests = self.requests
+    latencies = sorted(self.latencies)
+    self.lock.release()
+    result = {"mode": SERVER_MODE == EVENT_LOOP and "event_loop" or "threaded",
+              "requests": requests,
+              "per_second": requests / max(elapsed, 0.001),
+              "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    if latencies:
+      result["p50_ms"] = latencies[len(latencies) // 2] * 1000
+      result["p99_ms"] = latencies[min(len(latencies) - 1,
+                                       len(latencies) * 99 // 100)] * 1000
+      result["max_ms"] = latencies[-1] * 1000
+    return result
+
+request_stats = RequestStats()
+
+
+class DiffStats:
+  # How many of the diffs sent to clients had to be computed, and how many
+  # were skipped because the shadow was known to match the text.  The report
+  # includes the paths taken by mobwrite_core.diff().
+
+  def __init__(self):
+    self.lock = thread.allocate_lock()
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    self.diffs_skipped = 0
+    self.diffs_computed = 0
+    self.lock.release()
+    mobwrite_core.DIFF_PATHS.reset()
+
+  def skipped(self):
+    self.lock.acquire()
+    self.diffs_skipped += 1
+    self.lock.release()
+
+  def computed(self):
+    self.lock.acquire()
+    self.diffs_computed += 1
+    self.lock.release()
+
+  def report(self):
+    self.lock.acquire()
+    result = {"diffs_skipped": self.diffs_skipped,
+              "diffs_computed": self.diffs_computed}
+    self.lock.release()
+    result.update(mobwrite_core.DIFF_PATHS.report())
+    return result
+
+diff_stats = DiffStats()
+
+
+class MemoryStats:
+  # The bytes held by the loaded texts, as measured by TextObj.measure(), and
+  # how many texts have been unloaded to stay within MAX_MEMORY.  The report
+  # lists the documents holding the most.
+
+  def __init__(self):
+    self.lock = thread.allocate_lock()
+    self.used = 0
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    self.peak = self.used
+    self.evicted = 0
+    self.lock.release()
+
+  def charge(self, memory):
+    self.lock.acquire()
+    self.used += memory
+    self.peak = max(self.peak, self.used)
+    self.lock.release()
+
+  def evict(self):
+    self.lock.acquire()
+    self.evicted += 1
+    self.lock.release()
+
+  def report(self, documents=10):
+    self.lock.acquire()
+    result = {"memory_bytes": self.used,
+              "peak_memory_bytes": self.peak,
+              "texts_evicted": self.evicted}
+    self.lock.release()
+    largest = [(textobj.memory, textobj.name, textobj)
+               for textobj in texts.values()]
+    largest.sort(reverse=True)
+    result["documents"] = dict([(name, {"memory_bytes": textobj.memory,
+                                        "peak_memory_bytes": textobj.peak_memory})
+                                for (memory, name, textobj)
+                                in largest[:documents]])
+    return result
+
+memory_stats = MemoryStats()
+
+
+class PhaseTimes:
+  # Seconds spent computing diffs for clients, applying their patches and
+  # loading and saving texts.  These are elapsed times, but the work is
+  # all in Python, so they are close to the CPU time taken.
+
+  PHASES = ("diff", "patch", "persist")
+
+  def __init__(self):
+    self.lock = thread.allocate_lock()
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    self.seconds = dict.fromkeys(self.PHASES, 0.0)
+    self.lock.release()
+
+  def add(self, phase, seconds):
+    self.lock.acquire()
+    self.seconds[phase] += seconds
+    self.lock.release()
+
+  def report(self):
+    self.lock.acquire()
+    result = dict([(phase + "_ms", self.seconds[phase] * 1000)
+                   for phase in self.PHASES])
+    self.lock.release()
+    return result
+
+phase_times = PhaseTimes()
+
+
+def frame(text):
+  # Prefix text with its length, as a framed connection expects.
+  return "%d\n%s" % (len(text), text)
+
+
+def serve_request(handler, question, held=None):
+  # Answer one complete request, recording how long it took apart from the
+  # time it was held for.
+  if question.startswith("A:\n"):
+    return handler.assembleRequest(question[3:])
+  start = time.time()
+  (actions, held, waited) = handler.holdRequest(question, held)
+  answer = handler.doActions(actions, held)
+  request_stats.record(time.time() - start - waited)
+  return answer
+
+
+def split_wait(question):
+  # Take the "W:<seconds>" line off the front of a request.
+  # Returns the seconds to hold it for, or 0, and the rest of the request.
+  if not question.startswith("W:"):
+    return (0, question)
+  (line, question) = (question.split("\n", 1) + [""])[:2]
+  try:
+    wait = float(line[2:])
+  except ValueError:
+    mobwrite_core.LOG.warning("Invalid wait: '%s'" % line)
+    return (0, question)
+  return (max(0, min(wait, LONG_POLL_TIMEOUT)), question)
+
+
+def idle_views(actions):
+  # The views of a request which sends no edits and would get none back, or
+  # None if the request should be answered now.
+  viewobjs = []
+  for action in actions:
+    viewobj = views.get((action["username"], action["filename"]))
+    if (viewobj is None or action["mode"] != "delta" or action["force"] or
+        action["server_version"] != viewobj.shadow_server_version or
+        action["client_version"] != viewobj.shadow_client_version or
+        viewobj.shadow_revision != viewobj.textobj.revision):
+      return None
+    if viewobj.shadow:
+      unchanged = "=%d" % len(viewobj.shadow)
+    else:
+      unchanged = ""
+    if action["data"] != unchanged:
+      return None
+    viewobjs.append(viewobj)
+  return viewobjs or None
+
+
+def hold_views(viewobjs):
+  # Note how many requests each view has seen, so that a held request can
+  # tell whether its client has sent another since.
+  held = {}
+  for viewobj in viewobjs:
+    key = (viewobj.username, viewobj.filename)
+    held[key] = (viewobj, viewobj.requests)
+  return held
+
+
+def watch_views(viewobjs, callback):
+  # Call callback once any of the views, or their texts, change.
+  for viewobj in viewobjs:
+    viewobj.watchers.add(callback)
+    viewobj.textobj.watchers.add(callback)
+
+
+def unwatch_views(viewobjs, callback):
+  for viewobj in viewobjs:
+    viewobj.watchers.remove(callback)
+    viewobj.textobj.watchers.remove(callback)
+
+
+def handler_class(persister):
+  # SocketServer creates a new handler for every connection, passing it the
+  # request, the client address and the server.
+  class ThreadedDaemonMobWrite(DaemonMobWrite):
+    def __init__(self, request, client_address, server):
+      DaemonMobWrite.__init__(self, persister)
+      SocketServer.StreamRequestHandler.__init__(self, request,
+                                                 client_address, server)
+  return ThreadedDaemonMobWrite
+
+
+class Executor:
+  # A fixed pool of threads that run functions off the event loop.
+  # The loop learns that a function is done through the trigger.
+
+  def __init__(self, threads, trigger):
+    self.trigger = trigger
+    self.queue = Queue.Queue()
+    self.threads = []
+    for x in xrange(threads):
+      worker = threading.Thread(target=self.run)
+      worker.setDaemon(True)
+      worker.start()
+      self.threads.append(worker)
+
+  def submit(self, function, args, callback):
+    # Run function(*args) on a worker thread, then callback(result) on the
+    # event loop.
+    self.queue.put((function, args, callback))
+
+  def run(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        return
+      (function, args, callback) = job
+      try:
+        result = function(*args)
+      except:
+        mobwrite_core.LOG.exception("Error handling request")
+        result = ""
+      self.trigger.call(callback, result)
+
+  def shutdown(self):
+    for worker in self.threads:
+      self.queue.put(None)
+    for worker in self.threads:
+      worker.join()
+
+
+class Trigger(asyncore.file_dispatcher):
+  # Wakes up the event loop so that it runs callbacks queued by other
+  # threads.
+
+  def __init__(self, map):
+    (self.reader, self.writer) = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self.reader, map)
+    self.lock = thread.allocate_lock()
+    self.callbacks = []
+
+  def call(self, callback, *args):
+    self.lock.acquire()
+    try:
+      if self.writer is None:
+        # The loop has stopped.
+        return
+      self.callbacks.append((callback, args))
+      os.write(self.writer, "x")
+    finally:
+      self.lock.release()
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(8192)
+    except socket.error:
+      pass
+    self.lock.acquire()
+    callbacks = self.callbacks
+    self.callbacks = []
+    self.lock.release()
+    for (callback, args) in callbacks:
+      callback(*args)
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    self.lock.acquire()
+    if self.writer is not None:
+      os.close(self.writer)
+      self.writer = None
+    self.lock.release()
+
+
+class MobWriteChannel(asyncore.dispatcher):
+  # One client connection in EVENT_LOOP mode.  Reads a request, has it
+  # answered by the executor and writes the answer back.  A plain request
+  # ends in a blank line and the connection is closed after the answer, a
+  # framed connection carries one request after another.
+
+  def __init__(self, server, sock):
+    asyncore.dispatcher.__init__(self, sock, server.map)
+    self.server = server
+    # Received data that has not been handled yet, as a list of strings
+    # holding self.received bytes in total.  Nothing can be handled until
+    # at least self.needed bytes are there.
+    self.chunks = []
+    self.received = 0
+    self.needed = 1
+    self.framed = None
+    self.outgoing = ""
+    self.waiting = False
+    self.lasttime = time.time()
+
+  def readable(self):
+    return not self.waiting and not self.outgoing and not self.server.busy()
+
+  def writable(self):
+    return len(self.outgoing) > 0
+
+  def handle_read(self):
+    try:
+      data = self.recv(8192)
+    except socket.error:
+      data = ""
+    if not data:
+      self.close()
+      return
+    self.lasttime = time.time()
+    self.chunks.append(data)
+    self.received += len(data)
+    if self.received >= self.needed:
+      self.process()
+
+  def process(self):
+    # Dispatch the next complete request, if there is one.
+    data = "".join(self.chunks)
+    newline = data.find("\n")
+    if self.framed is None:
+      if newline == -1:
+        self.needed = self.received + 1
+        return
+      self.framed = data[:newline].rstrip("\r").isdigit()
+    if self.framed:
+      if newline == -1:
+        self.needed = self.received + 1
+        return
+      length = data[:newline].rstrip("\r")
+      if not length.isdigit():
+        mobwrite_core.LOG.warning("Bad frame on connection")
+        self.close()
+        return
+      end = newline + 1 + int(length)
+      if len(data) < end:
+        self.chunks = [data]
+        self.needed = end
+        return
+      question = data[newline + 1:end]
+      rest = data[end:]
+    else:
+      # Same terminators that parseRequest accepts.
+      if not (data.endswith("\n\n") or data.endswith("\r\r") or
+              data.endswith("\n\r\n\r") or data.endswith("\r\n\r\n")):
+        self.chunks = [data]
+        self.needed = self.received + 1
+        return
+      question = data
+      rest = ""
+    self.chunks = rest and [rest] or []
+    self.received = len(rest)
+    self.needed = 1
+    self.waiting = True
+    self.server.dispatch(self, question)
+
+  def answer(self, answer):
+    # Called on the event loop once the executor is done.
+    self.waiting = False
+    self.lasttime = time.time()
+    if self.framed:
+      self.outgoing = frame(answer)
+    elif not answer:
+      self.close()
+    else:
+      self.outgoing = answer
+
+  def handle_write(self):
+    try:
+      sent = self.send(self.outgoing)
+    except socket.error:
+      self.close()
+      return
+    self.lasttime = time.time()
+    self.outgoing = self.outgoing[sent:]
+    if not self.outgoing:
+      if not self.framed:
+        # Goodbye
+        self.close()
+      elif self.received:
+        # The client sent its next request without waiting.
+        self.process()
+
+  def handle_close(self):
+    self.close()
+
+  def stalled(self, now):
+    if self.waiting:
+      return False
+    if self.framed and not self.received and not self.outgoing:
+      return self.lasttime < now - TIMEOUT_IDLE
+    return self.lasttime < now - TIMEOUT_TELNET
+
+
+class HeldRequest:
+  # A request held by the event loop until one of its views or their texts
+  # changes, without taking up a worker thread.
+
+  def __init__(self, server, channel, question, actions, viewobjs, wait):
+    self.server = server
+    self.channel = channel
+    self.question = question
+    self.viewobjs = viewobjs
+    self.held = hold_views(viewobjs)
+    self.deadline = time.time() + wait
+    self.released = False
+    server.held.add(self)
+    watch_views(viewobjs, self.changed)
+    # A change may have come before the watch.
+    if idle_views(actions) is None:
+      self.release()
+
+  def changed(self):
+    # Called by the thread that made the change.
+    self.server.trigger.call(self.release)
+
+  def release(self):
+    # Called on the event loop.  Hand the request to the executor.
+    if self.released:
+      return
+    self.released = True
+    unwatch_views(self.viewobjs, self.changed)
+    self.server.held.discard(self)
+    self.server.submit(self.channel, self.question, self.held)
+
+
+class EventLoopServer(asyncore.dispatcher):
+  # Accepts connections and runs them all from one select() loop.
+
+  def __init__(self, address, persister, threads=EXECUTOR_THREADS,
+               backlog=EXECUTOR_BACKLOG):
+    self.map = {}
+    asyncore.dispatcher.__init__(self, map=self.map)
+    self.handler = DaemonMobWrite(persister)
+    self.backlog = backlog
+    self.in_flight = 0
+    self.held = set()
+    self.running = False
+    self.trigger = Trigger(self.map)
+    self.executor = Executor(threads, self.trigger)
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(address)
+    self.listen(128)
+    self.server_address = self.socket.getsockname()
+
+  def busy(self):
+    return self.in_flight >= self.backlog
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+    (sock, client_address) = pair
+    if CONNECTION_ORIGIN and client_address[0] != CONNECTION_ORIGIN:
+      mobwrite_core.LOG.warning("Connection refused from " + client_address[0])
+      sock.close()
+      return
+    mobwrite_core.LOG.info("Connection accepted from " + client_address[0])
+    MobWriteChannel(self, sock)
+
+  def dispatch(self, channel, question):
+    (wait, question) = split_wait(question)
+    if wait:
+      actions = self.handler.parseRequest(question)
+      viewobjs = idle_views(actions)
+      if viewobjs is not None:
+        HeldRequest(self, channel, question, actions, viewobjs, wait)
+        return
+    self.submit(channel, question)
+
+  def submit(self, channel, question, held=None):
+    self.in_flight += 1
+    def done(answer):
+      self.in_flight -= 1
+      if channel.connected:
+        channel.answer(answer)
+    self.executor.submit(serve_request, (self.handler, question, held), done)
+
+  def serve_forever(self, poll_interval=0.5):
+    self.running = True
+    while self.running:
+      asyncore.loop(timeout=poll_interval, map=self.map, count=1)
+      now = time.time()
+      for channel in self.map.values():
+        if isinstance(channel, MobWriteChannel) and channel.stalled(now):
+          mobwrite_core.LOG.warning("Timeout on connection")
+          channel.close()
+      for request in list(self.held):
+        if request.deadline <= now:
+          request.release()
+    self.executor.shutdown()
+    for channel in self.map.values():
+      channel.close()
+
+  def shutdown(self):
+    # Stop serve_forever from another thread.
+    self.trigger.call(self.stop)
+
+  def stop(self):
+    self.running = False
+
+
 def cleanup_thread():
   # Every minute cleanup
   if STORAGE_MODE == BDB:
@@ -673,30 +1797,55 @@ def cleanup_thread():
 
   while True:
     cleanup()
+    mobwrite_core.LOG.info("Request stats: %s" % request_stats.report())
+    mobwrite_core.LOG.info("Diff stats: %s" % diff_stats.report())
+    mobwrite_core.LOG.info("Memory stats: %s" % memory_stats.report())
+    mobwrite_core.LOG.info("Phase times: %s" % phase_times.report())
     time.sleep(60)
 
 # Left at double initial indent to help diff
+# Number of seconds between sweeps of the FILE or BDB storage for texts that
+# have not been touched in TIMEOUT_TEXT.
+STORAGE_SWEEP = 60
+
+last_sweep = 0
+
 def cleanup():
-    mobwrite_core.LOG.info("Running cleanup task.")
-    for v in views.values():
-      v.cleanup()
-    for v in texts.values():
-      v.cleanup()
-    for v in buffers.values():
-      v.cleanup()
-
-    # Persist the remaining texts
-    for v in texts.values():
+    mobwrite_core.LOG.debug("Running cleanup task.")
+    # Expire the views, texts and buffers that are due.  A view that goes
+    # may make its text due at once.
+    now = mobwrite_core.monotonic()
+    due = expiry.due(now)
+    while due:
+      for v in due:
+        v.expire()
+      due = expiry.due(now)
+
+    # Persist the texts that have changed.
+    for v in take_dirty():
       v.lock.acquire()
-      v.save()
-      v.lock.release()
+      try:
+        try:
+          if v.changed:
+            v.save()
+        except:
+          mobwrite_core.LOG.exception("Can't save text: '%s'" % v.name)
+          mark_dirty(v)
+      finally:
+        v.lock.release()
 
-    timeout = datetime.datetime.now() - mobwrite_core.TIMEOUT_TEXT
+    evict_texts(now)
+
+    global last_sweep
+    if time.time() < last_sweep + STORAGE_SWEEP:
+      return
+    last_sweep = time.time()
+    timeout = time.time() - mobwrite_core.TIMEOUT_TEXT
     if STORAGE_MODE == FILE:
       # Delete old files.
       files = glob.glob("%s/*.txt" % DATA_DIR)
       for filename in files:
-        if datetime.datetime.fromtimestamp(os.path.getmtime(filename)) < timeout:
+        if os.path.getmtime(filename) < timeout:
           os.unlink(filename)
           mobwrite_core.LOG.info("Deleted file: '%s'" % filename)
 
@@ -705,7 +1854,7 @@ def cleanup():
       # Can't delete an entry in a hash while iterating or else order is lost.
       expired = []
       for k, v in lasttime_db.iteritems():
-        if datetime.datetime.fromtimestamp(int(v)) < timeout:
+        if int(v) < timeout:
           expired.append(k)
       for k in expired:
         if texts_db.has_key(k):
@@ -714,6 +1863,28 @@ def cleanup():
           del lasttime_db[k]
         mobwrite_core.LOG.info("Deleted from DB: '%s'" % k)
 
+def evict_texts(now):
+  # Unload the least recently used texts until the memory they hold is within
+  # MAX_MEMORY.  Texts in MEMORY storage have nowhere else to go.
+  if (MAX_MEMORY == 0 or STORAGE_MODE == MEMORY or
+      memory_stats.used <= MAX_MEMORY):
+    return
+  lru = []
+  for textobj in texts.values():
+    lasttime = textobj.lastused()
+    if lasttime < now - MEMORY_MIN_IDLE:
+      lru.append((lasttime, textobj.name, textobj))
+  lru.sort()
+  for (lasttime, name, textobj) in lru:
+    if memory_stats.used <= MAX_MEMORY:
+      break
+    if textobj.evict():
+      mobwrite_core.LOG.info("Evicted text: '%s'" % name)
+      memory_stats.evict()
+  if memory_stats.used > MAX_MEMORY:
+    mobwrite_core.LOG.warning("Over memory limit: %d > %d bytes" %
+        (memory_stats.used, MAX_MEMORY))
+
 last_cleanup = time.time()
 
 def maybe_cleanup():
@@ -724,7 +1895,19 @@ def maybe_cleanup():
     last_cleanup = now
 
 
+# Most projects that each thread of the Persister remembers.
+PERSISTER_CACHE_SIZE = 1000
+
+
 class Persister:
+  # Keeps texts in temp files in their Bespin projects.  Each thread
+  # remembers the projects it has looked up for c.access_cache.ttl seconds,
+  # or until sharing changes, so steady editing needs no database queries.
+  # The projects are not shared between threads because their database
+  # objects and metadata connections belong to the thread that made them.
+
+  def __init__(self):
+    self.local = threading.local()
 
   def load(self, name):
     project, path = self.check_access(name)
@@ -737,9 +1920,21 @@ class Persister:
     project.save_temp_file(path, contents)
 
   def check_access(self, name):
+    from bespin import config
     from bespin.database import User, get_project
     (user_name, project_name, path) = name.split("/", 2)
 
+    access_cache = config.c.access_cache
+    projects = self.local.__dict__.setdefault("projects", {})
+    key = (user_name, project_name)
+    now = time.time()
+    entry = projects.get(key)
+    if (entry is not None and entry[0] > now and
+        entry[1] == access_cache.generation):
+      return (entry[2], path)
+
+    # Sharing changes made during the lookup must not be cached.
+    generation = access_cache.generation
     user = User.find_user(user_name)
 
     parts = project_name.partition('+')
@@ -750,31 +1945,249 @@ class Persister:
       project_name = parts[2]
 
     project = get_project(user, owner, project_name)
+    if len(projects) >= PERSISTER_CACHE_SIZE:
+      projects.clear()
+    projects[key] = (now + access_cache.ttl, generation, project)
     return (project, path)
 
+  def close(self, name):
+    # Called when the text is unloaded.
+    pass
+
+
+def _text_md5(text):
+  if text is None:
+    text = ""
+  if isinstance(text, unicode):
+    text = text.encode("utf-8")
+  return hashlib.md5(text).hexdigest()
+
+
+def _unicode(text):
+  if text is None:
+    return u""
+  if isinstance(text, str):
+    return text.decode("utf-8", "replace")
+  return text
+
+
+class Journal:
+  # The journal of one text.
+
+  # Object properties:
+  # .text - The text as of the last record.
+  # .base - MD5 of the text as it was last written out in full.
+  # .size - Bytes in the journal file.
+  # .started - When the journal file was started, or None if there is none.
+
+  def __init__(self, text):
+    self.text = text
+    self.base = _text_md5(text)
+    self.size = 0
+    self.started = None
+
+
+class JournalPersister:
+  # Write-behind persistence for texts.  Instead of writing out the whole
+  # text on every save, append the change since the last save to a journal
+  # file, as a diff delta on one line.  The journal is folded into a full
+  # save of the text once it grows bigger than the text or older than
+  # JOURNAL_INTERVAL, and when the text is unloaded, so the bytes written
+  # follow the size of the edits rather than the size of the text.
+  #
+  # The journal starts with the MD5 of the text that its deltas apply to,
+  # followed by the name of the text.  The file itself is named after the
+  # MD5 of the text's name, since a deep path would exceed the limit on the
+  # length of a file name.  Loading a text replays its journal if the saved text still matches,
+  # which recovers the edits after a crash.  A journal that doesn't match
+  # was already folded into the saved text before the crash.
+
+  def __init__(self, persister, directory):
+    self.persister = persister
+    self.directory = directory
+    self.journals = {}
+    self.lock = thread.allocate_lock()
+
+  def filename(self, name):
+    return os.path.join(self.directory, _text_md5(name) + ".journal")
+
+  def header(self, name, journal):
+    if isinstance(name, unicode):
+      name = name.encode("utf-8")
+    return "base %s %s" % (journal.base, urllib.quote(name, ""))
+
+  def check_access(self, name):
+    return self.persister.check_access(name)
+
+  def load(self, name):
+    text = self.persister.load(name)
+    journal = Journal(text)
+    replayed = self.replay(name, journal)
+    self.lock.acquire()
+    self.journals[name] = journal
+    self.lock.release()
+    if replayed:
+      mobwrite_core.LOG.info("Replayed %d edits to '%s'" % (replayed, name))
+      self.compact(name, journal)
+    return journal.text
+
+  def replay(self, name, journal):
+    # Apply the journal left over from before a crash.  Returns the number
+    # of edits applied.
+    filename = self.filename(name)
+    if not os.path.exists(filename):
+      return 0
+    infile = open(filename, "r")
+    try:
+      lines = infile.read().split("\n")
+    finally:
+      infile.close()
+    # The last line is either empty or was cut off by the crash.
+    lines = lines[:-1]
+    if not lines or lines[0] != self.header(name, journal):
+      mobwrite_core.LOG.info("Discarding stale journal: '%s'" % name)
+      os.remove(filename)
+      return 0
+    text = _unicode(journal.text)
+    replayed = 0
+    for line in lines[1:]:
+      try:
+        diffs = mobwrite_core.DMP.diff_fromDelta(text, line)
+      except ValueError:
+        mobwrite_core.LOG.error("Bad journal entry for '%s'" % name)
+        break
+      text = mobwrite_core.DMP.diff_text2(diffs)
+      replayed += 1
+    journal.text = text
+    return replayed
+
+  def save(self, name, contents):
+    journal = self.journals.get(name)
+    if journal is None or contents is None:
+      # Not loaded through here, or nullified.
+      self.persister.save(name, contents)
+      if journal is not None:
+        journal.text = contents
+        journal.base = _text_md5(contents)
+        journal.started = None
+        self.compact(name, journal)
+      return
+    if _unicode(contents) == _unicode(journal.text):
+      return
+    diffs = mobwrite_core.diff(_unicode(journal.text), _unicode(contents))
+    line = mobwrite_core.DMP.diff_toDelta(diffs) + "\n"
+    filename = self.filename(name)
+    if journal.started is None:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      line = "%s\n%s" % (self.header(name, journal), line)
+      journal.started = time.time()
+      outfile = open(filename, "w")
+    else:
+      outfile = open(filename, "a")
+    try:
+      outfile.write(line)
+    finally:
+      outfile.close()
+    journal.text = contents
+    journal.size += len(line)
+    if (journal.size >= max(JOURNAL_MIN_BYTES, len(contents)) or
+        journal.started < time.time() - JOURNAL_INTERVAL):
+      self.compact(name, journal)
+
+  def compact(self, name, journal):
+    # Write the text out in full and drop the journal.
+    if journal.started is not None or journal.base != _text_md5(journal.text):
+      self.persister.save(name, journal.text)
+      journal.base = _text_md5(journal.text)
+    filename = self.filename(name)
+    if os.path.exists(filename):
+      os.remove(filename)
+    journal.size = 0
+    journal.started = None
+
+  def close(self, name):
+    self.lock.acquire()
+    journal = self.journals.pop(name, None)
+    self.lock.release()
+    if journal is not None:
+      self.compact(name, journal)
+    self.persister.close(name)
+
+
+def make_server(address, persister):
+  # Create the server for SERVER_MODE.  Either kind has serve_forever() and
+  # shutdown() methods.
+  if SERVER_MODE == EVENT_LOOP:
+    return EventLoopServer(address, persister)
+  SocketServer.ThreadingTCPServer.allow_reuse_address = True
+  server = SocketServer.ThreadingTCPServer(address, handler_class(persister))
+  server.daemon_threads = True
+  return server
+
+
+def main(shard=None):
+  # With a shard number, listen on LOCAL_PORT + shard and keep the BDB
+  # files apart from the other shards'.
+  port = LOCAL_PORT
+  suffix = ""
+  if shard is not None:
+    port += shard
+    suffix = "-%d" % shard
 
-def main():
   if STORAGE_MODE == BDB:
     import bsddb
     global texts_db, lasttime_db
-    texts_db = bsddb.hashopen(DATA_DIR + "/texts.db")
-    lasttime_db = bsddb.hashopen(DATA_DIR + "/lasttime.db")
+    texts_db = bsddb.hashopen(DATA_DIR + "/texts%s.db" % suffix)
+    lasttime_db = bsddb.hashopen(DATA_DIR + "/lasttime%s.db" % suffix)
 
   # Start up a thread that does timeouts and cleanup
   thread.start_new_thread(cleanup_thread, ())
 
-  mobwrite_core.LOG.info("Listening on port %d..." % LOCAL_PORT)
-  s = SocketServer.ThreadingTCPServer(("", LOCAL_PORT), DaemonMobWrite)
+  persister = Persister()
+  if JOURNAL_DIR:
+    persister = JournalPersister(persister, JOURNAL_DIR + suffix)
+
+  mobwrite_core.LOG.info("Listening on port %d..." % port)
+  s = make_server(("", port), persister)
   try:
     s.serve_forever()
   except KeyboardInterrupt:
     mobwrite_core.LOG.info("Shutting down.")
+    mobwrite_core.LOG.info("Request stats: %s" % request_stats.report())
+    mobwrite_core.LOG.info("Diff stats: %s" % diff_stats.report())
+    mobwrite_core.LOG.info("Memory stats: %s" % memory_stats.report())
+    mobwrite_core.LOG.info("Phase times: %s" % phase_times.report())
     s.socket.close()
     if STORAGE_MODE == BDB:
       texts_db.close()
       lasttime_db.close()
 
 
+def main_shards(shards):
+  # Run one daemon process per shard.  The web tier sends each document to
+  # the shard that owns it, so the processes share nothing and the diff work
+  # spreads over as many cores.
+  children = []
+  for shard in xrange(shards):
+    pid = os.fork()
+    if pid == 0:
+      try:
+        main(shard)
+      finally:
+        os._exit(0)
+    children.append(pid)
+  while children:
+    try:
+      (pid, status) = os.wait()
+    except KeyboardInterrupt:
+      # The children get the interrupt too.
+      continue
+    except OSError:
+      break
+    children.remove(pid)
+
+
 if __name__ == "__main__":
   mobwrite_core.logging.basicConfig()
   main()
@@ -0,0 +1,242 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+
+"""Talks to a mobwrite daemon over framed, keep-alive connections.
+
+Each request is written as its length on a line of its own followed
+by the request, and the daemon answers the same way. The connection
+then stays open, so ConnectionPool keeps the idle ones around for the
+next request instead of setting up a new TCP connection every time.
+
+The collaboration state can be spread over several daemon processes,
+each owning the documents that a ShardRing maps to it. ShardedPool
+splits a request by document, sends each part to the daemon that owns
+it and merges the answers. A request that carries a fragment of a
+buffered request is first sent to the daemon that the buffer's name
+maps to, which only assembles it. The assembled request is then split
+by document like any other.
+"""
+
+import bisect
+import socket
+import threading
+from hashlib import md5
+
+class MobwriteError(IOError):
+    pass
+
+class ConnectionPool(object):
+    """Keeps up to size idle connections to the daemon at address,
+    which any number of threads can share."""
+    def __init__(self, address, size, timeout=30):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = []
+        self.connects = 0
+
+    def request(self, question):
+        """Sends question to the daemon and returns its answer."""
+        conn = self._get()
+        reused = conn is not None
+        if not reused:
+            conn = self._connect()
+        try:
+            answer = self._exchange(conn, question)
+        except (socket.error, MobwriteError):
+            self._close(conn)
+            if not reused:
+                raise
+            # the daemon may have closed the connection while it was
+            # idle, try again on a new one
+            conn = self._connect()
+            try:
+                answer = self._exchange(conn, question)
+            except:
+                self._close(conn)
+                raise
+        self._put(conn)
+        return answer
+
+    def close(self):
+        """Closes all of the idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            self._close(conn)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        self._lock.acquire()
+        self.connects += 1
+        self._lock.release()
+        return (sock, sock.makefile("rb"))
+
+    def _exchange(self, conn, question):
+        sock, rfile = conn
+        sock.sendall("%d\n%s" % (len(question), question))
+        line = rfile.readline()
+        if not line:
+            raise MobwriteError("mobwrite daemon closed the connection")
+        length = line.rstrip("\r\n")
+        if not length.isdigit():
+            raise MobwriteError("Bad answer from mobwrite daemon: %r" % line)
+        size = int(length)
+        answer = rfile.read(size)
+        if len(answer) < size:
+            raise MobwriteError("mobwrite daemon closed the connection")
+        return answer
+
+    def _get(self):
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def _put(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        self._close(conn)
+
+    def _close(self, conn):
+        sock, rfile = conn
+        rfile.close()
+        sock.close()
+
+def _hash(name):
+    return int(md5(name).hexdigest()[:8], 16)
+
+class ShardRing(object):
+    """Consistent hash of document names onto shards 0 to shards-1.
+    Every shard has replicas points on the ring, so adding a shard
+    only moves the documents that the new shard takes over."""
+    def __init__(self, shards, replicas=64):
+        points = sorted((_hash("%s-%s" % (shard, replica)), shard)
+                        for shard in range(shards)
+                        for replica in range(replicas))
+        self._keys = [key for key, shard in points]
+        self._shards = [shard for key, shard in points]
+
+    def shard(self, name):
+        """Returns the shard that owns the document called name."""
+        index = bisect.bisect(self._keys, _hash(name)) % len(self._keys)
+        return self._shards[index]
+
+def buffer_name(question):
+    """Returns the name of the buffer that question carries a fragment
+    of, or None if it carries none."""
+    for line in question.splitlines():
+        if not line:
+            break
+        if line[:2] in ("b:", "B:"):
+            return line[2:].split(" ", 1)[0]
+    return None
+
+def split_request(question, shard_for):
+    """Splits a mobwrite request into one request per shard.
+
+    shard_for is called with each document name and returns its shard.
+    The user and handle lines in effect are repeated in front of every
+    document's commands. Returns a list of (shard, request) in the
+    order that the shards first appear.
+
+    Buffer commands carry fragments of a request, which has to be
+    assembled (see ShardedPool) before it can be split. They are left
+    out here.
+
+    A request that asks to be held with a leading "W:" line is only held
+    if all of its documents are on one shard, it would otherwise wait
+    on each shard in turn."""
+    wait = None
+    if question.startswith("W:"):
+        wait, question = question.split("\n", 1)
+    headers = {}
+    requests = {}
+    order = []
+    lines = None
+    for line in question.splitlines():
+        if not line:
+            break
+        name = line[:1]
+        if line.find(":") != 1:
+            continue
+        if name in "bB":
+            continue
+        if name in "uUhH":
+            headers[name.lower()] = line
+        elif name in "fFnN":
+            filename = line[2:]
+            if name in "fF":
+                filename = filename.partition(":")[2]
+            shard = shard_for(filename)
+            lines = requests.get(shard)
+            if lines is None:
+                lines = requests[shard] = []
+                order.append(shard)
+            lines.extend(headers[key] for key in "uh" if key in headers)
+            lines.append(line)
+        elif lines is not None:
+            lines.append(line)
+    if wait is not None and len(order) == 1:
+        requests[order[0]].insert(0, wait)
+    return [(shard, "\n".join(requests[shard]) + "\n\n")
+            for shard in order]
+
+class ShardedPool(object):
+    """Sends requests to the daemons that own their documents, through
+    one ConnectionPool per daemon."""
+    def __init__(self, pools, replicas=64):
+        self.pools = pools
+        self.ring = ShardRing(len(pools), replicas)
+
+    def request(self, question):
+        """Sends question to the daemons and returns the merged answer."""
+        name = buffer_name(question)
+        if name is not None:
+            # every fragment goes to the daemon that holds the buffer,
+            # which hands back the request once it is complete
+            question = self.pools[self.ring.shard(name)].request(
+                "A:\n" + question)
+            if not question:
+                return ""
+        parts = split_request(question, self.ring.shard)
+        return "".join(self.pools[shard].request(part)
+                       for shard, part in parts)
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
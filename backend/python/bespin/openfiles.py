@@ -0,0 +1,256 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Keeps track of which users have which files open.
+
+Projects are identified by a key that is unique across users
+(Project.full_name) and files by their path within the project.
+Each open file is one entry, so opening and closing a file does not
+depend on how many other files are open, and the entries can be
+looked up by (project, path) or by user.
+
+MemoryOpenFiles is for a single server process. SQLiteOpenFiles keeps
+the entries in a sqlite database that any number of server processes
+can share. It takes a shared lock from a bespin.locks manager to read
+and an exclusive one to write, so that writers wait for each other in
+the lock manager rather than in sqlite's busy handler, which sleeps
+and retries.
+"""
+
+import threading
+import sqlite3
+
+from bespin import locks as locks_module
+
+class MemoryOpenFiles(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (project, path) -> {username: mode}
+        self._files = {}
+        # project -> set of paths with entries
+        self._projects = {}
+        # project -> name of the project, as used by User.files
+        self._project_names = {}
+        # username -> set of (project, path)
+        self._users = {}
+
+    def opened(self, project, project_name, path, username, mode):
+        """Records that username has the file at path open."""
+        self._lock.acquire()
+        try:
+            key = (project, path)
+            self._files.setdefault(key, {})[username] = mode
+            self._projects.setdefault(project, set()).add(path)
+            self._project_names[project] = project_name
+            self._users.setdefault(username, set()).add(key)
+        finally:
+            self._lock.release()
+
+    def closed(self, project, path, username):
+        """Records that username no longer has the file open."""
+        self._lock.acquire()
+        try:
+            self._remove(project, path, username)
+        finally:
+            self._lock.release()
+
+    def _remove(self, project, path, username):
+        key = (project, path)
+        file_users = self._files.get(key)
+        if not file_users or username not in file_users:
+            return
+        del file_users[username]
+        if not file_users:
+            del self._files[key]
+            paths = self._projects[project]
+            paths.discard(path)
+            if not paths:
+                del self._projects[project]
+                del self._project_names[project]
+        keys = self._users[username]
+        keys.discard(key)
+        if not keys:
+            del self._users[username]
+
+    def users(self, project, path):
+        """Returns a dictionary of the users with the file open and
+        their modes."""
+        self._lock.acquire()
+        try:
+            return dict(self._files.get((project, path), {}))
+        finally:
+            self._lock.release()
+
+    def project_files(self, project):
+        """Returns a dictionary of the open files in the project, with
+        the values being dictionaries of users and modes."""
+        self._lock.acquire()
+        try:
+            return dict((path, dict(self._files[(project, path)]))
+                        for path in self._projects.get(project, ()))
+        finally:
+            self._lock.release()
+
+    def user_files(self, username):
+        """Returns the files that the user has open, in the form::
+
+            {'project' : {'path/to/file' : {'mode' : 'rw'}}}
+        """
+        self._lock.acquire()
+        try:
+            result = {}
+            for project, path in self._users.get(username, ()):
+                project_name = self._project_names[project]
+                mode = self._files[(project, path)][username]
+                result.setdefault(project_name, {})[path] = dict(mode=mode)
+            return result
+        finally:
+            self._lock.release()
+
+    def forget_project(self, project):
+        """Drops the entries for a project that has been deleted."""
+        self._lock.acquire()
+        try:
+            for path in list(self._projects.get(project, ())):
+                for username in list(self._files[(project, path)]):
+                    self._remove(project, path, username)
+        finally:
+            self._lock.release()
+
+    def rename_project(self, project, new_project, new_name):
+        """Moves the entries of a project that has been renamed."""
+        self._lock.acquire()
+        try:
+            moved = []
+            for path in list(self._projects.get(project, ())):
+                for username, mode in self._files[(project, path)].items():
+                    moved.append((path, username, mode))
+                    self._remove(project, path, username)
+        finally:
+            self._lock.release()
+        for path, username, mode in moved:
+            self.opened(new_project, new_name, path, username, mode)
+
+class SQLiteOpenFiles(object):
+    def __init__(self, filename, locks=None):
+        self.filename = filename
+        if locks is None:
+            locks = locks_module.ThreadLocks()
+        self.locks = locks
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """The connection for the current thread."""
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(self.filename, timeout=30)
+        lock = self.locks.exclusive(self.filename)
+        try:
+            conn.execute("""create table if not exists open_files (
+                project text not null, project_name text not null,
+                path text not null, username text not null, mode text,
+                primary key (project, path, username))""")
+            conn.execute("""create index if not exists open_files_username
+                on open_files (username)""")
+            conn.commit()
+        finally:
+            lock.release()
+        self._local.connection = conn
+        return conn
+
+    def _execute(self, query, params):
+        conn = self.connection
+        lock = self.locks.exclusive(self.filename)
+        try:
+            try:
+                conn.execute(query, params)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        finally:
+            lock.release()
+
+    def _select(self, query, params):
+        c = self.connection.cursor()
+        lock = self.locks.shared(self.filename)
+        try:
+            c.execute(query, params)
+            rows = c.fetchall()
+        finally:
+            lock.release()
+            c.close()
+        return rows
+
+    def opened(self, project, project_name, path, username, mode):
+        """Records that username has the file at path open."""
+        self._execute("""insert or replace into open_files
+            (project, project_name, path, username, mode)
+            values (?, ?, ?, ?, ?)""",
+            (project, project_name, path, username, mode))
+
+    def closed(self, project, path, username):
+        """Records that username no longer has the file open."""
+        self._execute("""delete from open_files
+            where project=? and path=? and username=?""",
+            (project, path, username))
+
+    def users(self, project, path):
+        """Returns a dictionary of the users with the file open and
+        their modes."""
+        return dict(self._select("""select username, mode from open_files
+            where project=? and path=?""", (project, path)))
+
+    def project_files(self, project):
+        """Returns a dictionary of the open files in the project, with
+        the values being dictionaries of users and modes."""
+        result = {}
+        for path, username, mode in self._select("""select path,
+                username, mode from open_files where project=?""",
+                (project,)):
+            result.setdefault(path, {})[username] = mode
+        return result
+
+    def user_files(self, username):
+        """Returns the files that the user has open, in the form::
+
+            {'project' : {'path/to/file' : {'mode' : 'rw'}}}
+        """
+        result = {}
+        for project_name, path, mode in self._select("""select
+                project_name, path, mode from open_files
+                where username=?""", (username,)):
+            result.setdefault(project_name, {})[path] = dict(mode=mode)
+        return result
+
+    def forget_project(self, project):
+        """Drops the entries for a project that has been deleted."""
+        self._execute("delete from open_files where project=?", (project,))
+
+    def rename_project(self, project, new_project, new_name):
+        """Moves the entries of a project that has been renamed."""
+        self._execute("""update or replace open_files
+            set project=?, project_name=? where project=?""",
+            (new_project, new_name, project))
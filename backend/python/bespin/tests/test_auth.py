@@ -25,4 +25,32 @@ def test_login_success():
     fli = tracker.can_log_in("foo")
     assert fli.can_log_in
     assert fli.failed_attempts == 0
-    
\ No newline at end of file
+    
+def test_access_cache_drops_answers_looked_up_before_an_invalidate():
+    cache = auth.AccessCache(60)
+    generation = cache.generation
+    cache.invalidate()
+    cache.set("key", True, generation)
+    assert cache.get("key") is None
+    cache.set("key", False, cache.generation)
+    assert cache.get("key") is False
+
+class _Session(object):
+    pass
+
+def test_access_cache_is_invalidated_again_when_the_session_ends():
+    cache = auth.AccessCache(60)
+    extension = auth.AccessCacheExtension(cache)
+    session = _Session()
+    cache.invalidate(session)
+    # another session reads the old rows before the change is committed
+    cache.set("key", True, cache.generation)
+    assert cache.get("key") is True
+    extension.after_commit(session)
+    assert cache.get("key") is None
+
+    # only sessions that changed access invalidate the cache
+    cache.set("key", True, cache.generation)
+    extension.after_commit(session)
+    extension.after_rollback(_Session())
+    assert cache.get("key") is True
@@ -27,7 +27,8 @@
 
 import simplejson
 from bespin import config, controllers
-from bespin.filesystem import get_project
+from bespin.filesystem import get_project, NotAuthorized
+from bespin.mobwrite import mobwrite_daemon
 from bespin.database import User, Base, ConflictError
 
 from nose.tools import assert_equals
@@ -277,6 +278,81 @@ def test_sharing():
 
     joes_project.delete()
 
+def test_sharing_changes_reach_the_access_cache():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    key = (joe.uuid, "joes_project", ev.uuid)
+
+    assert not joe.is_project_shared(joes_project, ev)
+    assert_equals(config.c.access_cache.get(key), False)
+
+    joe.add_sharing(joes_project, ev, False, False)
+    assert_equals(config.c.access_cache.get(key), None)
+    assert joe.is_project_shared("joes_project", ev)
+    assert_equals(config.c.access_cache.get(key), True)
+
+    homies = joe.get_group("homies", create_on_not_found=True)
+    homies.add_member(tom)
+    joe.add_sharing(joes_project, homies, False, False)
+    assert joe.is_project_shared("joes_project", tom)
+    homies.remove_member(tom)
+    assert not joe.is_project_shared("joes_project", tom)
+
+    joe.remove_sharing(joes_project, ev)
+    assert not joe.is_project_shared("joes_project", ev)
+
+def test_revoked_sharing_is_seen_at_once():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    joe.add_sharing(joes_project, ev, True, False)
+    session.commit()
+    assert joe.is_project_shared("joes_project", ev)
+
+    persister = mobwrite_daemon.Persister()
+    project, path = persister.check_access("ev/joe+joes_project/foo.txt")
+    assert_equals(project.name, "joes_project")
+
+    joe.remove_sharing(joes_project, ev)
+    session.commit()
+    assert not joe.is_project_shared("joes_project", ev)
+    try:
+        persister.check_access("ev/joe+joes_project/foo.txt")
+        assert False, "Expected NotAuthorized"
+    except NotAuthorized:
+        pass
+
+    # a check that was under way when sharing was revoked is not cached
+    joe.add_sharing(joes_project, ev, True, False)
+    session.commit()
+    check = User._check_project_shared
+    def racing_check(self, project, user):
+        result = check(self, project, user)
+        joe.remove_sharing(joes_project, ev)
+        session.commit()
+        return result
+    User._check_project_shared = racing_check
+    try:
+        assert joe.is_project_shared("joes_project", ev)
+    finally:
+        User._check_project_shared = check
+    assert not joe.is_project_shared("joes_project", ev)
+
+# Mobwrite tests
+def test_mobwrite_advertises_long_polling():
+    _reset()
+    environ = dict(REMOTE_ADDR="127.0.0.1")
+    response = app.post("/mobwrite/", "q=u%3Ajoe%0A", extra_environ=environ)
+    assert "X-Mobwrite-Long-Poll" not in response.headers
+
+    old_long_poll = config.c.mobwrite_long_poll
+    config.c.mobwrite_long_poll = 25
+    try:
+        response = app.post("/mobwrite/", "q=u%3Ajoe%0A",
+                            extra_environ=environ)
+    finally:
+        config.c.mobwrite_long_poll = old_long_poll
+    assert_equals(response.headers["X-Mobwrite-Long-Poll"], "25")
+
 # Sharing tests
 def test_sharing_with_app():
     _reset()
@@ -0,0 +1,75 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License
+# Version
+# 1.1 (the "License"); you may not use this file except in compliance
+# with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+import random
+import time
+
+from bespin.mobwrite import benchmark
+from bespin.mobwrite.diff_match_patch import diff_match_patch
+
+from nose.tools import assert_equals
+
+def test_bisect_finds_the_middle_snake():
+    dmp = diff_match_patch()
+    assert_equals(dmp.diff_bisect(u"cat", u"map", time.time() + 60),
+                  [(-1, u"c"), (1, u"m"), (0, u"a"), (-1, u"t"), (1, u"p")])
+    # out of time, so replace the lot
+    assert_equals(dmp.diff_bisect(u"cat", u"map", 0),
+                  [(-1, u"cat"), (1, u"map")])
+
+def test_diffs_of_source_edits_are_minimal():
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = 0
+    rnd = random.Random(1)
+    lines = benchmark.source_file(200, rnd)
+    text1 = u"".join(lines)
+    text2 = u"".join(["  " + line for line in lines[50:60]])
+    text2 = u"".join(lines[:50]) + text2 + u"".join(lines[60:])
+    diffs = dmp.diff_main(text1, text2, False)
+    assert_equals(dmp.diff_text1(diffs), text1)
+    assert_equals(dmp.diff_text2(diffs), text2)
+    assert_equals(dmp.diff_levenshtein(diffs), 20)
+
+def test_timeout_covers_the_whole_diff():
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = 0.05
+    rnd = random.Random(2)
+    text1 = u"".join(benchmark.source_file(2000, rnd))
+    text2 = u"".join(benchmark.source_file(2000, rnd))
+    start = time.time()
+    diffs = dmp.diff_main(text1, text2)
+    # the line diff and every character rediff share the one deadline
+    assert time.time() - start < 0.5
+    assert_equals(dmp.diff_text1(diffs), text1)
+    assert_equals(dmp.diff_text2(diffs), text2)
+
+def test_diff_benchmark():
+    results = benchmark.diff_benchmark(lines=100)
+    assert_equals(len(results), 3 * len(benchmark.EDITS))
+    for result in results:
+        assert result["map_edits"] > 0
+        assert result["bisect_edits"] > 0
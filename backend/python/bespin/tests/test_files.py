@@ -24,6 +24,7 @@
 # 
 
 import os
+import time
 from datetime import datetime, timedelta
 from urllib import urlencode
 
@@ -135,6 +136,48 @@ def test_cannot_save_beyond_quota():
     finally:
         filesystem.QUOTA_UNITS = old_units
         
+def test_save_files_in_one_batch():
+    _init_data()
+    starting_point = macgyver.amount_used
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    saved = bigmac.save_files([("foo/bar", "biz"), ("README", "read me"),
+                               ("foo/bar", "bizbiz")])
+    assert [f.name for f in saved] == ["foo/bar", "README", "foo/bar"]
+    assert macgyver.amount_used == starting_point + 13
+    assert sorted(bigmac.search_files("")) == ["README", "foo/bar"]
+    assert bigmac.update_manifest() == 0
+
+def test_save_files_with_writer_threads():
+    _init_data()
+    starting_point = macgyver.amount_used
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    files = [("dir%s/file%s" % (i % 3, i), "x" * i) for i in range(20)]
+    files.append(("dir1/file1", "last copy wins"))
+    saved = bigmac.save_files(files, writers=4)
+    assert len(saved) == 21
+    assert macgyver.amount_used == starting_point + 189 + 14
+    assert len(bigmac.search_files("file")) == 20
+    assert bigmac.get_file("dir1/file1") == "last copy wins"
+    bigmac.close("dir1/file1")
+    assert bigmac.update_manifest() == 0
+
+def test_save_files_quota_counts_the_whole_batch():
+    _init_data()
+    old_units = filesystem.QUOTA_UNITS
+    filesystem.QUOTA_UNITS = 1
+    macgyver.quota = macgyver.amount_used + 10
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    try:
+        bigmac.save_files([("foo", "x" * 6), ("bar", "x" * 6)])
+        assert False, "Expected an OverQuota exception"
+    except OverQuota:
+        pass
+    finally:
+        filesystem.QUOTA_UNITS = old_units
+    # the file saved before the failure is still accounted for
+    assert bigmac.search_files("") == ["foo"]
+    assert bigmac.update_manifest() == 0
+
 def test_amount_used_can_be_recomputed():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -146,6 +189,79 @@ def test_amount_used_can_be_recomputed():
     macgyver.recompute_files()
     assert macgyver.amount_used == starting_point
     
+def test_rescan_only_lists_changed_directories():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar/baz", "biz")
+    bigmac.save_file("README", "read me")
+    # age the directories so that the scan trusts their mtimes
+    old = time.time() - 100
+    for d in ["", "foo", "foo/bar"]:
+        os.utime(bigmac.location / d, (old, old))
+    bigmac.scan_files()
+
+    known_dirs, known_files = bigmac.metadata.manifest_get()
+    assert sorted(known_files.keys()) == ["README", "foo/bar/baz"]
+    changes = filesystem._scan_changes(bigmac.location, known_dirs,
+                                       known_files)
+    assert changes == ({}, [], {}, [])
+
+    # change things behind Bespin's back
+    (bigmac.location / "foo" / "new.txt").write_bytes("12345")
+    (bigmac.location / "README").remove()
+    dirs, removed_dirs, files, removed_files = filesystem._scan_changes(
+                            bigmac.location, known_dirs, known_files)
+    assert sorted(dirs.keys()) == ["", "foo"]
+    assert files.keys() == ["foo/new.txt"]
+    assert removed_files == ["README"]
+
+    assert bigmac.update_manifest() == -2
+    assert bigmac.search_files("new") == ["foo/new.txt"]
+    assert bigmac.search_files("README") == []
+    assert bigmac.scan_files() == 8
+
+def test_saved_files_are_not_counted_again_by_a_rescan():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "biz")
+    bigmac.update_manifest()
+    bigmac.save_file("foo/baz", "12345")
+    bigmac.save_file("foo/bar", "bizbiz")
+    bigmac.delete("foo/bar")
+    assert bigmac.update_manifest() == 0
+    assert bigmac.search_files("ba") == ["foo/baz"]
+
+def test_first_rescan_counts_files_added_outside_bespin():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/saved", "12345")
+    bigmac.save_file("foo/gone", "123")
+    # a clone or an import writes straight to disk
+    (bigmac.location / "foo" / "cloned").write_bytes("x" * 100)
+    (bigmac.location / "lib").mkdir()
+    (bigmac.location / "lib" / "mod.py").write_bytes("y" * 20)
+    (bigmac.location / "foo" / "gone").remove()
+    assert bigmac.update_manifest() == 117
+    assert bigmac.update_manifest() == 0
+    assert sorted(bigmac.search_files("")) == ["foo/cloned", "foo/saved",
+                                               "lib/mod.py"]
+
+def test_deleting_a_directory_keeps_its_neighbours_in_the_manifest():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/a.txt", "a")
+    bigmac.save_file("foobar.txt", "x" * 1000)
+    bigmac.save_file("Foo2/c.txt", "c" * 50)
+    bigmac.save_file("foo_1/d.txt", "d")
+    bigmac.update_manifest()
+    bigmac.delete("foo/")
+    assert bigmac.update_manifest() == 0
+    known_dirs, known_files = bigmac.metadata.manifest_get()
+    assert sorted(known_files) == ["Foo2/c.txt", "foo_1/d.txt", "foobar.txt"]
+    assert "Foo2" in known_dirs
+    assert sorted(bigmac.search_files("txt")) == ["Foo2/c.txt",
+                                                  "foo_1/d.txt", "foobar.txt"]
+
 def test_retrieve_file_obj():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -372,6 +488,28 @@ def test_list_top_level():
                             "SampleProject", "bigmac"]
     
     
+def test_list_files_looks_up_open_files_once():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "biz")
+    bigmac.save_file("readme.txt", "Hi there!")
+    bigmac.save_file("other.txt", "Hi")
+    bigmac.get_file_object("readme.txt").mark_opened(macgyver, "rw")
+    bigmac.get_file_object("foo/bar").mark_opened(someone_else, "r")
+
+    result = bigmac.list_files()
+    assert [item.name for item in result] == ["foo/", "other.txt",
+                                              "readme.txt"]
+    # the listing already knows the sizes
+    assert result[2]._info['size'] == 9
+    open_files = bigmac.open_files()
+    assert open_files["readme.txt"] == result[2].users
+
+    resp = app.get("/file/list/bigmac/")
+    data = simplejson.loads(resp.body)
+    assert [item.get('openedBy') for item in data] == [None, [],
+                                                       ["MacGyver"]]
+
 def test_filesystem_can_be_arranged_in_levels():
     config.c.fslevels = 0
     _init_data()
@@ -555,6 +693,49 @@ def _run_search_tests(search_func):
     result = search_func(u'ø')
     assert result == []
 
+def test_search_index_follows_file_changes():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/noodle.py", "hi")
+    bigmac.save_file("foo/nod.py", "hi")
+    bigmac.save_file("bar/Node.js", "hi")
+    # the index only narrows things down to files with all of the
+    # characters, the order still matters
+    assert bigmac.search_files("ood") == ["foo/noodle.py"]
+    assert bigmac.search_files("don") == []
+    assert bigmac.search_files("node") == ["bar/Node.js", "foo/noodle.py"]
+
+    bigmac.delete("foo/noodle.py")
+    assert bigmac.search_files("node") == ["bar/Node.js"]
+    bigmac.delete("bar/")
+    assert bigmac.search_files("nod") == ["foo/nod.py"]
+
+    bigmac.metadata.cache_replace(["baz/oodles.txt"])
+    assert bigmac.search_files("ood") == ["baz/oodles.txt"]
+    assert bigmac.search_files("nod") == []
+
+def test_search_looks_up_files_containing_the_query_by_trigram():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    for name in ["lib/node1.js", "lib/Node2.js", "foo/noodle.py",
+                 "foo/ode_to_n.txt", "foo/readme"]:
+        bigmac.save_file(name, "hi")
+    metadata = bigmac.metadata
+    c = metadata.connection.cursor()
+    candidates = metadata._search_candidates(c, set(["nod", "ode"]))
+    c.close()
+    assert sorted(candidates) == ["lib/Node2.js", "lib/node1.js"]
+
+    # with enough files containing the query, no others are looked at
+    assert sorted(metadata.search_files("node", 2)) == ["lib/Node2.js",
+                                                       "lib/node1.js"]
+    assert bigmac.search_files("node", 2) == ["lib/Node2.js", "lib/node1.js"]
+    # otherwise the characters in order are enough
+    assert sorted(metadata.search_files("node", 3)) == ["foo/noodle.py",
+                                        "lib/Node2.js", "lib/node1.js"]
+    assert bigmac.search_files("node") == ["lib/Node2.js", "lib/node1.js",
+                                           "foo/noodle.py"]
+
 def test_project_rename_should_be_secure():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -671,6 +852,44 @@ def test_get_file_stats_from_web():
     data = simplejson.loads(resp.body)
     assert data['size'] == 19
     
+def test_conditional_get_of_files():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("README.txt", "This is the readme file.")
+
+    for url in ["/file/at/bigmac/README.txt",
+                "/preview/at/bigmac/README.txt"]:
+        resp = app.get(url)
+        assert resp.body == "This is the readme file."
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        resp = app.get(url, headers={'If-None-Match': etag}, status=304)
+        assert resp.body == ""
+        resp = app.get(url, headers={'If-Modified-Since': last_modified},
+                       status=304)
+
+    # a changed file has a new ETag
+    later = time.time() + 10
+    os.utime(bigmac.location / "README.txt", (later, later))
+    resp = app.get("/file/at/bigmac/README.txt",
+                   headers={'If-None-Match': etag})
+    assert resp.body == "This is the readme file."
+    assert resp.headers['ETag'] != etag
+
+def test_files_are_sent_with_the_file_wrapper():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("README.txt", "This is the readme file.")
+    wrapped = []
+    def file_wrapper(fileobj, block_size):
+        wrapped.append(fileobj)
+        return iter(lambda: fileobj.read(block_size), "")
+    resp = app.get("/file/at/bigmac/README.txt",
+                   extra_environ={'wsgi.file_wrapper': file_wrapper})
+    assert resp.body == "This is the readme file."
+    assert len(wrapped) == 1
+
 def test_preview_mode():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
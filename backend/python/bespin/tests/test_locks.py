@@ -0,0 +1,104 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License
+# Version
+# 1.1 (the "License"); you may not use this file except in compliance
+# with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+import os
+import time
+import threading
+import tempfile
+
+from bespin import locks
+
+def _hold(manager, name, exclusive, events, seconds=0.2):
+    if exclusive:
+        lock = manager.exclusive(name)
+    else:
+        lock = manager.shared(name)
+    events.append("got")
+    time.sleep(seconds)
+    events.append("released")
+    lock.release()
+
+def _check_readers_share_and_writers_wait(manager, name):
+    events = []
+    lock = manager.shared(name)
+    reader = threading.Thread(target=_hold,
+                              args=(manager, name, False, events))
+    reader.start()
+    reader.join(1)
+    # the second reader did not have to wait for the first
+    assert events == ["got", "released"]
+
+    writer = threading.Thread(target=_hold,
+                              args=(manager, name, True, events, 0))
+    writer.start()
+    time.sleep(0.1)
+    assert events == ["got", "released"]
+    lock.release()
+    writer.join(1)
+    assert events == ["got", "released", "got", "released"]
+
+    stats = manager.stats()
+    assert stats['locks_acquired'] == 3
+    assert stats['locks_contended'] == 1
+    assert stats['locks_wait_ms'] >= 50
+
+def test_thread_locks():
+    _check_readers_share_and_writers_wait(locks.ThreadLocks(), "foo")
+
+def test_flock_locks():
+    name = tempfile.mktemp()
+    try:
+        _check_readers_share_and_writers_wait(locks.FlockLocks(), name)
+    finally:
+        os.remove(name + ".lock")
+
+def test_flock_locks_work_across_processes():
+    name = tempfile.mktemp()
+    manager = locks.FlockLocks()
+    lock = manager.exclusive(name)
+    pid = os.fork()
+    if not pid:
+        # the child waits for the parent's lock
+        child_lock = locks.FlockLocks().exclusive(name)
+        child_lock.release()
+        os._exit(0)
+    time.sleep(0.2)
+    assert os.waitpid(pid, os.WNOHANG) == (0, 0)
+    lock.release()
+    assert os.waitpid(pid, 0)[1] == 0
+    os.remove(name + ".lock")
+
+def test_releasing_twice_is_an_error():
+    manager = locks.ThreadLocks()
+    lock = manager.exclusive("foo")
+    lock.release()
+    try:
+        lock.release()
+        assert False, "Expected a LockError"
+    except locks.LockError:
+        pass
+    assert manager._locks == {}
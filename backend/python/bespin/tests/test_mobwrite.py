@@ -0,0 +1,869 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+# 
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+# 
+# The Original Code is Bespin.
+# 
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+# 
+# Contributor(s):
+# 
+# ***** END LICENSE BLOCK *****
+# 
+
+import os
+import urllib
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from bespin import config, mobwriteclient
+from bespin.database import User, Base
+from bespin.filesystem import get_project, NotAuthorized
+from bespin.mobwrite import benchmark, loadgen, mobwrite_daemon, mobwrite_core
+
+from nose.tools import assert_equals
+
+macgyver = None
+
+class _Persister(mobwrite_daemon.Persister):
+    # the test database lives in memory and is not visible to the
+    # server's threads, so look the project up without it
+    def check_access(self, name):
+        (user_name, project_name, path) = name.split("/", 2)
+        return (get_project(macgyver, macgyver, project_name), path)
+
+def setup_module(module):
+    config.set_profile("test")
+
+def _reset():
+    config.activate_profile()
+    Base.metadata.drop_all(bind=config.c.dbengine)
+    Base.metadata.create_all(bind=config.c.dbengine)
+    fsroot = config.c.fsroot
+    if fsroot.exists() and fsroot.basename() == "testfiles":
+        fsroot.rmtree()
+    fsroot.makedirs()
+
+    global macgyver
+    macgyver = User.create_user("MacGyver", "richarddean", "rich@sg1.com")
+    get_project(macgyver, macgyver, "bigmac", create=True)
+
+def _start(mode):
+    old_mode = mobwrite_daemon.SERVER_MODE
+    mobwrite_daemon.SERVER_MODE = mode
+    try:
+        server = mobwrite_daemon.make_server(("127.0.0.1", 0),
+                                             _Persister())
+    finally:
+        mobwrite_daemon.SERVER_MODE = old_mode
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server, t
+
+def _ask(server, question):
+    s = socket.create_connection(server.server_address)
+    try:
+        s.sendall(question)
+        data = []
+        while True:
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            data.append(chunk)
+        return "".join(data)
+    finally:
+        s.close()
+
+def _check_server(mode):
+    _reset()
+    mobwrite_daemon.request_stats.reset()
+    server, t = _start(mode)
+    try:
+        answers = []
+        for i in range(5):
+            answers.append(_ask(server,
+                "u:tester%s\nF:0:MacGyver/bigmac/foo.txt\nR:0:hello\n\n" % i))
+    finally:
+        server.shutdown()
+        t.join(5)
+    for answer in answers:
+        assert answer.startswith("F:0:MacGyver/bigmac/foo.txt\n"), answer
+    report = mobwrite_daemon.request_stats.report()
+    assert_equals(report["requests"], 5)
+    assert report["max_ms"] >= report["p99_ms"] >= report["p50_ms"] > 0
+    assert report["per_second"] > 0
+
+def test_threaded_server():
+    _check_server(mobwrite_daemon.THREADED)
+
+def test_event_loop_server():
+    _check_server(mobwrite_daemon.EVENT_LOOP)
+
+def test_event_loop_server_handles_connections_concurrently():
+    _reset()
+    server, t = _start(mobwrite_daemon.EVENT_LOOP)
+    try:
+        # a client that has not finished sending its request does not
+        # hold up the others
+        slow = socket.create_connection(server.server_address)
+        slow.sendall("u:slow\nF:0:MacGyver/bigmac/foo.txt\n")
+        answer = _ask(server, "u:fast\nF:0:MacGyver/bigmac/foo.txt\nR:0:hi\n\n")
+        assert answer.startswith("F:0:MacGyver/bigmac/foo.txt\n"), answer
+        slow.sendall("R:0:hi\n\n")
+        data = slow.recv(1024)
+        assert data.startswith("F:0:MacGyver/bigmac/foo.txt\n"), data
+        slow.close()
+    finally:
+        server.shutdown()
+        t.join(5)
+
+def _check_pool(mode):
+    _reset()
+    server, t = _start(mode)
+    pool = mobwriteclient.ConnectionPool(server.server_address, 2)
+    try:
+        for i in range(3):
+            answer = pool.request(
+                "u:tester\nF:%s:MacGyver/bigmac/foo.txt\nR:%s:hello\n\n"
+                % (i, i))
+            assert answer.startswith("F:%s:MacGyver/bigmac/foo.txt\n" % i), \
+                answer
+        # one connection carried all of the requests
+        assert_equals(pool.connects, 1)
+
+        # plain requests still work alongside the framed ones
+        answer = _ask(server,
+            "u:other\nF:0:MacGyver/bigmac/foo.txt\nR:0:hello\n\n")
+        assert answer.startswith("F:0:MacGyver/bigmac/foo.txt\n"), answer
+    finally:
+        pool.close()
+        server.shutdown()
+        t.join(5)
+
+def test_pooled_connections_to_threaded_server():
+    _check_pool(mobwrite_daemon.THREADED)
+
+def test_pooled_connections_to_event_loop_server():
+    _check_pool(mobwrite_daemon.EVENT_LOOP)
+
+def test_pool_reconnects_after_idle_timeout():
+    _reset()
+    old_timeout = mobwrite_daemon.TIMEOUT_IDLE
+    mobwrite_daemon.TIMEOUT_IDLE = 0.1
+    server, t = _start(mobwrite_daemon.EVENT_LOOP)
+    pool = mobwriteclient.ConnectionPool(server.server_address, 2)
+    try:
+        pool.request("u:tester\nF:0:MacGyver/bigmac/foo.txt\nR:0:hi\n\n")
+        time.sleep(1.2)
+        answer = pool.request("u:tester\nF:0:MacGyver/bigmac/foo.txt\nR:0:hi\n\n")
+        assert answer.startswith("F:0:MacGyver/bigmac/foo.txt\n"), answer
+        assert_equals(pool.connects, 2)
+    finally:
+        mobwrite_daemon.TIMEOUT_IDLE = old_timeout
+        pool.close()
+        server.shutdown()
+        t.join(5)
+
+def test_request_stats_percentiles():
+    stats = mobwrite_daemon.RequestStats(samples=100)
+    for i in range(1, 201):
+        stats.record(i / 1000.0)
+    report = stats.report()
+    assert_equals(report["requests"], 200)
+    # only the last 100 samples are kept
+    assert_equals(report["p50_ms"], 151.0)
+    assert_equals(report["p99_ms"], 200.0)
+    assert_equals(report["max_ms"], 200.0)
+
+def test_shard_ring_moves_few_documents_when_a_shard_is_added():
+    names = ["MacGyver/bigmac/file%s.js" % i for i in range(1000)]
+    three = mobwriteclient.ShardRing(3)
+    four = mobwriteclient.ShardRing(4)
+    owners = [three.shard(name) for name in names]
+    for shard in range(3):
+        assert owners.count(shard) > 200, owners.count(shard)
+    moved = [name for name in names if three.shard(name) != four.shard(name)]
+    # only documents taken over by the new shard move
+    for name in moved:
+        assert_equals(four.shard(name), 3)
+    assert len(moved) < 400, len(moved)
+
+def test_split_request_by_shard():
+    question = ("H:joe:127.0.0.1\nu:joe\nF:1:joe/p/a\nd:1:=5\n"
+                "F:2:joe/p/b\nd:2:=3\nn:joe/p/c\n\n")
+    shards = {"joe/p/a": 0, "joe/p/b": 1, "joe/p/c": 0}
+    parts = mobwriteclient.split_request(question, shards.get)
+    assert_equals(parts, [
+        (0, "u:joe\nH:joe:127.0.0.1\nF:1:joe/p/a\nd:1:=5\n"
+            "u:joe\nH:joe:127.0.0.1\nn:joe/p/c\n\n"),
+        (1, "u:joe\nH:joe:127.0.0.1\nF:2:joe/p/b\nd:2:=3\n\n")])
+
+    # buffers are assembled before they are split
+    buffered = "b:abc 2 1 F%3A0%3Ajoe/p/a\n\n"
+    assert_equals(mobwriteclient.buffer_name(buffered), "abc")
+    assert_equals(mobwriteclient.buffer_name(question), None)
+    assert_equals(mobwriteclient.split_request(buffered, shards.get), [])
+
+    # a request is only held when it goes to one shard
+    held = "W:20\n" + question
+    assert_equals(mobwriteclient.split_request(held, shards.get), parts)
+    held = "W:20\nu:joe\nF:1:joe/p/a\nd:1:=5\n\n"
+    assert_equals(mobwriteclient.split_request(held, shards.get),
+                  [(0, held)])
+
+def test_sharded_pool_sends_documents_to_their_shards():
+    _reset()
+    servers = [_start(mobwrite_daemon.EVENT_LOOP) for i in range(2)]
+    pools = [mobwriteclient.ConnectionPool(server.server_address, 2)
+             for server, t in servers]
+    sharded = mobwriteclient.ShardedPool(pools)
+    names = ["MacGyver/bigmac/file%s.txt" % i for i in range(20)]
+    first = [name for name in names if sharded.ring.shard(name) == 0][0]
+    second = [name for name in names if sharded.ring.shard(name) == 1][0]
+    try:
+        answer = sharded.request("u:tester\nF:0:%s\nR:0:one\n"
+                                 "F:0:%s\nR:0:two\n\n" % (first, second))
+        assert ("F:0:%s\n" % first) in answer, answer
+        assert ("F:0:%s\n" % second) in answer, answer
+        assert_equals([pool.connects for pool in pools], [1, 1])
+    finally:
+        sharded.close()
+        for server, t in servers:
+            server.shutdown()
+            t.join(5)
+
+class _RecordingPool(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.questions = []
+
+    def request(self, question):
+        self.questions.append(question)
+        return self.pool.request(question)
+
+    def close(self):
+        self.pool.close()
+
+def test_sharded_pool_assembles_buffers_before_splitting():
+    _reset()
+    servers = [_start(mobwrite_daemon.EVENT_LOOP) for i in range(2)]
+    pools = [_RecordingPool(mobwriteclient.ConnectionPool(
+             server.server_address, 2)) for server, t in servers]
+    sharded = mobwriteclient.ShardedPool(pools)
+    names = ["MacGyver/bigmac/file%s.txt" % i for i in range(20)]
+    document = [name for name in names if sharded.ring.shard(name) == 1][0]
+    buffers = ["buf%s" % i for i in range(20)]
+    buffer = [name for name in buffers if sharded.ring.shard(name) == 0][0]
+    request = urllib.quote("u:tester\nF:0:%s\nR:0:hello\n" % document)
+    half = len(request) // 2
+    try:
+        answer = sharded.request("b:%s 2 1 %s\n\n" % (buffer, request[:half]))
+        assert_equals(answer, "")
+        answer = sharded.request("b:%s 2 2 %s\n\n" % (buffer, request[half:]))
+        assert answer.startswith("F:0:%s\n" % document), answer
+        # the buffer's shard only assembled the request, the document's
+        # shard executed it
+        assert_equals(len(pools[0].questions), 2)
+        for question in pools[0].questions:
+            assert question.startswith("A:\nb:"), question
+        assert_equals(pools[1].questions,
+                      ["u:tester\nF:0:%s\nR:0:hello\n\n" % document])
+    finally:
+        sharded.close()
+        for server, t in servers:
+            server.shutdown()
+            t.join(5)
+
+def _different_stripes(registry, make_key):
+    keys = [make_key(i) for i in range(20)]
+    first = keys[0]
+    for key in keys[1:]:
+        if registry.lock(key) is not registry.lock(first):
+            return first, key
+    raise AssertionError("all keys in one stripe")
+
+def test_fetch_does_not_wait_for_unrelated_documents():
+    _reset()
+    persister = _Persister()
+    busy, free = _different_stripes(mobwrite_daemon.views,
+        lambda i: ("tester", "MacGyver/bigmac/file%s.txt" % i))
+    lock = mobwrite_daemon.views.lock(busy)
+    lock.acquire()
+    try:
+        fetched = []
+        t = threading.Thread(target=lambda: fetched.append(
+            mobwrite_daemon.fetch_viewobj(free[0], free[1], None, persister)))
+        t.start()
+        t.join(5)
+        assert fetched, "fetch waited for another document's stripe"
+        assert_equals(fetched[0].filename, free[1])
+    finally:
+        lock.release()
+    view = mobwrite_daemon.fetch_viewobj(busy[0], busy[1], None, persister)
+    assert_equals(view.filename, busy[1])
+    assert mobwrite_daemon.views.get(busy) is view
+    assert mobwrite_daemon.texts.get(busy[1]) is view.textobj
+
+    # idle views and their texts are cleaned up
+    view.nullify()
+    fetched[0].nullify()
+    mobwrite_daemon.cleanup()
+    assert busy not in mobwrite_daemon.views
+    assert busy[1] not in mobwrite_daemon.texts
+
+class _CountingPersister(_Persister):
+    def __init__(self):
+        _Persister.__init__(self)
+        self.saved = []
+
+    def save(self, name, contents):
+        self.saved.append(name)
+        _Persister.save(self, name, contents)
+
+def test_cleanup_saves_changed_texts_and_expires_due_objects():
+    _reset()
+    mobwrite_daemon.cleanup()
+    persister = _CountingPersister()
+    active = mobwrite_daemon.fetch_viewobj("tester",
+        "MacGyver/bigmac/active.txt", None, persister)
+    other = mobwrite_daemon.fetch_viewobj("tester",
+        "MacGyver/bigmac/other.txt", None, persister)
+
+    active.textobj.lock.acquire()
+    active.textobj.setText(u"edited")
+    active.textobj.lock.release()
+
+    old_timeout = mobwrite_core.TIMEOUT_VIEW
+    mobwrite_core.TIMEOUT_VIEW = 0
+    try:
+        idle = mobwrite_daemon.fetch_viewobj("tester",
+            "MacGyver/bigmac/idle.txt", None, persister)
+        # the monotonic clock may only tick every hundredth of a second
+        time.sleep(0.02)
+        mobwrite_daemon.cleanup()
+    finally:
+        mobwrite_core.TIMEOUT_VIEW = old_timeout
+
+    # the idle view went and took its text with it, the edited text
+    # was saved and the untouched one was not
+    assert ("tester", "MacGyver/bigmac/idle.txt") not in mobwrite_daemon.views
+    assert "MacGyver/bigmac/idle.txt" not in mobwrite_daemon.texts
+    assert mobwrite_daemon.views.get(
+        ("tester", "MacGyver/bigmac/active.txt")) is active
+    assert_equals(sorted(persister.saved),
+                  ["MacGyver/bigmac/active.txt", "MacGyver/bigmac/idle.txt"])
+    assert not active.textobj.changed
+
+    # nothing changed or became due, so nothing is saved
+    persister.saved = []
+    mobwrite_daemon.cleanup()
+    assert_equals(persister.saved, [])
+
+class _DictPersister(object):
+    def __init__(self, texts):
+        self.texts = texts
+        self.saves = 0
+
+    def check_access(self, name):
+        pass
+
+    def load(self, name):
+        return self.texts.get(name, "")
+
+    def save(self, name, contents):
+        self.saves += 1
+        self.texts[name] = contents
+
+    def close(self, name):
+        pass
+
+def test_journal_writes_edits_and_compacts():
+    directory = tempfile.mkdtemp()
+    try:
+        name = "MacGyver/bigmac/big.txt"
+        original = "line\n" * 2000
+        backing = _DictPersister({name: original})
+        persister = mobwrite_daemon.JournalPersister(backing, directory)
+        text = persister.load(name)
+        assert_equals(text, original)
+
+        journal_file = persister.filename(name)
+        for i in range(10):
+            text = text + "edit %s\n" % i
+            persister.save(name, text)
+        # the edits went to the journal, not to the saved text
+        assert_equals(backing.saves, 0)
+        assert os.path.getsize(journal_file) < 500, \
+            os.path.getsize(journal_file)
+
+        # unloading folds the journal into the text
+        persister.close(name)
+        assert_equals(backing.saves, 1)
+        assert_equals(backing.texts[name], text)
+        assert not os.path.exists(journal_file)
+
+        # a journal bigger than the text is folded in right away
+        persister.load(name)
+        persister.save(name, "x" * 20000)
+        assert_equals(backing.saves, 2)
+        assert not os.path.exists(journal_file)
+    finally:
+        shutil.rmtree(directory)
+
+def test_journal_is_replayed_after_a_crash():
+    directory = tempfile.mkdtemp()
+    try:
+        name = "MacGyver/bigmac/crash.txt"
+        backing = _DictPersister({name: u"hello world\n"})
+        persister = mobwrite_daemon.JournalPersister(backing, directory)
+        persister.load(name)
+        persister.save(name, u"hello there world\n")
+        persister.save(name, u"hello there world\n\u00e9t\u00e9\n")
+        # never closed, as if the process died
+
+        recovered = mobwrite_daemon.JournalPersister(backing, directory)
+        assert_equals(recovered.load(name),
+                      u"hello there world\n\u00e9t\u00e9\n")
+        assert_equals(backing.texts[name],
+                      u"hello there world\n\u00e9t\u00e9\n")
+        assert not os.path.exists(recovered.filename(name))
+    finally:
+        shutil.rmtree(directory)
+
+def test_stale_journal_is_not_replayed():
+    directory = tempfile.mkdtemp()
+    try:
+        name = "MacGyver/bigmac/stale.txt"
+        backing = _DictPersister({name: u"one\n"})
+        persister = mobwrite_daemon.JournalPersister(backing, directory)
+        persister.load(name)
+        persister.save(name, u"one\ntwo\n")
+        # the text was written out but the process died before the
+        # journal was removed
+        backing.texts[name] = u"one\ntwo\n"
+
+        recovered = mobwrite_daemon.JournalPersister(backing, directory)
+        assert_equals(recovered.load(name), u"one\ntwo\n")
+        assert not os.path.exists(recovered.filename(name))
+    finally:
+        shutil.rmtree(directory)
+
+def test_journal_of_a_deep_path_has_a_short_filename():
+    directory = tempfile.mkdtemp()
+    try:
+        name = "MacGyver/bigmac/" + "/".join(["nested%d" % i
+                                               for i in range(40)]) + "/a.txt"
+        backing = _DictPersister({name: u"one\n"})
+        persister = mobwrite_daemon.JournalPersister(backing, directory)
+        persister.load(name)
+        persister.save(name, u"one\ntwo\n")
+        journal_file = persister.filename(name)
+        assert len(os.path.basename(journal_file)) < 255
+        assert_equals(os.listdir(directory), [os.path.basename(journal_file)])
+        header = open(journal_file).readline()
+        assert urllib.quote(name, "") in header, header
+
+        recovered = mobwrite_daemon.JournalPersister(backing, directory)
+        assert_equals(recovered.load(name), u"one\ntwo\n")
+    finally:
+        shutil.rmtree(directory)
+
+class _FailingPersister(_DictPersister):
+    def save(self, name, contents):
+        raise IOError("disk full")
+
+def test_failed_save_keeps_the_text_and_releases_its_lock():
+    _reset()
+    persister = _FailingPersister({})
+    name = "MacGyver/bigmac/full.txt"
+    view = mobwrite_daemon.fetch_viewobj("tester", name, None, persister)
+    textobj = view.textobj
+    textobj.lock.acquire()
+    textobj.setText(u"unsaved")
+    textobj.lock.release()
+    view.nullify()
+
+    assert not textobj.cleanup()
+    assert not textobj.lock.locked()
+    assert mobwrite_daemon.texts.get(name) is textobj
+    assert textobj.changed
+
+def test_persister_remembers_projects_until_sharing_changes():
+    _reset()
+    other = User.create_user("Murdoc", "", "murdoc@badpeople.bad")
+    persister = mobwrite_daemon.Persister()
+    project, path = persister.check_access("MacGyver/bigmac/foo.txt")
+    assert_equals(path, "foo.txt")
+    again, path = persister.check_access("MacGyver/bigmac/bar.txt")
+    assert again is project
+    assert_equals(path, "bar.txt")
+
+    macgyver.add_sharing(project, other, False, False)
+    shared, path = persister.check_access("Murdoc/MacGyver+bigmac/foo.txt")
+    assert_equals(shared.name, "bigmac")
+    fresh, path = persister.check_access("MacGyver/bigmac/foo.txt")
+    assert fresh is not project
+
+    macgyver.remove_sharing(project, other)
+    try:
+        persister.check_access("Murdoc/MacGyver+bigmac/foo.txt")
+        assert False, "Expected NotAuthorized"
+    except NotAuthorized:
+        pass
+
+def _diff_counts():
+    report = mobwrite_daemon.diff_stats.report()
+    return (report["diffs_computed"], report["diffs_skipped"])
+
+def test_idle_polls_skip_the_diff():
+    _reset()
+    mobwrite_daemon.diff_stats.reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    name = "MacGyver/bigmac/idle.txt"
+
+    answer = handler.handleRequest("u:tester\nF:0:%s\nR:0:hello\n\n" % name)
+    assert "D:0:=5\n" in answer, answer
+    assert_equals(_diff_counts(), (1, 0))
+
+    # nothing has changed, so the empty delta comes without a diff
+    answer = handler.handleRequest("u:tester\nF:1:%s\nd:0:=5\n\n" % name)
+    assert "d:1:=5\n" in answer, answer
+    assert_equals(_diff_counts(), (1, 1))
+
+    # another view's edit has to be diffed
+    textobj = mobwrite_daemon.texts[name]
+    textobj.lock.acquire()
+    textobj.setText(u"hello world")
+    textobj.lock.release()
+    answer = handler.handleRequest("u:tester\nF:2:%s\nd:1:=5\n\n" % name)
+    assert "d:2:=5\t+ world\n" in answer, answer
+    assert_equals(_diff_counts(), (2, 1))
+
+    # and so does an edit from this view
+    answer = handler.handleRequest(
+        "u:tester\nF:3:%s\nd:2:=11\t+!\n\n" % name)
+    assert "d:3:=12\n" in answer, answer
+    assert_equals(textobj.text, u"hello world!")
+    assert_equals(_diff_counts(), (3, 1))
+
+def test_large_texts_are_diffed_line_by_line_first():
+    mobwrite_core.DIFF_PATHS.reset()
+    lines = [u"line %d of the file\n" % i for i in range(1000)]
+    text1 = u"".join(lines)
+
+    # a small change stays character by character
+    text2 = text1.replace(u"line 500 ", u"line five hundred ")
+    diffs = mobwrite_core.diff(text1, text2)
+    assert_equals(mobwrite_core.DMP.diff_text2(diffs), text2)
+    assert_equals(mobwrite_core.DMP.diff_levenshtein(diffs), 12)
+    assert_equals(mobwrite_core.DIFF_PATHS.report()["chars"], 1)
+
+    # scattered edits are refined within the changed lines
+    edited = list(lines)
+    edited[10] = u"line ten of the file\n"
+    edited[990] = u"line 990 of the text\n"
+    text2 = u"".join(edited)
+    diffs = mobwrite_core.diff(text1, text2)
+    assert_equals(mobwrite_core.DMP.diff_text1(diffs), text1)
+    assert_equals(mobwrite_core.DMP.diff_text2(diffs), text2)
+    assert mobwrite_core.DMP.diff_levenshtein(diffs) < 10
+
+    # reindenting pairs the lines up
+    edited = lines[:100] + [u"  " + line for line in lines[100:400]] + \
+        lines[400:]
+    text2 = u"".join(edited)
+    diffs = mobwrite_core.diff(text1, text2)
+    assert_equals(mobwrite_core.DMP.diff_text2(diffs), text2)
+    assert_equals(mobwrite_core.DMP.diff_levenshtein(diffs), 600)
+
+    # and a rewrite too large to refine is sent as whole lines
+    edited = lines[:100] + [u"%d\n" % i for i in range(150)] + lines[300:]
+    text2 = u"".join(edited)
+    diffs = mobwrite_core.diff(text1, text2)
+    assert_equals(mobwrite_core.DMP.diff_text2(diffs), text2)
+
+    assert_equals(mobwrite_core.DIFF_PATHS.report(),
+                  dict(chars=1, lines=3, hunks_refined=2, hunks_paired=1,
+                       hunks_whole=1))
+
+def _fragments(name, request, count):
+    quoted = urllib.quote(request)
+    size = len(quoted) // count + 1
+    return ["b:%s %d %d %s\n\n" % (name, count, i + 1,
+                                   quoted[i * size:(i + 1) * size])
+            for i in range(count)]
+
+def test_buffers_are_assembled_from_fragments():
+    _reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    request = "u:tester\nF:0:MacGyver/bigmac/pasted.txt\nR:0:%s\n\n" % (
+        "pasted%20text%20" * 500)
+    fragments = _fragments("paste", request, 20)
+    # the fragments can arrive in any order
+    for fragment in reversed(fragments[1:]):
+        assert_equals(handler.handleRequest(fragment), "")
+    assert_equals(len(mobwrite_daemon.buffers), 1)
+    answer = handler.handleRequest(fragments[0])
+    assert answer.startswith("F:0:MacGyver/bigmac/pasted.txt\n"), answer
+    assert_equals(mobwrite_daemon.texts["MacGyver/bigmac/pasted.txt"].text,
+                  u"pasted text " * 500)
+    assert_equals(mobwrite_daemon.buffers, {})
+    assert_equals(mobwrite_daemon.buffer_chars, 0)
+
+def test_buffers_are_limited_in_size():
+    _reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    request = "u:tester\nF:0:MacGyver/bigmac/big.txt\nR:0:%s\n\n" % ("x" * 400)
+    old_limits = (mobwrite_daemon.MAX_BUFFER_CHARS,
+                  mobwrite_daemon.MAX_BUFFERS_CHARS)
+    mobwrite_daemon.MAX_BUFFER_CHARS = 300
+    mobwrite_daemon.MAX_BUFFERS_CHARS = 300
+    try:
+        # a buffer too large for itself is dropped as it goes over, so
+        # only the last fragment is left, in a buffer of its own
+        for fragment in _fragments("big", request, 4):
+            assert_equals(handler.handleRequest(fragment), "")
+        assert_equals(mobwrite_daemon.buffers.keys(), ["big_4"])
+        big = mobwrite_daemon.buffers["big_4"]
+        assert_equals(big.filled, 1)
+        assert_equals(mobwrite_daemon.buffer_chars, big.chars)
+
+        # and half-finished buffers can't take more than their share
+        handler.handleRequest(_fragments("second", request, 4)[0])
+        handler.handleRequest(_fragments("third", request, 4)[0])
+        assert_equals(sorted(mobwrite_daemon.buffers.keys()),
+                      ["big_4", "second_4"])
+        assert mobwrite_daemon.buffer_chars <= 300
+    finally:
+        (mobwrite_daemon.MAX_BUFFER_CHARS,
+         mobwrite_daemon.MAX_BUFFERS_CHARS) = old_limits
+        for bufferobj in mobwrite_daemon.buffers.values():
+            bufferobj.discard()
+    assert_equals(mobwrite_daemon.buffer_chars, 0)
+
+def _held(handler, question):
+    # answers question on another thread, returning the thread and a list
+    # that gets the answer and how long it took
+    result = []
+    def ask():
+        start = time.time()
+        answer = handler.handleRequest(question)
+        result.extend([answer, time.time() - start])
+    t = threading.Thread(target=ask)
+    t.setDaemon(True)
+    t.start()
+    return t, result
+
+def _edit(name, text):
+    textobj = mobwrite_daemon.texts[name]
+    textobj.lock.acquire()
+    textobj.setText(text)
+    textobj.lock.release()
+
+def test_held_request_returns_when_the_text_changes():
+    _reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    name = "MacGyver/bigmac/held.txt"
+    handler.handleRequest("u:tester\nF:0:%s\nR:0:hello\n\n" % name)
+
+    t, result = _held(handler, "W:10\nu:tester\nF:1:%s\nd:0:=5\n\n" % name)
+    time.sleep(0.2)
+    assert not result
+    _edit(name, u"hello world")
+    t.join(5)
+    answer, elapsed = result
+    assert "d:1:=5\t+ world\n" in answer, answer
+    assert elapsed < 5, elapsed
+
+    # with nothing to send either way, it gives up after the wait
+    start = time.time()
+    answer = handler.handleRequest(
+        "W:0.3\nu:tester\nF:2:%s\nd:1:=11\n\n" % name)
+    assert "d:2:=11\n" in answer, answer
+    assert time.time() - start >= 0.3
+
+    # a request with edits is answered at once
+    answer = handler.handleRequest(
+        "W:10\nu:tester\nF:3:%s\nd:2:=11\t+!\n\n" % name)
+    assert "d:3:=12\n" in answer, answer
+
+def test_held_request_is_dropped_when_the_client_asks_again():
+    _reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    name = "MacGyver/bigmac/held.txt"
+    handler.handleRequest("u:tester\nF:0:%s\nR:0:hello\n\n" % name)
+
+    t, result = _held(handler, "W:10\nu:tester\nF:1:%s\nd:0:=5\n\n" % name)
+    time.sleep(0.2)
+    answer = handler.handleRequest(
+        "u:tester\nF:1:%s\nd:0:=5\nd:1:=5\t+!\n\n" % name)
+    assert "d:1:=6\n" in answer, answer
+    t.join(5)
+    answer, elapsed = result
+    assert_equals(answer, "")
+    assert elapsed < 5, elapsed
+    assert_equals(mobwrite_daemon.texts[name].text, u"hello!")
+
+def test_event_loop_holds_requests_without_a_worker():
+    _reset()
+    server, t = _start(mobwrite_daemon.EVENT_LOOP)
+    name = "MacGyver/bigmac/held.txt"
+    try:
+        _ask(server, "u:tester\nF:0:%s\nR:0:hello\n\n" % name)
+        result = []
+        def ask():
+            result.append(_ask(server,
+                "W:10\nu:tester\nF:1:%s\nd:0:=5\n\n" % name))
+        asker = threading.Thread(target=ask)
+        asker.setDaemon(True)
+        asker.start()
+        for i in range(50):
+            if server.held:
+                break
+            time.sleep(0.05)
+        assert_equals(len(server.held), 1)
+        assert_equals(server.in_flight, 0)
+        _edit(name, u"hello world")
+        asker.join(5)
+        assert "d:1:=5\t+ world\n" in result[0], result
+        assert_equals(len(server.held), 0)
+    finally:
+        server.shutdown()
+        t.join(5)
+
+def test_shadows_share_the_text():
+    _reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    name = "MacGyver/bigmac/shared.txt"
+    big = "x" * 10000
+    handler.handleRequest("u:one\nF:0:%s\nR:0:%s\n\n" % (name, big))
+    handler.handleRequest("u:two\nF:0:%s\nR:0:%s\n\n" % (name, big))
+    handler.handleRequest("u:one\nF:1:%s\nd:0:=10000\t+!\n\n" % name)
+    handler.handleRequest("u:two\nF:1:%s\nd:0:=10000\n\n" % name)
+
+    textobj = mobwrite_daemon.texts[name]
+    assert_equals(textobj.text, u"x" * 10000 + u"!")
+    for username in ("one", "two"):
+        viewobj = mobwrite_daemon.views[(username, name)]
+        assert viewobj.shadow is textobj.text
+    one = mobwrite_daemon.views[("one", name)]
+    assert one.backup_shadow is textobj.text
+
+    # the text is counted once, the rest is edit stacks and the shadow that
+    # "two" has not caught up from
+    size = sys.getsizeof(textobj.text)
+    assert size < textobj.memory < 2 * size + 1000, textobj.memory
+    assert textobj.peak_memory >= textobj.memory
+    report = mobwrite_daemon.memory_stats.report()
+    assert_equals(report["documents"][name]["memory_bytes"], textobj.memory)
+    assert report["memory_bytes"] >= textobj.memory
+
+def _age(name, minutes):
+    # make the text and its views look unused for the given time
+    textobj = mobwrite_daemon.texts[name]
+    then = mobwrite_core.monotonic() - minutes * 60
+    textobj.lasttime = then
+    for viewobj in textobj.views:
+        viewobj.lasttime = then
+
+def test_cold_texts_are_evicted_to_stay_within_the_memory_limit():
+    _reset()
+    persister = _Persister()
+    handler = mobwrite_daemon.DaemonMobWrite(persister)
+    project = get_project(macgyver, macgyver, "bigmac")
+    names = []
+    for name in ("coldest", "cold", "hot"):
+        project.save_file(name + ".txt", "")
+        names.append("MacGyver/bigmac/%s.txt" % name)
+    for name in names:
+        handler.handleRequest("u:tester\nF:0:%s\nR:0:%s\n\n"
+                              % (name, "y" * 5000))
+    _age(names[0], 120)
+    _age(names[1], 60)
+    coldest = mobwrite_daemon.texts[names[0]]
+
+    old_limits = (mobwrite_daemon.MAX_MEMORY, mobwrite_daemon.MEMORY_MIN_IDLE)
+    mobwrite_daemon.MEMORY_MIN_IDLE = 30 * 60
+    mobwrite_daemon.memory_stats.reset()
+    try:
+        used = mobwrite_daemon.memory_stats.used
+        size = coldest.memory
+        mobwrite_daemon.MAX_MEMORY = used - size
+        mobwrite_daemon.cleanup()
+        assert names[0] not in mobwrite_daemon.texts
+        assert ("tester", names[0]) not in mobwrite_daemon.views
+        assert names[1] in mobwrite_daemon.texts
+        assert_equals(mobwrite_daemon.memory_stats.used, used - size)
+        assert_equals(persister.load(names[0]), "y" * 5000)
+
+        # texts in use are kept even when over the limit
+        mobwrite_daemon.MAX_MEMORY = 1
+        mobwrite_daemon.cleanup()
+        assert names[1] not in mobwrite_daemon.texts
+        assert names[2] in mobwrite_daemon.texts
+        assert_equals(mobwrite_daemon.memory_stats.report()["texts_evicted"], 2)
+    finally:
+        (mobwrite_daemon.MAX_MEMORY, mobwrite_daemon.MEMORY_MIN_IDLE) = \
+            old_limits
+
+    # an evicted text's client starts over with the saved text
+    answer = handler.handleRequest("u:tester\nF:1:%s\nd:1:=5000\n\n"
+                                   % names[0])
+    assert ("R:0:" + "y" * 5000) in answer, answer
+
+def test_memory_benchmark():
+    results = benchmark.memory_benchmark(files=20)
+    objects = [result["object"] for result in results]
+    assert_equals(objects[:4], ["core TextObj", "core ViewObj",
+                                "daemon TextObj", "daemon ViewObj"])
+    for result in results[:4]:
+        assert 0 < result["after"] < result["before"], result
+    # the daemon's objects are gone again
+    for viewobj in mobwrite_daemon.views.values():
+        assert not viewobj.filename.startswith("bench/")
+    for textobj in mobwrite_daemon.texts.values():
+        assert not textobj.name.startswith("bench/")
+
+def test_load_generator_in_process():
+    _reset()
+    handler = mobwrite_daemon.DaemonMobWrite(_Persister())
+    report = loadgen.run(handler.handleRequest, users=6, files=3, syncs=10,
+                         threads=2, paste_rate=0.2, fragment=500,
+                         prefix="MacGyver/bigmac/loadtest/")
+    assert_equals(report["syncs"], 60)
+    assert report["syncs_per_second"] > 0
+    assert report["max_ms"] >= report["p99_ms"] >= report["p50_ms"] > 0
+    assert report["bytes_sent"] > 0 and report["bytes_received"] > 0
+    assert report["diff_ms"] > 0 and report["patch_ms"] > 0
+    assert report["persist_ms"] > 0
+    assert_equals(report["documents_converged"], report["documents"])
+
+def test_load_generator_over_tcp():
+    _reset()
+    server, t = _start(mobwrite_daemon.EVENT_LOOP)
+    pool = mobwriteclient.ConnectionPool(server.server_address, 2)
+    try:
+        report = loadgen.run(pool.request, users=4, files=2, syncs=5,
+                             threads=2, prefix="MacGyver/bigmac/loadtest/")
+    finally:
+        pool.close()
+        server.shutdown()
+        t.join(5)
+    assert_equals(report["syncs"], 20)
+    assert_equals(report["documents_converged"], report["documents"])
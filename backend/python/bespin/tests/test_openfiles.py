@@ -0,0 +1,105 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License
+# Version
+# 1.1 (the "License"); you may not use this file except in compliance
+# with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+import tempfile
+import threading
+
+from path import path
+
+from bespin import locks, openfiles
+
+def _check_registry(registry):
+    registry.opened("uuid1/bigmac", "bigmac", "foo/bar", "MacGyver", "rw")
+    registry.opened("uuid1/bigmac", "bigmac", "foo/bar", "Murdoc", "r")
+    registry.opened("uuid1/bigmac", "bigmac", "README", "MacGyver", "r")
+    registry.opened("uuid2/bigmac", "bigmac", "README", "Murdoc", "rw")
+
+    assert registry.users("uuid1/bigmac", "foo/bar") == dict(
+        MacGyver="rw", Murdoc="r")
+    assert registry.users("uuid1/bigmac", "other") == {}
+    assert registry.project_files("uuid1/bigmac") == {
+        "foo/bar": dict(MacGyver="rw", Murdoc="r"),
+        "README": dict(MacGyver="r")}
+    assert registry.user_files("MacGyver") == dict(bigmac={
+        "foo/bar": dict(mode="rw"), "README": dict(mode="r")})
+
+    # opening again just changes the mode
+    registry.opened("uuid1/bigmac", "bigmac", "README", "MacGyver", "rw")
+    assert registry.users("uuid1/bigmac", "README") == dict(MacGyver="rw")
+
+    registry.closed("uuid1/bigmac", "foo/bar", "Murdoc")
+    registry.closed("uuid1/bigmac", "foo/bar", "Murdoc")
+    assert registry.users("uuid1/bigmac", "foo/bar") == dict(MacGyver="rw")
+
+    registry.rename_project("uuid1/bigmac", "uuid1/littlemac", "littlemac")
+    assert registry.project_files("uuid1/bigmac") == {}
+    assert registry.user_files("MacGyver") == dict(littlemac={
+        "foo/bar": dict(mode="rw"), "README": dict(mode="rw")})
+
+    registry.forget_project("uuid1/littlemac")
+    assert registry.user_files("MacGyver") == {}
+    assert registry.user_files("Murdoc") == dict(bigmac={
+        "README": dict(mode="rw")})
+
+def test_memory_open_files():
+    _check_registry(openfiles.MemoryOpenFiles())
+
+def test_sqlite_open_files():
+    dbfile = path(tempfile.mktemp())
+    try:
+        _check_registry(openfiles.SQLiteOpenFiles(dbfile))
+        # the entries are visible from another instance
+        other = openfiles.SQLiteOpenFiles(dbfile)
+        assert other.users("uuid2/bigmac", "README") == dict(Murdoc="rw")
+    finally:
+        dbfile.remove()
+
+def test_sqlite_open_files_lock_through_the_lock_manager():
+    dbfile = path(tempfile.mktemp())
+    manager = locks.ThreadLocks()
+    try:
+        registry = openfiles.SQLiteOpenFiles(dbfile, manager)
+        registry.opened("uuid1/bigmac", "bigmac", "README", "MacGyver", "r")
+        reader = manager.shared(dbfile)
+        # readers don't wait for each other
+        assert registry.users("uuid1/bigmac", "README") == dict(MacGyver="r")
+        closed = []
+        writer = threading.Thread(target=lambda: closed.append(
+            registry.closed("uuid1/bigmac", "README", "MacGyver")))
+        writer.start()
+        writer.join(0.2)
+        # the writer waits for the reader
+        assert not closed
+        reader.release()
+        writer.join(5)
+        assert closed
+        assert registry.users("uuid1/bigmac", "README") == {}
+        stats = manager.stats()
+        assert stats["locks_contended"] == 1
+        assert stats["locks_acquired"] == 7
+    finally:
+        dbfile.remove()
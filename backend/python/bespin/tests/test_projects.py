@@ -30,14 +30,17 @@ import os
 from cStringIO import StringIO
 import tarfile
 import zipfile
+import threading
+import BaseHTTPServer
 
 from __init__ import BespinTestApp
 import simplejson
 from path import path
 
-from bespin import config, controllers
+from bespin import config, controllers, filesystem
 
 from bespin.filesystem import get_project, FileNotFound, _find_common_base
+from bespin.filesystem import OverQuota
 from bespin.database import User, Base
 
 tarfilename = os.path.join(os.path.dirname(__file__), "ut.tgz")
@@ -185,6 +188,70 @@ def test_reimport_wipes_out_the_project():
     for test in tests:
         yield run_one, test[0], test[1]
         
+def test_import_accounts_for_every_file():
+    tests = [
+        ("import_tarball", tarfilename),
+        ("import_zipfile", zipfilename)
+    ]
+
+    def run_one(func, f):
+        print "Testing %s" % (func)
+        handle = open(f)
+        _init_data()
+        starting_point = macgyver.amount_used
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        getattr(bigmac, func)(os.path.basename(f), handle)
+        handle.close()
+        files = [name for name in bigmac.location.walkfiles()]
+        total = sum(name.size for name in files)
+        assert len(files) == len(bigmac.search_files(""))
+        assert macgyver.amount_used == starting_point + total
+        assert bigmac.update_manifest() == 0
+
+    for test in tests:
+        yield run_one, test[0], test[1]
+
+def _make_archive(func, files):
+    data = StringIO()
+    if func == "import_tarball":
+        tfile = tarfile.open("big.tgz", "w:gz", fileobj=data)
+        for name, contents in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            tfile.addfile(info, StringIO(contents))
+        tfile.close()
+        filename = "big.tgz"
+    else:
+        zfile = zipfile.ZipFile(data, "w")
+        for name, contents in files:
+            zfile.writestr(name, contents)
+        zfile.close()
+        filename = "big.zip"
+    data.seek(0)
+    return filename, data
+
+def test_import_over_quota_writes_nothing():
+    def run_one(func):
+        print "Testing %s" % (func)
+        filename, data = _make_archive(func,
+            [("small.txt", "x" * 5), ("big.txt", "x" * 20)])
+        _init_data()
+        old_units = filesystem.QUOTA_UNITS
+        filesystem.QUOTA_UNITS = 1
+        macgyver.quota = macgyver.amount_used + 10
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        try:
+            getattr(bigmac, func)(filename, data)
+            assert False, "Expected an OverQuota exception"
+        except OverQuota:
+            pass
+        finally:
+            filesystem.QUOTA_UNITS = old_units
+        assert bigmac.location.listdir() == []
+
+    for func in ["import_tarball", "import_zipfile"]:
+        yield run_one, func
+
 def test_export_tarfile():
     _init_data()
     handle = open(tarfilename)
@@ -213,6 +280,31 @@ def test_export_zipfile():
     # the extra slash shows up in this context, but does not seem to be a problem
     assert 'bigmac/commands/yourcommands.js' in names
 
+def test_stream_tarball():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "INFO!")
+    big_contents = os.urandom(200000)
+    bigmac.save_file("big.txt", big_contents)
+    chunks = list(bigmac.stream_tarball())
+    # the data comes out in pieces, not as one finished archive
+    assert len(chunks) > 2
+    tfile = tarfile.open("bigmac.tgz", "r:gz", StringIO("".join(chunks)))
+    membersnames = [member.name for member in tfile.getmembers()]
+    assert "bigmac/foo/bar" in membersnames
+    assert tfile.extractfile("bigmac/big.txt").read() == big_contents
+    assert tfile.extractfile("bigmac/foo/bar").read() == "INFO!"
+
+def test_stream_zipfile():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "INFO!")
+    bigmac.save_file("README", "Read me")
+    chunks = list(bigmac.stream_zipfile())
+    assert len(chunks) == 3
+    zfile = zipfile.ZipFile(StringIO("".join(chunks)))
+    assert zfile.read("bigmac/foo/bar") == "INFO!"
+    assert zfile.read("bigmac/README") == "Read me"
 
 # -------
 # Web tests
@@ -243,6 +335,79 @@ def test_import_from_the_web():
     for test in tests:
         yield run_one, test
     
+class _ArchiveServer(BaseHTTPServer.HTTPServer):
+    """Serves archives from the files dict on a local port. Paths
+    ending in "nolength" are sent without a content-length."""
+    def __init__(self, files):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           _ArchiveHandler)
+        self.files = files
+
+    def url(self, name):
+        return "http://127.0.0.1:%s/%s" % (self.server_port, name)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+class _ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def send_archive(self, body):
+        data = self.server.files[self.path.split("/")[1]]
+        self.send_response(200)
+        if not self.path.endswith("nolength"):
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            try:
+                self.wfile.write(data)
+            except Exception:
+                # the client may hang up once it has seen enough
+                pass
+
+    def do_HEAD(self):
+        self.send_archive(False)
+
+    def do_GET(self):
+        self.send_archive(True)
+
+    def log_message(self, *args):
+        pass
+
+def test_import_from_a_url():
+    _init_data()
+    server = _ArchiveServer({"ut.tgz": open(tarfilename).read()})
+    server.start()
+    try:
+        app.post("/project/fromurl/newproj", server.url("ut.tgz"))
+    finally:
+        server.shutdown()
+    resp = app.get("/file/at/newproj/config.js")
+    assert resp.body == ""
+    app.post("/file/close/newproj/config.js")
+
+def test_import_from_a_url_stops_at_the_quota():
+    def run_one(name):
+        _init_data()
+        data = os.urandom(200000)
+        server = _ArchiveServer({name: data})
+        server.start()
+        old_units = filesystem.QUOTA_UNITS
+        filesystem.QUOTA_UNITS = 1
+        macgyver.quota = macgyver.amount_used + 100000
+        try:
+            resp = app.post("/project/fromurl/newproj", server.url(name),
+                            status=400)
+        finally:
+            filesystem.QUOTA_UNITS = old_units
+            server.shutdown()
+        assert "Over quota" in resp.body
+        proj_names = [proj.name for proj in macgyver.projects]
+        assert "newproj" not in proj_names
+
+    for name in ["big.tgz", "big.tgz?nolength"]:
+        yield run_one, name
+
 def test_import_unknown_file_type():
     _init_data()
     app.post("/project/import/newproj", upload_files=[
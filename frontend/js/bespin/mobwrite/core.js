@@ -102,6 +102,33 @@ mobwrite.syncRunPid_ = null;
 mobwrite.syncKillPid_ = null;
 
 
+/**
+ * PID of task which checks for client-side changes while a sync is held.
+ * @type {number?}
+ * @private
+ */
+mobwrite.syncHeldPid_ = null;
+
+
+/**
+ * Ask the server to hold syncs that carry no client-side changes until
+ * there are server-side changes to send back (Ajax only).  A held sync
+ * ties up a server thread, so this is turned on by the server: answers
+ * carry an X-Mobwrite-Long-Poll header when its mobwrite_long_poll
+ * setting is on.
+ * @type {boolean}
+ */
+mobwrite.longPoll = false;
+
+
+/**
+ * Track whether the sync that is airborne may be held by the server.
+ * @type {boolean}
+ * @private
+ */
+mobwrite.syncHeld_ = false;
+
+
 /**
  * Time to wait for a connection before giving up and retrying.
  * @type {number}
@@ -491,14 +518,60 @@ mobwrite.syncRun1_ = function() {
     // Execution will resume in mobwrite.callback();
   } else {
     // Issue Ajax post of client-side changes and request server-side changes.
-    data = 'q=' + encodeURIComponent(data);
+    // With nothing to send, ask the server to hold on to the request until
+    // it has something for us.
+    mobwrite.syncHeld_ = mobwrite.longPoll && !mobwrite.clientChange_;
+    data = (mobwrite.syncHeld_ ? 'w=' : 'q=') + encodeURIComponent(data);
     mobwrite.syncAjaxObj_ = mobwrite.syncLoadAjax_(mobwrite.syncGateway, data,
         mobwrite.syncCheckAjax_);
+    if (mobwrite.syncHeld_) {
+      window.clearInterval(mobwrite.syncHeldPid_);
+      mobwrite.syncHeldPid_ = window.setInterval(mobwrite.syncCheckHeld_,
+          mobwrite.minSyncInterval);
+    }
     // Execution will resume in either syncCheckAjax_(), or syncKill_()
   }
 };
 
 
+/**
+ * While a sync is held by the server, look for client-side changes.  If
+ * there are any, give up on the held sync and send them straight away.
+ * @private
+ */
+mobwrite.syncCheckHeld_ = function() {
+  if (!mobwrite.syncAjaxObj_) {
+    return;
+  }
+  var changed = false;
+  for (var x in mobwrite.shared) {
+    if (mobwrite.shared.hasOwnProperty(x)) {
+      var file = mobwrite.shared[x];
+      try {
+        if (file.deltaOk && file.getClientText(false) != file.shadowText) {
+          changed = true;
+        }
+      } catch (e) {
+        // Not synchronized yet, leave it to the next sync.
+      }
+    }
+  }
+  if (!changed) {
+    return;
+  }
+  window.clearInterval(mobwrite.syncHeldPid_);
+  mobwrite.syncHeldPid_ = null;
+  // The server drops the held request once it sees the next one.
+  var ajax = mobwrite.syncAjaxObj_;
+  mobwrite.syncAjaxObj_ = null;
+  ajax.abort();
+  window.clearTimeout(mobwrite.syncKillPid_);
+  mobwrite.syncKillPid_ = null;
+  window.clearTimeout(mobwrite.syncRunPid_);
+  mobwrite.syncRunPid_ = window.setTimeout(mobwrite.syncRun1_, 1);
+};
+
+
 /**
  * Callback location for JSON-P requests.
  */
@@ -705,7 +778,14 @@ mobwrite.syncRun2_ = function(text) {
     }
   }
 
+  window.clearInterval(mobwrite.syncHeldPid_);
+  mobwrite.syncHeldPid_ = null;
   mobwrite.computeSyncInterval_();
+  if (mobwrite.syncHeld_) {
+    // A held sync has already waited for the server, ask again soon.
+    mobwrite.syncInterval = mobwrite.minSyncInterval;
+    mobwrite.syncHeld_ = false;
+  }
 
   // Ensure that there is only one sync task.
   window.clearTimeout(mobwrite.syncRunPid_);
@@ -786,6 +866,8 @@ mobwrite.computeSyncInterval_ = function() {
  */
 mobwrite.syncKill_ = function() {
   mobwrite.syncKillPid_ = null;
+  window.clearInterval(mobwrite.syncHeldPid_);
+  mobwrite.syncHeldPid_ = null;
   if (mobwrite.syncAjaxObj_) {
     // Cleanup old Ajax connection.
     mobwrite.syncAjaxObj_.abort();
@@ -860,6 +942,8 @@ mobwrite.syncCheckAjax_ = function() {
     if (mobwrite.syncAjaxObj_.status == 200) {
       try {
         var text = mobwrite.syncAjaxObj_.responseText;
+        mobwrite.longPoll =
+            !!mobwrite.syncAjaxObj_.getResponseHeader('X-Mobwrite-Long-Poll');
         mobwrite.syncAjaxObj_ = null;
         mobwrite.syncRun2_(text);
       }
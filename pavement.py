@@ -676,9 +676,130 @@ def test():
     system("nosetests backend/python/bespin")
 
 @task
-def mobwrite():
+@cmdopts([('eventloop', 'e', "Serve connections from one event loop"),
+          ('shards=', 's', "Number of daemon processes to run"),
+          ('journal=', 'j', "Directory for the journal of edits")])
+def mobwrite(options):
+    """Run the mobwrite daemon. By default each connection gets its
+    own thread, -e serves them all from one event loop that hands
+    the diff and patch work to a pool of threads. -s runs that many
+    daemons on consecutive ports, each owning a share of the
+    documents; set mobwrite_shards to the same number for the
+    web server. -j keeps a journal of the edits to each file in the
+    given directory, writing files out in full only now and then."""
     from bespin.mobwrite import mobwrite_daemon
-    mobwrite_daemon.main()
+    if options.mobwrite.get('eventloop'):
+        mobwrite_daemon.SERVER_MODE = mobwrite_daemon.EVENT_LOOP
+    if options.mobwrite.get('journal'):
+        mobwrite_daemon.JOURNAL_DIR = options.mobwrite.journal
+    shards = int(options.mobwrite.get('shards') or 1)
+    if shards > 1:
+        mobwrite_daemon.main_shards(shards)
+    else:
+        mobwrite_daemon.main()
+
+@task
+@cmdopts([('lines=', 'l', "Number of lines in the file that is edited"),
+          ('timeout=', 't', "Seconds each diff may take, 0 for no limit")])
+def diffbench(options):
+    """Time the diff engine on edits to a generated source file,
+    against the diff_map engine it replaced. Defaults to a 2000 line
+    file and the timeout mobwrite uses."""
+    from bespin.mobwrite import benchmark
+    timeout = options.diffbench.get('timeout')
+    if timeout is not None:
+        timeout = float(timeout)
+    benchmark.print_diff_benchmark(int(options.diffbench.get('lines') or 2000),
+                                   timeout)
+
+@task
+@cmdopts([('files=', 'f', "Number of texts to create"),
+          ('views=', 'v', "Number of views of each text")])
+def memorybench(options):
+    """Measure the bytes taken by each mobwrite text and view, before
+    and after they used __slots__. Defaults to 1000 texts with 2 views
+    each."""
+    from bespin.mobwrite import benchmark
+    benchmark.print_memory_benchmark(
+        int(options.memorybench.get('files') or 1000),
+        int(options.memorybench.get('views') or 2))
+
+@task
+@cmdopts([('target=', 'T', "inprocess, tcp for the running daemon, or serve "
+                           "to start a daemon in this process"),
+          ('eventloop', 'e', "With serve, use the event loop daemon"),
+          ('users=', 'u', "Number of simulated users"),
+          ('files=', 'f', "Number of shared files"),
+          ('syncs=', 'n', "Number of syncs per user"),
+          ('threads=', 'c', "Number of users syncing at once"),
+          ('editrate=', 'r', "Chance of typing before each sync"),
+          ('pasterate=', 'p', "Chance of a paste before each sync"),
+          ('pastesize=', 's', "Characters in each paste"),
+          ('fragment=', 'b', "Send requests longer than this in b: buffers")])
+def loadtest(options):
+    """Simulate users editing shared files through mobwrite and report
+    the syncs per second, latency, bytes on the wire and the time
+    spent on diffs, patches and persistence. The files belong to a
+    loadtest user in the dev database. -T tcp talks to the daemon that
+    "paver mobwrite" runs, which logs its own split of the time."""
+    import threading
+    from bespin import config, filesystem, mobwriteclient
+    from bespin.database import User
+    from bespin.mobwrite import loadgen, mobwrite_daemon
+    opts = options.loadtest
+    target = opts.get('target') or 'inprocess'
+    if target not in ('inprocess', 'tcp', 'serve'):
+        raise BuildFailure("Unknown target: %s" % target)
+
+    config.set_profile("dev")
+    config.c.in_process_mobwrite = (target == 'inprocess')
+    config.activate_profile()
+    session = config.c.session_factory()
+    owner = User.find_user("loadtest")
+    if owner is None:
+        owner = User.create_user("loadtest", "loadtest", "loadtest@foo.com")
+    filesystem.get_project(owner, owner, "loadtest", create=True)
+    session.commit()
+
+    server = pool = None
+    if target == 'inprocess':
+        from bespin import controllers
+        request = controllers.InProcessMobwriteWorker().processRequest
+    elif target == 'tcp':
+        request = config.c.mobwrite_pool.request
+    else:
+        if opts.get('eventloop'):
+            mobwrite_daemon.SERVER_MODE = mobwrite_daemon.EVENT_LOOP
+        server = mobwrite_daemon.make_server(("127.0.0.1", 0),
+                                             mobwrite_daemon.Persister())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        pool = mobwriteclient.ConnectionPool(server.server_address,
+                                             int(opts.get('threads') or 4))
+        request = pool.request
+
+    try:
+        report = loadgen.run(request,
+            users=int(opts.get('users') or 20),
+            files=int(opts.get('files') or 5),
+            syncs=int(opts.get('syncs') or 50),
+            threads=int(opts.get('threads') or 4),
+            edit_rate=float(opts.get('editrate') or 0.5),
+            paste_rate=float(opts.get('pasterate') or 0.02),
+            paste_size=int(opts.get('pastesize') or 2000),
+            fragment=int(opts.get('fragment') or 0),
+            prefix="loadtest/loadtest/")
+    finally:
+        if pool is not None:
+            pool.close()
+        if server is not None:
+            server.shutdown()
+    if target == 'tcp':
+        # the daemon's times are in the daemon's process
+        for key in ('diff_ms', 'patch_ms', 'persist_ms'):
+            report[key] = None
+    loadgen.print_report(report)
 
 @task
 def seeddb():